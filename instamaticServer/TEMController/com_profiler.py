@@ -0,0 +1,147 @@
+import inspect
+import threading
+from time import perf_counter
+
+# results of COM accesses that are returned as they are, anything else is
+# a COM object whose accesses are profiled as well
+_VALUE_TYPES = (bool, int, float, complex, str, bytes, tuple, list, dict, type(None))
+
+_REPORT_KEYS = ('total', 'count', 'mean', 'max')
+
+
+def unwrap(obj):
+    """Return the COM object behind `obj` if it is a `ComProxy`."""
+    if isinstance(obj, ComProxy):
+        return object.__getattribute__(obj, '_obj')
+    return obj
+
+
+class ComProfiler:
+    """Counts and times the COM accesses made through `ComProxy` objects.
+
+    Every attribute get, attribute set and method call is recorded under
+    the dispatch path (e.g. `Stage.Position.X`) and the server command
+    that was running, set by the worker in `command`.
+    """
+
+    def __init__(self):
+        self.command = None
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, path: str, kind: str, duration: float) -> None:
+        key = (self.command, path, kind)
+        with self._lock:
+            try:
+                entry = self._stats[key]
+            except KeyError:
+                entry = self._stats[key] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += duration
+            if duration > entry[2]:
+                entry[2] = duration
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+    def report(self, sort: str = 'total', reset: bool = False) -> list:
+        """Return the recorded accesses as a list of dicts with the `command`,
+        `path`, `kind` (get, set or call), `count`, `total`, `mean` and
+        `max` time in s, sorted by `sort` from high to low."""
+        if sort not in _REPORT_KEYS:
+            raise ValueError('Cannot sort the report by: %s' % (sort))
+        with self._lock:
+            stats = list(self._stats.items())
+            if reset:
+                self._stats.clear()
+
+        rows = []
+        for (command, path, kind), (count, total, max_time) in stats:
+            rows.append({
+                'command': command,
+                'path': path,
+                'kind': kind,
+                'count': count,
+                'total': total,
+                'mean': total / count,
+                'max': max_time,
+            })
+        rows.sort(key=lambda row: row[sort], reverse=True)
+        return rows
+
+
+def format_report(rows: list) -> str:
+    """Format the rows of `ComProfiler.report` as a text table."""
+    lines = ['%-28s %-40s %-4s %8s %10s %10s %10s' % ('command', 'path', 'kind', 'count', 'total ms', 'mean ms', 'max ms')]
+    for row in rows:
+        lines.append('%-28s %-40s %-4s %8d %10.3f %10.3f %10.3f' % (
+            row['command'], row['path'], row['kind'], row['count'],
+            row['total'] * 1e3, row['mean'] * 1e3, row['max'] * 1e3))
+    return '\n'.join(lines)
+
+
+class ComProxy:
+    """Wraps the COM object `obj` and reports the time of every access to
+    `profiler`. COM objects obtained through the proxy are wrapped as
+    well, so a dispatch chain like `tem.Stage.Position.X` is recorded
+    step by step under its full `path`.
+
+    Proxies passed back to COM, as method arguments or values that are
+    set, are unwrapped first.
+    """
+
+    __slots__ = ('_obj', '_profiler', '_path')
+
+    def __init__(self, obj, profiler: ComProfiler, path: str = ''):
+        object.__setattr__(self, '_obj', obj)
+        object.__setattr__(self, '_profiler', profiler)
+        object.__setattr__(self, '_path', path)
+
+    def _child(self, name: str) -> str:
+        return self._path + '.' + name if self._path else name
+
+    def _wrap(self, path: str, value):
+        if isinstance(value, _VALUE_TYPES):
+            return value
+        return ComProxy(value, self._profiler, path)
+
+    def __getattr__(self, name: str):
+        path = self._child(name)
+        t0 = perf_counter()
+        try:
+            value = getattr(self._obj, name)
+        finally:
+            duration = perf_counter() - t0
+
+        if inspect.ismethod(value) or inspect.isfunction(value) or inspect.isbuiltin(value):
+            return self._method(path, value)
+
+        self._profiler.record(path, 'get', duration)
+        return self._wrap(path, value)
+
+    def _method(self, path: str, method):
+        profiler = self._profiler
+
+        def call(*args, **kwargs):
+            args = [unwrap(arg) for arg in args]
+            kwargs = {key: unwrap(value) for key, value in kwargs.items()}
+            t0 = perf_counter()
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                profiler.record(path, 'call', perf_counter() - t0)
+            return self._wrap(path + '()', result)
+
+        call.__name__ = method.__name__
+        return call
+
+    def __setattr__(self, name: str, value) -> None:
+        t0 = perf_counter()
+        try:
+            setattr(self._obj, name, unwrap(value))
+        finally:
+            self._profiler.record(self._child(name), 'set', perf_counter() - t0)
+
+    def __repr__(self):
+        return '<ComProxy %s of %r>' % (self._path or '(root)', self._obj)
@@ -0,0 +1,70 @@
+import time
+
+from utils.exceptions import TEMCommunicationError
+
+# first and largest interval in s between two polls of a completion condition
+POLL_INTERVAL = (0.005, 0.05)
+TIMEOUT = 60.0
+
+
+class Completion:
+    """Waits for microscope operations to complete.
+
+    Instead of sleeping for a fixed time, the completion condition of an
+    operation is polled, starting at a short interval that doubles up to
+    a maximum. `settings` is the `completion` section of the microscope
+    config, with the poll `interval` (first, largest) and per operation
+    a `timeout` and a `min_wait`. The minimum wait stands in for the
+    completion condition where the instrument gives no signal:
+
+        completion:
+          interval: [0.005, 0.05]
+          setNeutral: {min_wait: 4.0}
+          waitForStage: {timeout: 120}
+
+    The timeout of a slower run of an operation, e.g. a stage move at
+    reduced speed, can be scaled with `scale`.
+
+    The duration of the last run of every operation is kept in `durations`.
+    """
+
+    def __init__(self, settings: dict = None):
+        settings = dict(settings or {})
+        self.interval = tuple(settings.pop('interval', POLL_INTERVAL))
+        self.operations = settings
+        self.durations = {}
+
+    def wait(self, operation: str, condition=None, t0: float = None, max_interval: float = None,
+             scale: float = 1.0) -> float:
+        """Wait for `operation` to complete, return its duration in s.
+
+        Waits at least the `min_wait` of the operation, and then until
+        `condition()` is true, or raises `TEMCommunicationError` after
+        its `timeout` times `scale`. `t0` is the time.perf_counter() at
+        the start of the operation, by default now.
+        """
+        settings = self.operations.get(operation) or {}
+        timeout = settings.get('timeout', TIMEOUT) * scale
+        min_wait = settings.get('min_wait', 0.0)
+        if t0 is None:
+            t0 = time.perf_counter()
+
+        remaining = t0 + min_wait - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+
+        if condition is not None:
+            delay, max_delay = self.interval
+            if max_interval is not None:
+                max_delay = max_interval
+                delay = min(delay, max_delay)
+            while not condition():
+                if time.perf_counter() - t0 > timeout:
+                    raise TEMCommunicationError('%s did not complete within %s s' % (operation, timeout))
+                if delay > 0:
+                    time.sleep(delay)
+                delay = min(delay * 2, max_delay)
+
+        duration = time.perf_counter() - t0
+        self.durations[operation] = duration
+        return duration
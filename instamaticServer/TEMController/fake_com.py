@@ -0,0 +1,167 @@
+"""Model of the Tecnai COM scripting interface (`TEMScripting.Instrument`),
+to run `TecnaiMicroscope` without a microscope or comtypes, e.g. in the
+tests and in `soak.py --microscope fake-tecnai`.
+
+Only the objects and properties used by `TecnaiMicroscope` are modelled.
+Like the COM objects, vector and stage position properties return a copy
+that takes effect when it is assigned back (or passed to `GoTo`), and
+the stage reports `stMoving` for the time a move takes.
+"""
+import time
+from math import pi
+
+# time (s) of a stage move at full speed: a fixed part, plus the travel
+# at these speeds (m/s, rad/s)
+STAGE_SETTLE = 0.01
+STAGE_SPEED_XYZ = 1e-4
+STAGE_SPEED_AB = 10 / 180 * pi
+
+
+class Constants:
+    """The enum constants of the scripting interface."""
+
+    ProjectionMode = {'pmImaging': 1, 'pmDiffraction': 2}
+    ProjectionNormalization = {'pnmAll': 12}
+    IlluminationNormalization = {'nmAll': 7}
+    ScreenPosition = {'spUnknown': 1, 'spUp': 2, 'spDown': 3}
+    StageAxes = {'axisX': 1, 'axisY': 2, 'axisXY': 3, 'axisZ': 4, 'axisA': 8, 'axisB': 16}
+    StageHolderType = {'hoNone': 0, 'hoSingleTilt': 1, 'hoDoubleTilt': 2}
+    StageStatus = {'stReady': 0, 'stDisabled': 1, 'stNotReady': 2, 'stGoing': 3, 'stMoving': 4}
+
+
+class Vector:
+    def __init__(self, x: float = 0.0, y: float = 0.0):
+        self.X = x
+        self.Y = y
+
+    def copy(self) -> 'Vector':
+        return Vector(self.X, self.Y)
+
+
+class StagePosition:
+    AXES = ('X', 'Y', 'Z', 'A', 'B')
+
+    def __init__(self, x: float = 0.0, y: float = 0.0, z: float = 0.0, a: float = 0.0, b: float = 0.0):
+        self.X = x
+        self.Y = y
+        self.Z = z
+        self.A = a
+        self.B = b
+
+    def copy(self) -> 'StagePosition':
+        return StagePosition(self.X, self.Y, self.Z, self.A, self.B)
+
+
+class _Vectors:
+    """Base of the COM objects with vector properties, held in `_vectors`
+    and returned as copies."""
+
+    def __getattr__(self, name: str):
+        vectors = self.__dict__.get('_vectors', {})
+        if name in vectors:
+            return vectors[name].copy()
+        raise AttributeError(name)
+
+    def __setattr__(self, name: str, value) -> None:
+        vectors = self.__dict__.get('_vectors', {})
+        if name in vectors:
+            vectors[name] = value.copy()
+        else:
+            super().__setattr__(name, value)
+
+
+class Gun(_Vectors):
+    def __init__(self):
+        self._vectors = {'Shift': Vector(), 'Tilt': Vector()}
+        self.HTValue = 200000.0
+
+
+class Illumination(_Vectors):
+    def __init__(self):
+        self._vectors = {'Shift': Vector(), 'Tilt': Vector(), 'RotationCenter': Vector(),
+                         'CondenserStigmator': Vector()}
+        self.Intensity = 0.5
+        self.SpotsizeIndex = 3
+        self.BeamBlanked = False
+
+    def Normalize(self, mode: int) -> None:
+        pass
+
+
+class Projection(_Vectors):
+    """Projection system, `ranges` are the numbers of magnifications in
+    the LM, Mi, SA and Mh ranges, which give the `SubMode`."""
+
+    def __init__(self, ranges: tuple = (16, 3, 14, 6)):
+        self._vectors = {'ImageShift': Vector(), 'ImageBeamShift': Vector(), 'DiffractionShift': Vector(),
+                         'ObjectiveStigmator': Vector(), 'DiffractionStigmator': Vector()}
+        self._ranges = ranges
+        self.Mode = Constants.ProjectionMode['pmImaging']
+        self.MagnificationIndex = ranges[0] + ranges[1] + 1
+        self.CameraLengthIndex = 1
+        self.Defocus = 0.0
+
+    @property
+    def SubMode(self) -> int:
+        """1-4: lowmag, mag1, samag, mag2, 6: diff (LAD is not modelled)."""
+        if self.Mode == Constants.ProjectionMode['pmDiffraction']:
+            return 6
+        n = 0
+        for submode, size in enumerate(self._ranges, 1):
+            n += size
+            if self.MagnificationIndex <= n:
+                return submode
+        return len(self._ranges)
+
+    def Normalize(self, mode: int) -> None:
+        pass
+
+
+class Stage:
+    def __init__(self):
+        self._position = StagePosition()
+        self._t_ready = 0.0
+        self.Holder = Constants.StageHolderType['hoDoubleTilt']
+
+    @property
+    def Position(self) -> StagePosition:
+        return self._position.copy()
+
+    @property
+    def Status(self) -> int:
+        if time.perf_counter() < self._t_ready:
+            return Constants.StageStatus['stMoving']
+        return Constants.StageStatus['stReady']
+
+    def GoTo(self, pos: StagePosition, axis: int) -> None:
+        self.GoToWithSpeed(pos, axis, 1.0)
+
+    def GoToWithSpeed(self, pos: StagePosition, axis: int, speed: float) -> None:
+        duration = 0.0
+        for i, name in enumerate(StagePosition.AXES):
+            if axis & (1 << i):
+                distance = abs(getattr(pos, name) - getattr(self._position, name))
+                duration = max(duration, distance / (STAGE_SPEED_XYZ if i < 3 else STAGE_SPEED_AB))
+                setattr(self._position, name, getattr(pos, name))
+        self._t_ready = time.perf_counter() + STAGE_SETTLE + duration / speed
+
+
+class Camera:
+    def __init__(self):
+        self.MainScreen = Constants.ScreenPosition['spUp']
+        self.IsSmallScreenDown = False
+        self.ScreenCurrent = 1e-9
+
+
+class Instrument:
+    """The `TEMScripting.Instrument` object, `constants` holds the enums
+    that comtypes reads from the type library."""
+
+    constants = Constants()
+
+    def __init__(self, ranges: tuple = (16, 3, 14, 6)):
+        self.GUN = self.Gun = Gun()
+        self.Illumination = Illumination()
+        self.Projection = Projection(ranges)
+        self.Stage = Stage()
+        self.Camera = Camera()
@@ -1,9 +1,12 @@
 from utils.config import config
 
 _conf = config()
-_tem_interfaces = ('simulate', 'tecnai')
+_tem_interfaces = ('simulate', 'tecnai', 'fake-tecnai')
 
-__all__ = ['get_microscope', 'get_microscope_class']
+# interfaces without a config of their own: the config they use
+_CONFIGS = {'fake-tecnai': 'tecnai'}
+
+__all__ = ['get_interface', 'get_microscope', 'get_microscope_class', 'get_static_data']
 
 
 def get_microscope_class(interface: str):
@@ -13,6 +16,8 @@ def get_microscope_class(interface: str):
         from .simu_microscope import SimuMicroscope as cls
     elif interface == 'tecnai':
         from .tecnai_microscope import TecnaiMicroscope as cls
+    elif interface == 'fake-tecnai':
+        from .tecnai_microscope import FakeTecnaiMicroscope as cls
     else:
         raise ValueError("No such microscope interface: %s" % (interface))
 
@@ -23,19 +28,46 @@ def get_microscope(name: str = None):
     """Generic class to load microscope interface class.
 
     name: str
-        Specify which microscope to use, must be one of `tecnai`, `simulate`
+        Specify which microscope to use, either one of `tecnai`, `simulate`,
+        `fake-tecnai` (the tecnai config on the COM model of `fake_com`)
+        or the name of a microscope config in `utils`
     use_server: bool
         Connect to microscope server running on the host/port defined in the config file
 
     returns: TEM interface class
     """
+    interface, name = _resolve(name)
+
+    cls = get_microscope_class(interface=interface)
+    tem = cls(name=name)
+
+    return tem
+
+
+def _resolve(name: str = None):
+    """Return the interface and the config name of microscope `name`."""
     if name in _tem_interfaces:
         interface = name
-    else:
+        name = _CONFIGS.get(name, name)
+    elif name is None:
         interface = _conf.micr_interface
         name = _conf.default_settings['microscope']
+    else:
+        interface = config(name).micr_interface
+    return interface, name
 
-    cls = get_microscope_class(interface=interface)
-    tem = cls(name=name)
 
-    return tem
+def get_interface(name: str = None) -> str:
+    """Return the interface of microscope `name`."""
+    return _resolve(name)[0]
+
+
+def get_static_data(name: str = None) -> dict:
+    """Return the results of the commands of microscope `name` that only
+    depend on its config, so they can be answered before the connection
+    to the microscope is established."""
+    interface, name = _resolve(name)
+    cls = get_microscope_class(interface=interface)
+    return {
+        'getMagnificationRanges': cls._magnificationRanges(config(name).micr_ranges),
+    }
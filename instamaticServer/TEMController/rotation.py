@@ -0,0 +1,198 @@
+import time
+from pathlib import Path
+
+import yaml
+
+from utils.exceptions import TEMValueError
+
+# the calibration tables are stored next to the microscope configs
+CALIBRATION_DIRECTORY = Path(__file__).resolve().parent.parent.joinpath('utils')
+
+# part of the travel used for the fit of the angle against time, the
+# start and the end are left out because the stage accelerates there
+FIT_RANGE = (0.1, 0.9)
+
+# deg from the target angle at which a rotation counts as arrived, or
+# else the s the angle has to stay the same after the stage moved
+ARRIVAL_TOLERANCE = 0.05
+SETTLE_TIME = 2.0
+
+
+def fit_line(t: list, y: list):
+    """Least-squares fit of y = slope * t + intercept, returns (slope,
+    intercept, r) with r the correlation coefficient."""
+    n = len(t)
+    mt = sum(t) / n
+    my = sum(y) / n
+    stt = sum((ti - mt) ** 2 for ti in t)
+    syy = sum((yi - my) ** 2 for yi in y)
+    sty = sum((ti - mt) * (yi - my) for ti, yi in zip(t, y))
+    if stt == 0:
+        raise ValueError('Cannot fit a line to samples taken at the same time.')
+    slope = sty / stt
+    r = sty / (stt * syy) ** 0.5 if syy else 0.0
+    return slope, my - slope * mt, r
+
+
+def _interpolate(x: float, xs: list, ys: list) -> float:
+    """Linear interpolation of `ys` at `x`, clamped at the ends."""
+    if x <= xs[0]:
+        return ys[0]
+    if x >= xs[-1]:
+        return ys[-1]
+    for i in range(1, len(xs)):
+        if x <= xs[i]:
+            f = (x - xs[i - 1]) / (xs[i] - xs[i - 1])
+            return ys[i - 1] + f * (ys[i] - ys[i - 1])
+
+
+class RotationMixin:
+    """Calibration of the alpha rotation speed for the microscope classes.
+
+    `calibrateRotationSpeed` runs timed rotations at a set of rotation
+    speed settings and fits the angle against time, giving the actual
+    speed in deg/s and the overhead of a move (start-up and settling).
+    The table is stored in `utils/<microscope>_rotation.yaml` and used
+    by `getRotationSpeedDegrees` and `getRotationDuration`.
+
+    Classes using it implement `_rotateTo(angle, speed)`, which starts a
+    rotation of alpha at speed setting `speed` without waiting, list the
+    default settings in `ROTATION_SPEEDS` and use `SequenceMixin`.
+    """
+
+    ROTATION_SPEEDS = ()
+
+    _rotation_table = None
+
+    def _calibrationFile(self) -> Path:
+        name = self.name or self._conf.default_settings['microscope']
+        return CALIBRATION_DIRECTORY.joinpath('%s_rotation.yaml' % (name))
+
+    def _rotationTable(self) -> list:
+        if self._rotation_table is None:
+            path = self._calibrationFile()
+            table = []
+            if path.exists():
+                with open(str(path), 'r') as stream:
+                    table = (yaml.safe_load(stream) or {}).get('rotation_speeds') or []
+            self._rotation_table = sorted(table, key=lambda row: row['speed'])
+        return self._rotation_table
+
+    def _sampleRotation(self, target: float, speed, interval: float, timeout: float, cancel):
+        """Rotate alpha to `target` at `speed` and sample the angle every
+        `interval` s until it arrives, returns the start angle and the
+        lists of times and angles, or None if cancelled."""
+        start = self.getStagePosition()[3]
+        t0 = time.perf_counter()
+        self._rotateTo(target, speed)
+
+        times, angles = [], []
+        t_change = 0.0
+        while True:
+            a = self.getStagePosition()[3]
+            t = time.perf_counter() - t0
+            if angles and a != angles[-1]:
+                t_change = t
+            times.append(t)
+            angles.append(a)
+            if abs(a - target) <= ARRIVAL_TOLERANCE:
+                break
+            if a != start and t - t_change > SETTLE_TIME:
+                break  # stopped short of the target
+            if t > timeout:
+                raise TEMValueError('Rotation to %s deg at speed %s did not arrive within %s s' % (target, speed, timeout))
+            if cancel.wait(interval):
+                return None
+        return start, times, angles
+
+    def _timedRotation(self, target: float, speed, interval: float, timeout: float, cancel) -> dict:
+        """Rotate alpha to `target` at `speed`, returns the fitted
+        calibration row, or None if cancelled."""
+        sampled = self._sampleRotation(target, speed, interval, timeout, cancel)
+        if sampled is None:
+            return None
+        start, times, angles = sampled
+
+        span = abs(angles[-1] - start)
+        lo, hi = FIT_RANGE
+        sel = [i for i, a in enumerate(angles) if lo * span <= abs(a - start) <= hi * span]
+        if len(sel) < 3:
+            # fast moves, use every sample taken while the stage moved
+            sel = [i for i, a in enumerate(angles) if 0 < abs(a - start) < span] or list(range(len(angles)))
+        if len(sel) < 2:
+            raise TEMValueError('Too few samples to fit the rotation at speed %s, lower the interval.' % (speed))
+
+        slope, intercept, r = fit_line([times[i] for i in sel], [angles[i] for i in sel])
+        deg_per_s = abs(slope)
+        return {
+            'speed': speed,
+            'deg_per_s': deg_per_s,
+            'overhead': max(0.0, times[-1] - span / deg_per_s) if deg_per_s else None,
+            'r': abs(r),
+            'samples': len(sel),
+        }
+
+    def calibrateRotationSpeed(self,
+                               speeds: list = None,
+                               start: float = -20.0,
+                               stop: float = 20.0,
+                               interval: float = 0.05,
+                               timeout: float = 600.0,
+                               save: bool = True) -> list:
+        """Measure the alpha rotation speed in deg/s at the speed settings
+        `speeds` (default `ROTATION_SPEEDS`) by rotating between `start` and
+        `stop` (deg), sampling the angle every `interval` s. The table is
+        returned and stored with the microscope config if `save` is set.
+        The rotation speed setting is restored afterwards, and the
+        calibration stops early, without saving, on `__cancel__`."""
+        speeds = list(speeds or self.ROTATION_SPEEDS)
+        if not speeds:
+            raise TEMValueError('No rotation speeds to calibrate.')
+        cancel = self._start_sequence()
+        previous = self.getRotationSpeed()
+
+        table = []
+        try:
+            # go to the start at the fastest setting, then rotate back and forth
+            if self._sampleRotation(start, max(speeds), interval, timeout, cancel) is not None:
+                target = stop
+                for speed in speeds:
+                    row = self._timedRotation(target, speed, interval, timeout, cancel)
+                    if row is None:
+                        break
+                    table.append(row)
+                    target = start if target == stop else stop
+        finally:
+            self.setRotationSpeed(previous)
+
+        table.sort(key=lambda row: row['speed'])
+        if save and not cancel.is_set():
+            with open(str(self._calibrationFile()), 'w') as stream:
+                yaml.safe_dump({'rotation_speeds': table}, stream, default_flow_style=False)
+            self._rotation_table = table
+        return table
+
+    def getRotationSpeedTable(self) -> list:
+        """Return the rotation speed calibration, rows of speed setting,
+        deg_per_s and move overhead in s."""
+        return list(self._rotationTable())
+
+    def getRotationSpeedDegrees(self, speed=None) -> float:
+        """Return the calibrated rotation speed in deg/s at speed setting
+        `speed`, by default the current one."""
+        table = self._rotationTable()
+        if not table:
+            raise TEMValueError('The rotation speed is not calibrated, run `calibrateRotationSpeed`.')
+        if speed is None:
+            speed = self.getRotationSpeed()
+        return _interpolate(speed, [row['speed'] for row in table], [row['deg_per_s'] for row in table])
+
+    def getRotationDuration(self, angle: float, speed=None) -> float:
+        """Return the predicted time in s to rotate by `angle` deg at speed
+        setting `speed`, by default the current one."""
+        table = self._rotationTable()
+        deg_per_s = self.getRotationSpeedDegrees(speed)
+        if speed is None:
+            speed = self.getRotationSpeed()
+        overhead = _interpolate(speed, [row['speed'] for row in table], [row['overhead'] or 0.0 for row in table])
+        return overhead + abs(angle) / deg_per_s
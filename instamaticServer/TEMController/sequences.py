@@ -0,0 +1,220 @@
+import threading
+import time
+from math import atan2, floor
+
+from utils.exceptions import TEMValueError
+
+# deflectors that can be scanned, name: (getter, setter)
+DEFLECTORS = {
+    'BeamShift': ('getBeamShift', 'setBeamShift'),
+    'ImageShift1': ('getImageShift1', 'setImageShift1'),
+    'DiffShift': ('getDiffShift', 'setDiffShift'),
+}
+
+SCAN_ORDERS = ('raster', 'serpentine', 'spiral')
+
+# remaining time (s) before a deadline that is busy-waited instead of slept,
+# `time.sleep` is only accurate to a few ms (~15 ms on Windows XP)
+SPIN_TIME = 0.002
+
+
+def linspace(start: float, stop: float, num: int) -> list:
+    """Return `num` evenly spaced values from `start` to `stop`."""
+    num = int(num)
+    if num == 1:
+        return [start]
+    step = (stop - start) / (num - 1)
+    return [start + i * step for i in range(num)]
+
+
+def arange(start: float, stop: float, step: float) -> list:
+    """Return the values from `start` to `stop` (inclusive) in steps of `step`."""
+    if step == 0 or (stop - start) * step < 0:
+        raise ValueError('Cannot step from %s to %s in steps of %s' % (start, stop, step))
+    num = int(floor((stop - start) / step + 1e-9)) + 1
+    return [start + i * step for i in range(num)]
+
+
+def grid_points(x: list, y: list, order: str = 'serpentine') -> list:
+    """Return the (x, y) points of the grid spanned by the values `x` and
+    `y` in the given `order`.
+
+    raster: row by row, every row from left to right
+    serpentine: row by row, alternating direction
+    spiral: from the center outward, ring by ring
+    """
+    if order not in SCAN_ORDERS:
+        raise ValueError('No such scan order: %s, must be one of %s' % (order, SCAN_ORDERS))
+
+    if order == 'spiral':
+        ci = (len(x) - 1) / 2
+        cj = (len(y) - 1) / 2
+        ij = [(i, j) for j in range(len(y)) for i in range(len(x))]
+        ij.sort(key=lambda p: (max(abs(p[0] - ci), abs(p[1] - cj)),
+                               atan2(p[1] - cj, p[0] - ci)))
+        return [(x[i], y[j]) for i, j in ij]
+
+    points = []
+    for j, yj in enumerate(y):
+        row = x if (order == 'raster' or j % 2 == 0) else x[::-1]
+        points.extend((xi, yj) for xi in row)
+    return points
+
+
+class SequenceMixin:
+    """Multi-step sequences that run on the server against the public
+    get/set methods of the microscope classes.
+
+    Sequences clear `cancel_event` when they start and stop early once it
+    is set, which the server does for the `__cancel__` command. Classes
+    using `sweepFocus` implement `_getDefocus` and `_setDefocus`, which
+    access the focus without checking the function mode, in the units of
+    `getFocus` or, with `diffraction`, of `getDiffFocus`. Where these
+    units are coarser than the lens value, `_saveDefocus` and
+    `_restoreDefocus` are overridden to restore it exactly.
+    """
+
+    cancel_event = None
+
+    def _start_sequence(self) -> threading.Event:
+        if self.cancel_event is None:
+            self.cancel_event = threading.Event()
+        self.cancel_event.clear()
+        return self.cancel_event
+
+    def _sleep_until(self, deadline: float) -> bool:
+        """Wait until `time.perf_counter()` reaches `deadline`, return
+        False if the sequence was cancelled in the meantime."""
+        event = self.cancel_event
+        remaining = deadline - time.perf_counter()
+        if remaining > SPIN_TIME:
+            if event.wait(remaining - SPIN_TIME):
+                return False
+        while time.perf_counter() < deadline:
+            pass
+        return not event.is_set()
+
+    def _saveDefocus(self, diffraction: bool):
+        return self._getDefocus(diffraction)
+
+    def _restoreDefocus(self, saved, diffraction: bool) -> None:
+        self._setDefocus(saved, diffraction)
+
+    def _checkFocusMode(self, diffraction: bool) -> None:
+        mode = self.getFunctionMode()
+        if diffraction and mode != 'diff':
+            raise TEMValueError("Must be in 'diff' mode to sweep DiffFocus")
+        if not diffraction and mode in ('diff', 'LAD'):
+            raise TEMValueError("Must be in 'mag' mode to sweep Focus")
+
+    def rasterScan(self,
+                   deflector: str = 'BeamShift',
+                   points: list = None,
+                   x: list = None,
+                   y: list = None,
+                   dwell: float = 0.1,
+                   order: str = 'serpentine',
+                   return_to_start: bool = True) -> dict:
+        """Scan a deflector over a list or grid of positions with a fixed dwell time.
+
+        deflector: one of `BeamShift`, `ImageShift1`, `DiffShift`
+        points: list of (x, y) positions, visited in the given order
+        x, y: (start, stop, num) of the grid to scan instead of `points`
+        dwell: time (s) between the start of consecutive positions
+        order: `raster`, `serpentine` or `spiral` order of the grid
+        return_to_start: restore the deflector after the scan
+
+        Returns a dict with the wall clock time `t0` at the start of the
+        scan, the `points` that were set, the `times` (s, from `t0`) at
+        which each was set, and whether the scan was `cancelled`.
+        """
+        try:
+            getter, setter = DEFLECTORS[deflector]
+        except KeyError:
+            raise ValueError('No such deflector: %s, must be one of %s' % (deflector, tuple(DEFLECTORS)))
+
+        if points is None:
+            if x is None or y is None:
+                raise ValueError('Either `points` or the grid `x` and `y` must be given.')
+            points = grid_points(linspace(*x), linspace(*y), order=order)
+
+        getter = getattr(self, getter)
+        setter = getattr(self, setter)
+        start = getter()
+
+        self._start_sequence()
+        done = []
+        times = []
+        cancelled = False
+
+        t0 = time.time()
+        t_start = time.perf_counter()
+        try:
+            for i, (px, py) in enumerate(points):
+                if not self._sleep_until(t_start + i * dwell):
+                    cancelled = True
+                    break
+                setter(px, py)
+                times.append(time.perf_counter() - t_start)
+                done.append((px, py))
+            else:
+                cancelled = not self._sleep_until(t_start + len(points) * dwell)
+        finally:
+            if return_to_start:
+                setter(*start)
+
+        return {
+            't0': t0,
+            'points': done,
+            'times': times,
+            'cancelled': cancelled,
+        }
+
+    def sweepFocus(self,
+                   start: float,
+                   stop: float,
+                   step: float,
+                   settle: float = 0.1,
+                   diffraction: bool = False,
+                   return_to_start: bool = True) -> dict:
+        """Sweep the defocus from `start` to `stop` (inclusive) in steps of `step`.
+
+        The values are in the units of `getFocus`, or of `getDiffFocus`
+        if `diffraction` is set (0 to 65536 on the Tecnai). The function mode is checked once
+        before the sweep. After each value is set, the sweep waits
+        `settle` seconds.
+
+        Returns a dict with the wall clock time `t0` at the start of the
+        sweep, the `values` that were set, the `times` (s, from `t0`) at
+        which each took effect, and whether the sweep was `cancelled`.
+        """
+        values = arange(start, stop, step)
+        self._checkFocusMode(diffraction)
+        initial = self._saveDefocus(diffraction)
+
+        self._start_sequence()
+        done = []
+        times = []
+        cancelled = False
+
+        t0 = time.time()
+        t_start = time.perf_counter()
+        try:
+            for value in values:
+                self._setDefocus(value, diffraction)
+                t = time.perf_counter()
+                times.append(t - t_start)
+                done.append(value)
+                if not self._sleep_until(t + settle):
+                    cancelled = True
+                    break
+        finally:
+            if return_to_start:
+                self._restoreDefocus(initial, diffraction)
+
+        return {
+            't0': t0,
+            'values': done,
+            'times': times,
+            'cancelled': cancelled,
+        }
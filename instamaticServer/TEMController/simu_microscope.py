@@ -2,6 +2,11 @@ import random
 import time
 from typing import Optional, Tuple, Union
 
+from .sequences import SequenceMixin
+from .rotation import RotationMixin
+from .stage_tour import StageTourMixin
+from .simu_profile import LatencyProfile
+from .completion import Completion
 from .typing import StagePositionTuple, float_deg, int_nm
 from utils.exceptions import TEMValueError
 from utils.config import config
@@ -32,17 +37,20 @@ MAX = 65535
 MIN = 0
 
 
-class SimuMicroscope:
+class SimuMicroscope(SequenceMixin, RotationMixin, StageTourMixin):
     """Simulates a microscope connection.
 
     Has the same variables as the real JEOL/FEI equivalents, but does
     not make any function calls. The initial lens/deflector/stage values
-    are randomized based on the config file loaded.
+    are randomized based on the config file loaded. Latency, stalls and
+    errors of the real instrument can be injected through the
+    `simulation` section of the config, see `LatencyProfile`.
     """
 
     def __init__(self, name: str = None):
 
         self.CurrentDensity_value = 100000.0
+        self.ScreenCurrent_value = 1.0  # nA
 
         self.Brightness_value = random.randint(MIN, MAX)
 
@@ -68,6 +76,7 @@ class SimuMicroscope:
         self.FunctionMode_value = 0
 
         self.DiffractionFocus_value = random.randint(MIN, MAX)
+        self.Focus_value = random.randint(MIN, MAX)
         self.IntermediateLens1_value = random.randint(MIN, MAX)
 
         self.DiffractionShift_x = random.randint(MIN, MAX)
@@ -110,6 +119,11 @@ class SimuMicroscope:
         self.spotsize = 1
 
         self.screenposition_value = 'up'
+        # time a screen move takes, the screen is in between ('') meanwhile
+        self._screen_time = self._conf.micr_simulation.get('screen_time', 0.0)
+        self._screen_t_end = 0.0
+
+        self._completion = Completion(self._conf.micr_settings.get('completion'))
 
         self.condensorlens1_value = random.randint(MIN, MAX)
         self.condensorlens2_value = random.randint(MIN, MAX)
@@ -160,6 +174,9 @@ class SimuMicroscope:
                 self.goniotool_available = False
                 #config.settings.use_goniotool = False
 
+        self._profile = LatencyProfile(self._conf.micr_simulation)
+        self._profile.apply(self)
+
     def is_goniotool_available(self):
         """Return goniotool status."""
         return self.goniotool_available
@@ -255,6 +272,12 @@ class SimuMicroscope:
         rand_val = (random.random() - 0.5) * 10000
         return self.CurrentDensity_value + rand_val
 
+    def getScreenCurrent(self) -> float:
+        """get the Screen current in nA."""
+        if self.beamblank:
+            return 0.0
+        return self.ScreenCurrent_value * (1 + (random.random() - 0.5) * 0.01)
+
     def getBrightness(self) -> int:
         return self.Brightness_value
 
@@ -267,9 +290,9 @@ class SimuMicroscope:
         else:
             return self.Magnification_value
 
-    def setNeutral(self, *args):
+    def setNeutral(self, *args) -> float:
         """Neutralize given deflectors."""
-        pass
+        return self._completion.wait('setNeutral')
 
     def setMagnification(self, value: int):
         current_mode = self.getFunctionMode()
@@ -340,11 +363,15 @@ class SimuMicroscope:
 
 
     def getMagnificationRanges(self) -> dict:
+        return self._magnificationRanges(self._mic_ranges)
+
+    @staticmethod
+    def _magnificationRanges(ranges: dict) -> dict:
         mag_ranges = {}
-        for i, mode in enumerate(self.FUNCTION_MODES):
+        for i, mode in enumerate(FUNCTION_MODES):
             try:
-                mag_ranges[mode] = self._mic_ranges[mode]
-            except ValueError:
+                mag_ranges[mode] = ranges[mode]
+            except KeyError:
                 pass
 
         return mag_ranges
@@ -370,6 +397,11 @@ class SimuMicroscope:
         self.BeamShift_x = x
         self.BeamShift_y = y
 
+    def setBeamShiftRelative(self, dx: int = 0, dy: int = 0) -> Tuple[int, int]:
+        self.BeamShift_x += dx
+        self.BeamShift_y += dy
+        return self.BeamShift_x, self.BeamShift_y
+
     def getBeamTilt(self) -> Tuple[int, int]:
         return self.BeamTilt_x, self.BeamTilt_y
 
@@ -384,6 +416,11 @@ class SimuMicroscope:
         self.ImageShift1_x = x
         self.ImageShift1_y = y
 
+    def setImageShift1Relative(self, dx: int = 0, dy: int = 0) -> Tuple[int, int]:
+        self.ImageShift1_x += dx
+        self.ImageShift1_y += dy
+        return self.ImageShift1_x, self.ImageShift1_y
+
     def getImageShift2(self):
         return self.ImageShift2_x, self.ImageShift2_y
 
@@ -400,9 +437,11 @@ class SimuMicroscope:
         # print(res, self._is_moving)
         return self._is_moving
 
-    def waitForStage(self, delay: float = 0.1):
-        while self.isStageMoving():
-            time.sleep(delay)
+    def waitForStage(self, delay: float = None) -> float:
+        return self._completion.wait('waitForStage', lambda: not self.isStageMoving(), max_interval=delay)
+
+    def getCompletionTimes(self) -> dict:
+        return dict(self._completion.durations)
 
     def setStageX(self, value: int_nm, wait: bool = True) -> None:
         self.StagePosition_x = value
@@ -463,6 +502,28 @@ class SimuMicroscope:
             if y is not None:
                 self.setStageY(y, wait=wait)
 
+    def setStagePositionRelative(
+            self,
+            dx: int_nm = 0,
+            dy: int_nm = 0,
+            dz: int_nm = 0,
+            da: float_deg = 0,
+            db: float_deg = 0,
+            wait: bool = True,
+            speed: float = -1,
+    ) -> None:
+        """Move the stage by dx, dy, dz (nm) and da, db (deg) from its current position."""
+        x, y, z, a, b = self.getStagePosition()
+        self.setStagePosition(
+            x=x + dx if dx else None,
+            y=y + dy if dy else None,
+            z=z + dz if dz else None,
+            a=a + da if da else None,
+            b=b + db if db else None,
+            wait=wait,
+            speed=speed,
+        )
+
     def getRotationSpeed(self) -> int:
         return self._stage_dict['a']['speed_setting']
 
@@ -470,6 +531,10 @@ class SimuMicroscope:
         self._stage_dict['a']['speed_setting'] = value
         self._stage_dict['a']['speed'] = 10.0 * (value / 12)
 
+    def _rotateTo(self, angle: float, speed: int) -> None:
+        self.setRotationSpeed(speed)
+        self.StagePosition_a = angle
+
     def getFunctionMode(self) -> str:
         """Mag1, mag2, lowmag, samag, diff."""
         mode = self.FunctionMode_value
@@ -495,6 +560,27 @@ class SimuMicroscope:
             raise TEMValueError("Must be in 'diff' mode to set DiffFocus")
         self.DiffractionFocus_value = value
 
+    def getFocus(self) -> int:
+        if self.getFunctionMode() == 'diff':
+            raise TEMValueError("Must be in 'mag' mode to get Focus")
+        return self.Focus_value
+
+    def setFocus(self, value: int):
+        if self.getFunctionMode() == 'diff':
+            raise TEMValueError("Must be in 'mag' mode to set Focus")
+        self.Focus_value = value
+
+    def _getDefocus(self, diffraction: bool = False) -> int:
+        if diffraction:
+            return self.DiffractionFocus_value
+        return self.Focus_value
+
+    def _setDefocus(self, value: int, diffraction: bool = False):
+        if diffraction:
+            self.DiffractionFocus_value = value
+        else:
+            self.Focus_value = value
+
     def setIntermediateLens1(self, value: int):
         """IL1."""
         self.IntermediateLens1_value = value
@@ -510,6 +596,11 @@ class SimuMicroscope:
         self.DiffractionShift_x = x
         self.DiffractionShift_y = y
 
+    def setDiffShiftRelative(self, dx: int = 0, dy: int = 0) -> Tuple[int, int]:
+        self.DiffractionShift_x += dx
+        self.DiffractionShift_y += dy
+        return self.DiffractionShift_x, self.DiffractionShift_y
+
     def release_connection(self):
         print('Connection to microscope released')
 
@@ -545,14 +636,24 @@ class SimuMicroscope:
         """0-based indexing for GetSpotSize, add 1 for consistency."""
         return self.spotsize
 
+    def _getScreen(self) -> str:
+        if time.perf_counter() < self._screen_t_end:
+            return ''
+        return self.screenposition_value
+
     def getScreenPosition(self) -> str:
+        self._completion.wait('getScreenPosition', lambda: self._getScreen() != '')
         return self.screenposition_value
 
-    def setScreenPosition(self, value: int):
+    def setScreenPosition(self, value: int) -> float:
         """Value = 'up' or 'down'."""
         if value not in ('up', 'down'):
             raise TEMValueError("No such screen position: %s ." % (value))
+        t0 = time.perf_counter()
+        if value != self.screenposition_value:
+            self._screen_t_end = t0 + self._screen_time
         self.screenposition_value = value
+        return self._completion.wait('setScreenPosition', lambda: self._getScreen() == value, t0=t0)
 
     def setSpotSize(self, value: int):
         self.spotsize = value
@@ -0,0 +1,166 @@
+import functools
+import random
+import threading
+import time
+from fnmatch import fnmatchcase
+
+from utils.exceptions import exception_list
+
+
+_DISTRIBUTIONS = ('constant', 'uniform', 'normal', 'lognormal', 'exponential')
+
+
+class _Rule:
+    """One entry of the `simulation` section in the microscope config.
+
+    A rule applies to all methods whose name matches one of the glob
+    patterns in `methods` and defines the latency distribution, the
+    stall and the error injection for these methods.
+    """
+
+    def __init__(self, dct: dict):
+        methods = dct.get('methods', '*')
+        if isinstance(methods, str):
+            methods = [methods]
+        self.methods = list(methods)
+
+        latency = dct.get('latency', 0.0)
+        if not isinstance(latency, dict):
+            latency = {'distribution': 'constant', 'value': latency}
+        self.distribution = latency.get('distribution', 'constant')
+        if self.distribution not in _DISTRIBUTIONS:
+            raise ValueError("No such latency distribution: %s" % (self.distribution))
+        self.latency = latency
+
+        stall = dct.get('stall') or {}
+        self.stall_probability = float(stall.get('probability', 0.0))
+        self.stall_duration = stall.get('duration', 1.0)
+
+        error = dct.get('error') or {}
+        self.error_probability = float(error.get('probability', 0.0))
+        exception = error.get('exception', 'TEMCommunicationError')
+        if exception not in exception_list:
+            raise ValueError("No such exception: %s" % (exception))
+        self.exception = exception_list[exception]
+        self.message = error.get('message', 'Injected fault')
+
+    def matches(self, name: str) -> bool:
+        return any(fnmatchcase(name, pattern) for pattern in self.methods)
+
+    def sample(self, rng: random.Random) -> float:
+        """Draw a latency in seconds from the distribution of this rule."""
+        d = self.latency
+        dist = self.distribution
+        if dist == 'constant':
+            val = d.get('value', 0.0)
+        elif dist == 'uniform':
+            val = rng.uniform(d.get('min', 0.0), d.get('max', 0.0))
+        elif dist == 'normal':
+            val = rng.gauss(d.get('mean', 0.0), d.get('std', 0.0))
+        elif dist == 'lognormal':
+            # `median` is the median latency, `sigma` the spread of its log
+            val = d.get('median', 0.0) * rng.lognormvariate(0.0, d.get('sigma', 0.0))
+        elif dist == 'exponential':
+            mean = d.get('mean', 0.0)
+            val = rng.expovariate(1.0 / mean) if mean > 0 else 0.0
+        return max(0.0, min(val, d.get('max', val)))
+
+
+class LatencyProfile:
+    """Latency, stall and error injection for the simulated microscope.
+
+    Takes the `simulation` section of the microscope config, for example:
+
+        simulation:
+          enabled: true
+          seed: 42
+          rules:
+            - methods: ['getStagePosition', 'isStageMoving']
+              latency: {distribution: lognormal, median: 0.02, sigma: 0.4}
+            - methods: 'set*'
+              latency: {distribution: uniform, min: 0.01, max: 0.05}
+              stall: {probability: 0.001, duration: [1.0, 5.0]}
+              error: {probability: 0.0005, exception: TEMCommunicationError}
+            - methods: '*'
+              latency: 0.005
+
+    For every call, the first rule matching the method name is used.
+    Times are in seconds. Only the outermost call of a thread is
+    delayed, so methods calling other methods are not penalized twice.
+    """
+
+    def __init__(self, settings: dict = None):
+        settings = settings or {}
+
+        self.enabled = bool(settings.get('enabled', True)) and bool(settings.get('rules'))
+        self.rules = [_Rule(dct) for dct in settings.get('rules') or ()]
+        self._rng = random.Random(settings.get('seed'))
+        self._rng_lock = threading.Lock()
+        self._local = threading.local()
+        self._cache = {}
+
+    def rule_for(self, name: str):
+        """Return the first rule matching method `name`, or None."""
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+
+        rule = None
+        for candidate in self.rules:
+            if candidate.matches(name):
+                rule = candidate
+                break
+        self._cache[name] = rule
+        return rule
+
+    def inject(self, name: str) -> None:
+        """Sleep for the sampled latency of `name` and raise an injected
+        error if drawn."""
+        rule = self.rule_for(name)
+        if rule is None:
+            return
+
+        with self._rng_lock:
+            delay = rule.sample(self._rng)
+            if rule.stall_probability and self._rng.random() < rule.stall_probability:
+                duration = rule.stall_duration
+                if isinstance(duration, (list, tuple)):
+                    duration = self._rng.uniform(*duration)
+                delay += duration
+            fail = rule.error_probability and self._rng.random() < rule.error_probability
+
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            raise rule.exception('%s: %s' % (rule.message, name))
+
+    def wrap(self, name: str, func):
+        """Return `func` with the fault injection of method `name` applied."""
+        local = self._local
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(local, 'depth', 0):
+                return func(*args, **kwargs)
+            local.depth = 1
+            try:
+                self.inject(name)
+                return func(*args, **kwargs)
+            finally:
+                local.depth = 0
+
+        return wrapper
+
+    def apply(self, obj) -> None:
+        """Wrap all public methods of `obj` covered by a rule."""
+        if not self.enabled:
+            return
+
+        for name in dir(type(obj)):
+            if name.startswith('_'):
+                continue
+            func = getattr(obj, name)
+            if not callable(func) or self.rule_for(name) is None:
+                continue
+            setattr(obj, name, self.wrap(name, func))
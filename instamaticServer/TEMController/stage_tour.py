@@ -0,0 +1,261 @@
+import time
+
+from utils.exceptions import TEMValueError
+
+# stage axes of a target, in the order of `getStagePosition`
+AXES = ('x', 'y', 'z', 'a')
+
+# defaults of the `stage` section of the microscope config, speeds in nm/s and deg/s
+STAGE_MODEL = {
+    'speed': {'x': 50000.0, 'y': 50000.0, 'z': 10000.0, 'a': 10.0},
+    'groups': [['x', 'y', 'z', 'a']],
+    'overhead': 0.0,
+    'settle': 0.0,
+}
+
+# s the planning of a tour may take on the microscope thread, the time
+# left after the nearest neighbour tour is spent improving it with 2-opt
+PLAN_TIME = 2.0
+
+
+class StageModel:
+    """Predicts the duration of stage moves.
+
+    Every axis moves at its `speed` (nm/s, deg/s for a). The axes in one
+    of the `groups` move at the same time, the groups one after the
+    other, and every move takes an extra `overhead` (start-up) and
+    `settle` time in s. The `stage` section of the microscope config:
+
+        stage:
+          speed: {x: 1000000, y: 1000000, z: 100000, a: 20}
+          groups: [[z], [a], [x, y]]
+          overhead: 0.05
+          settle: 0.2
+    """
+
+    def __init__(self, speed: dict, groups: list = None, overhead: float = 0.0, settle: float = 0.0):
+        self.speed = dict(STAGE_MODEL['speed'], **(speed or {}))
+        self.groups = [[AXES.index(axis) for axis in group] for group in groups or STAGE_MODEL['groups']]
+        self.overhead = overhead
+        self.settle = settle
+
+    @classmethod
+    def from_settings(cls, settings: dict = None):
+        settings = dict(STAGE_MODEL, **(settings or {}))
+        return cls(settings['speed'], settings['groups'], settings['overhead'], settings['settle'])
+
+    def move_time(self, p: tuple, q: tuple) -> float:
+        """Return the time in s to move from position `p` to `q`."""
+        total = 0.0
+        for group in self.groups:
+            total += max(abs(q[i] - p[i]) / self.speed[AXES[i]] for i in group)
+        if total == 0.0:
+            return 0.0
+        return self.overhead + total + self.settle
+
+
+def _fill(target, current: tuple) -> tuple:
+    """Return the (x, y, z, a) of `target`, axes it leaves out stay at `current`."""
+    target = tuple(target)
+    if not 2 <= len(target) <= len(AXES):
+        raise TEMValueError('A stage target is (x, y[, z, a]), got: %r' % (target,))
+    return tuple(v if v is not None else c for v, c in zip(target + (None,) * len(AXES), current))
+
+
+def _pre_position(position: tuple, approach) -> tuple:
+    """Return the position the stage passes on its way to `position`
+    when it approaches by the move `approach` (dx, dy[, dz, da])."""
+    approach = tuple(approach) + (0,) * (len(AXES) - len(approach))
+    return tuple(p - d for p, d in zip(position, approach))
+
+
+def _check_deadline(deadline: float, n: int) -> None:
+    if deadline is not None and time.perf_counter() > deadline:
+        raise TEMValueError('Cannot plan a tour of %d stage targets within the planning time, '
+                            'increase `max_time` or visit them in the given order.' % (n))
+
+
+def nearest_neighbour(cost: list, n: int, deadline: float = None) -> list:
+    """Return the order of the `n` targets found by always moving to the
+    closest unvisited one, starting at node `n` (the current position).
+    Raises `TEMValueError` after `deadline` (time.perf_counter)."""
+    tour = []
+    left = set(range(n))
+    node = n
+    while left:
+        _check_deadline(deadline, n)
+        row = cost[node]
+        node = min(left, key=lambda j: row[j])
+        left.remove(node)
+        tour.append(node)
+    return tour
+
+
+def two_opt(tour: list, cost: list, start: int, deadline: float = None) -> list:
+    """Improve the open path `tour` from node `start` by reversing
+    segments while that shortens it, until `deadline` (time.perf_counter)."""
+    path = [start] + list(tour)
+    m = len(path)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, m - 1):
+            if deadline is not None and time.perf_counter() > deadline:
+                return path[1:]
+            a, b = path[i - 1], path[i]
+            cost_a, cost_b = cost[a], cost[b]
+            d_ab = cost_a[b]
+            for j in range(i + 1, m):
+                c = path[j]
+                delta = cost_a[c] - d_ab
+                if j + 1 < m:
+                    d = path[j + 1]
+                    delta += cost_b[d] - cost[c][d]
+                if delta < -1e-9:
+                    path[i:j + 1] = path[i:j + 1][::-1]
+                    b = path[i]
+                    cost_b = cost[b]
+                    d_ab = cost_a[b]
+                    improved = True
+    return path[1:]
+
+
+def plan_tour(model: StageModel, start: tuple, positions: list, max_time: float = PLAN_TIME) -> list:
+    """Return the order of `positions` (full (x, y, z, a) tuples) that
+    visits them from `start` in the least time: nearest neighbour,
+    improved by 2-opt, in at most `max_time` s. Raises `TEMValueError` if
+    there are too many positions to find even the first tour in time."""
+    deadline = time.perf_counter() + max_time
+    n = len(positions)
+    nodes = list(positions) + [start]
+    cost = []
+    for p in nodes:
+        _check_deadline(deadline, n)
+        cost.append([model.move_time(p, q) for q in nodes])
+    tour = nearest_neighbour(cost, n, deadline)
+    return two_opt(tour, cost, n, deadline)
+
+
+def schedule(model: StageModel, start: tuple, positions: list, approach=None) -> list:
+    """Return the predicted arrival times in s at `positions`, visited in
+    order from `start`."""
+    t = 0.0
+    current = start
+    arrival = []
+    for position in positions:
+        if approach:
+            pre = _pre_position(position, approach)
+            t += model.move_time(current, pre)
+            current = pre
+        t += model.move_time(current, position)
+        arrival.append(t)
+        current = position
+    return arrival
+
+
+class StageTourMixin:
+    """Planning and running of tours over many stage positions.
+
+    `planStageTour` orders a list of (x, y[, z, a]) targets to minimise
+    the predicted travel time of the `StageModel` of the microscope
+    config, and `visitStagePositions` moves the stage through them and
+    reports when it arrived at each.
+
+    With `approach` = (dx, dy[, dz, da]) every target is approached by
+    that final move, from target - approach, so the mechanical backlash
+    is the same at every target. The order is optimised for the direct
+    moves, the predicted times include the approach.
+
+    Classes using it use `SequenceMixin`.
+    """
+
+    _stage_model = None
+
+    def _stageModel(self) -> StageModel:
+        if self._stage_model is None:
+            self._stage_model = StageModel.from_settings(self._conf.micr_settings.get('stage'))
+        return self._stage_model
+
+    def _planTour(self, targets: list, approach=None, plan: bool = True, max_time: float = PLAN_TIME):
+        """Return the current position, the order of `targets`, their full
+        positions in that order and the predicted arrival times."""
+        if not targets:
+            raise TEMValueError('No stage targets to visit.')
+        model = self._stageModel()
+        start = tuple(self.getStagePosition()[:len(AXES)])
+        positions = [_fill(target, start) for target in targets]
+        order = plan_tour(model, start, positions, max_time) if plan else list(range(len(positions)))
+        positions = [positions[i] for i in order]
+        return start, order, positions, schedule(model, start, positions, approach)
+
+    def planStageTour(self, targets: list, approach: list = None, max_time: float = PLAN_TIME) -> dict:
+        """Plan the order in which to visit the stage `targets`, (x, y[, z,
+        a]) in nm and deg, from the current position.
+
+        approach: (dx, dy[, dz, da]), final move towards every target
+        max_time: s the planning may take at most
+
+        Returns a dict with the `order` (indices into `targets`), the
+        `targets` in that order, the predicted `arrival` times (s) at
+        each, the total `duration` and the `duration_given` of the
+        order the targets were given in.
+        """
+        model = self._stageModel()
+        start, order, positions, arrival = self._planTour(targets, approach, max_time=max_time)
+        given = schedule(model, start, [_fill(target, start) for target in targets], approach)
+        return {
+            'order': order,
+            'targets': [targets[i] for i in order],
+            'arrival': arrival,
+            'duration': arrival[-1],
+            'duration_given': given[-1],
+        }
+
+    def visitStagePositions(self,
+                            targets: list,
+                            approach: list = None,
+                            plan: bool = True,
+                            dwell: float = 0.0,
+                            max_time: float = PLAN_TIME) -> dict:
+        """Move the stage to every target, (x, y[, z, a]) in nm and deg.
+
+        approach: (dx, dy[, dz, da]), final move towards every target
+        plan: visit the targets in the order of `planStageTour`, or else as given
+        dwell: time (s) to stay at every target
+        max_time: s the planning may take at most
+
+        Returns a dict with the wall clock time `t0` at the start, the
+        `order` (indices into `targets`) and the `targets` visited, the
+        `predicted` and the measured `arrival` times (s, from `t0`) at
+        each, and whether the tour was `cancelled` (`__cancel__`).
+        """
+        start, order, positions, predicted = self._planTour(targets, approach, plan, max_time)
+        cancel = self._start_sequence()
+        arrival = []
+        visited = []
+
+        t0 = time.time()
+        t_start = time.perf_counter()
+        for i, position in zip(order, positions):
+            if cancel.is_set():
+                break
+            # only the axes of the target (and the approach) are moved
+            axes = [k for k, v in enumerate(targets[i]) if v is not None]
+            if approach:
+                axes = sorted(set(axes).union(k for k, d in enumerate(approach) if d))
+                pre = _pre_position(position, approach)
+                self.setStagePosition(wait=True, **{AXES[k]: pre[k] for k in axes})
+            self.setStagePosition(wait=True, **{AXES[k]: position[k] for k in axes})
+            arrival.append(time.perf_counter() - t_start)
+            visited.append(i)
+            if dwell and not self._sleep_until(time.perf_counter() + dwell):
+                break
+
+        return {
+            't0': t0,
+            'order': visited,
+            'targets': [targets[i] for i in visited],
+            'predicted': predicted[:len(visited)],
+            'arrival': arrival,
+            'cancelled': cancel.is_set(),
+        }
@@ -1,18 +1,31 @@
 import atexit
 import logging
 import time
-import comtypes.client
 from math import pi
+try:
+    import comtypes.client
+except ImportError:
+    comtypes = None  # only the model of `fake_com` can be used
 from typing import Optional
 
 from .typing import StagePositionTuple, float_deg, int_nm
 from utils.exceptions import FEIValueError, TEMCommunicationError
 from utils.config import config
-from TEMController.tecnai_stage_thread import TecnaiStageThread
+from TEMController import fake_com
+from TEMController.tecnai_stage_thread import TecnaiStageThread, get_constants
+from TEMController.sequences import SequenceMixin
+from TEMController.rotation import RotationMixin
+from TEMController.stage_tour import StageTourMixin
+from TEMController.com_profiler import ComProfiler, ComProxy, unwrap
+from TEMController.completion import Completion
 
 
 _FUNCTION_MODES = {1: 'lowmag', 2: 'mag1', 3: 'samag', 4: 'mag2', 5: 'LAD', 6: 'diff'}
 
+# polling of the HT at startup, the interval grows from the first to the last value
+HT_POLL_INTERVAL = (0.05, 1.0)
+HT_TIMEOUT = 30.0
+
 #diff=D, LAD=LAD, lowmag=LM, mag1=Mi, samag=SA, mag2=Mh in Functionmodes
 
 
@@ -34,33 +47,45 @@ class Singleton(type):
         return cls._instances[cls]
 
 
-class TecnaiMicroscope(metaclass=Singleton):
+class TecnaiMicroscope(SequenceMixin, RotationMixin, StageTourMixin, metaclass=Singleton):
     """Python bindings to the Tecnai-G2 microscope using the COM scripting interface."""
 
-    def __init__(self, name: str=None) -> None:
+    # speed settings of `GoToWithSpeed` measured by `calibrateRotationSpeed`
+    ROTATION_SPEEDS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
 
-        try:
-            comtypes.CoInitialize()
-        except:
-            raise
+    def __init__(self, name: str=None, instrument=None) -> None:
+        """`instrument` replaces the COM scripting interface, e.g. by the
+        model `fake_com.Instrument`."""
+
+        if instrument is None:
+            try:
+                comtypes.CoInitialize()
+            except:
+                raise
 
-        print('FEI Scripting initializing...')
-        ## TEM interfaces the GUN, stage etc
-        self._tem = comtypes.client.CreateObject('TEMScripting.Instrument', comtypes.CLSCTX_ALL)
+            print('FEI Scripting initializing...')
+            ## TEM interfaces the GUN, stage etc
+            self._tem = comtypes.client.CreateObject('TEMScripting.Instrument', comtypes.CLSCTX_ALL)
+        else:
+            self._tem = instrument
 
         ## TEM enum constants
-        self._tem_constant = comtypes.client.Constants(self._tem)
+        self._tem_constant = get_constants(self._tem)
 
         self._t = 0
+        t_start = time.perf_counter()
+        delay, max_delay = HT_POLL_INTERVAL
         while True:
             ht = self._tem.GUN.HTValue
             if ht > 0:
                 break
-            time.sleep(1)
-            self._t += 1
-            if self._t > 3:
-                print('Waiting for microscope, t = %ss' % (self._t))
-            if self._t > 30:
+            time.sleep(delay)
+            delay = min(delay * 1.5, max_delay)
+            t = int(time.perf_counter() - t_start)
+            if t > self._t and t > 3:
+                print('Waiting for microscope, t = %ss' % (t))
+            self._t = t
+            if self._t > HT_TIMEOUT:
                 raise TEMCommunicationError('Cannot establish microscope connection (timeout).')
 
         self._logger = logging.getLogger(__name__)
@@ -75,6 +100,15 @@ class TecnaiMicroscope(metaclass=Singleton):
         if self._conf.micr_interface == 'tecnai':
             self._mic_ranges = self._conf.micr_ranges
 
+        ## opt-in, times every COM access of the commands (see `com_profiler`)
+        self.com_profiler = None
+        if self._conf.default_settings.get('com_profiling'):
+            self.com_profiler = ComProfiler()
+            self._tem = ComProxy(self._tem, self.com_profiler)
+
+        ## completion detection of the stage, screen and normalization
+        self._completion = Completion(self._conf.micr_settings.get('completion'))
+
         self._rotation_speed = 1.0
         self._tecnaiStage = TecnaiStageThread() #Thread für a-Movement
         self._goniotool_available = False
@@ -138,7 +172,29 @@ class TecnaiMicroscope(metaclass=Singleton):
             speed: Optional[float] = None,
     ) -> None:
         """Set `Stageposition`'s x, y, z in m (from nm), alpha, beta in deg."""
+        self._moveStage(self._tem.Stage.Position, x, y, z, a, b, wait=wait, speed=speed)
+
+    def setStagePositionRelative(
+            self,
+            dx: int_nm = 0,
+            dy: int_nm = 0,
+            dz: int_nm = 0,
+            da: float_deg = 0,
+            db: float_deg = 0,
+            wait: bool = True,
+            speed: Optional[float] = None,
+    ) -> None:
+        """Move the stage by dx, dy, dz in nm and da, db in deg from its current position."""
         pos = self._tem.Stage.Position
+        x = pos.X * 1e9 + dx if dx else None
+        y = pos.Y * 1e9 + dy if dy else None
+        z = pos.Z * 1e9 + dz if dz else None
+        a = pos.A / pi * 180 + da if da else None
+        b = pos.B / pi * 180 + db if db else None
+        self._moveStage(pos, x, y, z, a, b, wait=wait, speed=speed)
+
+    def _moveStage(self, pos, x, y, z, a, b, wait: bool = True, speed: Optional[float] = None) -> None:
+        """Move the stage to x, y, z (nm), a, b (deg), `pos` is the current `Stage.Position`."""
         axis = 0
         enable_stage = False
         enable_B = False
@@ -183,13 +239,13 @@ class TecnaiMicroscope(metaclass=Singleton):
                     self._tem.Stage.GoToWithSpeed(pos, axis, speed)
                 else:
                    self._tem.Stage.GoTo(pos, axis)
-            self.waitForStage()
+            self._waitForStage(speed)
         else:
             if axis:
                 if self._tecnaiStage.is_alive():
                     raise RuntimeError('A `TecnaiStageThread` is already running!')
                 stagePos = (pos.X, pos.Y, pos.Z, pos.A, pos.B)
-                self._tecnaiStage = TecnaiStageThread(self._tem, stagePos, axis, speed)
+                self._tecnaiStage = TecnaiStageThread(unwrap(self._tem), stagePos, axis, speed)
                 self._tecnaiStage.daemon=True
                 self._tecnaiStage.start()
 
@@ -213,11 +269,11 @@ class TecnaiMicroscope(metaclass=Singleton):
         if enable_stage:
             if wait == True:
                 self._tem.Stage.GoToWithSpeed(pos, axis, self._rotation_speed)
-                self.waitForStage()
+                self._waitForStage(self._rotation_speed)
             elif (wait == False) and (self._tecnaiStage.is_alive() is False):
                 #start Rotation in separate Thread and go on
                 stagePos = (pos.X, pos.Y, pos.Z, pos.A, pos.B)
-                self._tecnaiStage = TecnaiStageThread(self._tem, stagePos, axis, self._rotation_speed)
+                self._tecnaiStage = TecnaiStageThread(unwrap(self._tem), stagePos, axis, self._rotation_speed)
                 self._tecnaiStage.daemon=True
                 self._tecnaiStage.start()
                 
@@ -240,11 +296,22 @@ class TecnaiMicroscope(metaclass=Singleton):
         
         self.waitForStage()
 
-    def waitForStage(self, delay: float=0.1) -> None:
-        """helper function to wait, until the stage movement is finished."""
-        while self._tem.Stage.Status is not self._tem_constant.StageStatus['stReady']:
-            if delay > 0:
-                time.sleep(delay)
+    def waitForStage(self, delay: float=None) -> float:
+        """helper function to wait, until the stage movement is finished.
+        `delay` overrides the largest poll interval, returns the time waited in s."""
+        return self._waitForStage(delay=delay)
+
+    def _waitForStage(self, speed: float = 1.0, delay: float = None) -> float:
+        """Wait for a stage move at `speed` (`GoToWithSpeed`), the timeout of
+        `waitForStage` applies to full speed and is scaled by 1 / speed."""
+        ready = self._tem_constant.StageStatus['stReady']
+        scale = 1.0 / speed if 0.0 < speed < 1.0 else 1.0
+        return self._completion.wait('waitForStage', lambda: self._tem.Stage.Status == ready,
+                                     max_interval=delay, scale=scale)
+
+    def getCompletionTimes(self) -> dict:
+        """Return the duration in s of the last stage wait, screen move and normalization."""
+        return dict(self._completion.durations)
 
     def setStageSpeed(self, value: float) -> None:
         """Set Stage speed, not available on Tecnai."""
@@ -263,6 +330,12 @@ class TecnaiMicroscope(metaclass=Singleton):
         """get the rotation speed of the alpha rotation"""
         return self._rotation_speed
 
+    def _rotateTo(self, angle: float, speed: float) -> None:
+        """Start rotating alpha to `angle` deg at `speed` (0-1), for `RotationMixin`."""
+        if self._tecnaiStage.is_alive():
+            self._tecnaiStage.join()
+        self._moveStage(self._tem.Stage.Position, None, None, None, angle, None, wait=False, speed=speed)
+
 
     ###Gun
     def getGunShift(self) -> (float, float):
@@ -322,11 +395,13 @@ class TecnaiMicroscope(metaclass=Singleton):
         """unblank the Beam."""
         self._tem.Illumination.BeamBlanked = False
 
-    def setNeutral(self, *args) -> None:
-        """Neutralize all deflectors."""
+    def setNeutral(self, *args) -> float:
+        """Neutralize all deflectors, return the time it took in s."""
+        t0 = time.perf_counter()
         self._tem.Projection.Normalize(self._tem_constant.ProjectionNormalization['pnmAll'])
         self._tem.Illumination.Normalize(self._tem_constant.IlluminationNormalization['nmAll'])
-        time.sleep(4)
+        # the lenses give no signal when they have settled, `min_wait` from the config
+        return self._completion.wait('setNeutral', t0=t0)
 
     def getBeamAlignShift(self) -> (float, float):
         """get the Gun-Shift values."""
@@ -380,6 +455,16 @@ class TecnaiMicroscope(metaclass=Singleton):
             
         self._tem.Illumination.Shift = bs
 
+    def setBeamShiftRelative(self, dx: float = 0.0, dy: float = 0.0) -> (float, float):
+        """shift the BeamShift by dx, dy, return the new values."""
+        bs = self._tem.Illumination.Shift
+        x = bs.X + dx
+        y = bs.Y + dy
+        bs.X = x
+        bs.Y = y
+        self._tem.Illumination.Shift = bs
+        return x, y
+
     def getBeamTilt(self) -> (float, float):
         """get Rotation center."""
         return self._tem.Illumination.RotationCenter.X, self._tem.Illumination.RotationCenter.Y
@@ -424,36 +509,36 @@ class TecnaiMicroscope(metaclass=Singleton):
 
     def getScreenPosition(self) -> str:
         """is Screen 'up' or 'down'."""
-        while self._tem.Camera.MainScreen == self._tem_constant.ScreenPosition['spUnknown']:
-            time.sleep(1)
+        unknown = self._tem_constant.ScreenPosition['spUnknown']
+        self._completion.wait('getScreenPosition', lambda: self._tem.Camera.MainScreen != unknown)
 
-        if self._tem.Camera.MainScreen == self._tem_constant.ScreenPosition['spUp']:
+        screen = self._tem.Camera.MainScreen
+        if screen == self._tem_constant.ScreenPosition['spUp']:
             return 'up'
-        elif self._tem.Camera.MainScreen == self._tem_constant.ScreenPosition['spDown']:
+        elif screen == self._tem_constant.ScreenPosition['spDown']:
             return 'down'
         else:
             return ''
         
-    def setScreenPosition(self, value: str) -> None:
-        """set Screen 'up' or 'down'."""
+    def setScreenPosition(self, value: str) -> float:
+        """set Screen 'up' or 'down', return the time the move took in s."""
         if value not in ('up', 'down'):
             raise FEIValueError("No such screen position: %s ." % (value))
         if value == 'up':
-            self._tem.Camera.MainScreen = self._tem_constant.ScreenPosition['spUp']
+            target = self._tem_constant.ScreenPosition['spUp']
         else:
-            self._tem.Camera.MainScreen = self._tem_constant.ScreenPosition['spDown']
+            target = self._tem_constant.ScreenPosition['spDown']
 
-        while self._tem.Camera.MainScreen == self._tem_constant.ScreenPosition['spUnknown']:
-            time.sleep(1)
+        t0 = time.perf_counter()
+        self._tem.Camera.MainScreen = target
+        return self._completion.wait('setScreenPosition', lambda: self._tem.Camera.MainScreen == target, t0=t0)
 
     def getDiffFocus(self, confirm_mode: bool=True) -> int:
         """get the diffraction focus scaled between -1e4 (0) und 1e4 (65536)."""
         if not self.getFunctionMode() == 'diff':
             raise FEIValueError("Must be in 'diff' mode to get DiffFocus")
 
-        foc = self._tem.Projection.Defocus
-        val = int(32768.0 * 1.0e4 * (foc + 1.0e-4))
-        return val
+        return self._toDiffFocus(self._tem.Projection.Defocus)
 
     def setDiffFocus(self, value: int, confirm_mode: bool=True) -> None:
         """set the diffraction focus value between -1e4 (0) und 1e4 (65536)."""
@@ -461,8 +546,7 @@ class TecnaiMicroscope(metaclass=Singleton):
             raise FEIValueError("Must be in 'diff' mode to set DiffFocus")
 
         if 0 <= value <= 65536:
-            foc = float((1.0e-4 / 32768.0 * value) - 1e-4)
-            self._tem.Projection.Defocus = foc
+            self._tem.Projection.Defocus = self._fromDiffFocus(value)
 
     def getDiffFocusValue(self, confirm_mode: bool=True) -> float:
         """get the diffraction focus value."""
@@ -492,6 +576,38 @@ class TecnaiMicroscope(metaclass=Singleton):
                                           
         self._tem.Projection.Defocus = value
 
+    @staticmethod
+    def _toDiffFocus(defocus: float) -> int:
+        """Scale the Defocus to the units of `getDiffFocus`, -1e4 (0) to 1e4 (65536)."""
+        return round(32768.0 * 1.0e4 * (defocus + 1.0e-4))
+
+    @staticmethod
+    def _fromDiffFocus(value: int) -> float:
+        return float((1.0e-4 / 32768.0 * value) - 1e-4)
+
+    def _getDefocus(self, diffraction: bool = False) -> float:
+        """get the Defocus value without checking the function mode, in the
+        units of `getFocus`, or of `getDiffFocus` (0 to 65536) if `diffraction`."""
+        if diffraction:
+            return self._toDiffFocus(self._tem.Projection.Defocus)
+        return self._tem.Projection.Defocus
+
+    def _setDefocus(self, value: float, diffraction: bool = False) -> None:
+        """set the Defocus value without checking the function mode, in the
+        units of `setFocus`, or of `setDiffFocus` (0 to 65536) if `diffraction`."""
+        if diffraction:
+            if not 0 <= value <= 65536:
+                raise FEIValueError('DiffFocus must be between 0 and 65536, got: %s' % (value))
+            value = self._fromDiffFocus(value)
+        self._tem.Projection.Defocus = value
+
+    def _saveDefocus(self, diffraction: bool) -> float:
+        """the Defocus value itself, the units of `getDiffFocus` are coarser."""
+        return self._tem.Projection.Defocus
+
+    def _restoreDefocus(self, saved: float, diffraction: bool) -> None:
+        self._tem.Projection.Defocus = saved
+
     def getFunctionMode(self) -> str:
         """get the Function Mode. diff=D, lowmag=LM, mag1=Mi, samag=SA, mag2=Mh ."""
         mode = self._tem.Projection.SubMode
@@ -509,6 +625,14 @@ class TecnaiMicroscope(metaclass=Singleton):
             except ValueError:
                 raise FEIValueError('Unrecognized function mode: %s' % (value))
 
+    def _imagingMagnifications(self) -> list:
+        """Return the magnifications of LM, Mi, SA and Mh in index order,
+        a new list, the ranges of the config must not be extended."""
+        magni = []
+        for k in ['LM', 'Mi', 'SA', 'Mh']:
+            magni.extend(self._mic_ranges[k])
+        return magni
+
     def getMagnification(self) -> float:
         """get Magnification/camera length."""
         ind = self.getMagnificationIndex() - 1
@@ -518,10 +642,7 @@ class TecnaiMicroscope(metaclass=Singleton):
         elif self.getFunctionMode() == 'LAD':
             return self._mic_ranges['LAD'][ind]
         else:
-            magni = self._mic_ranges['LM']
-            for k in ['Mi', 'SA', 'Mh']:
-                magni.extend(self._mic_ranges[k])
-            return magni[ind]
+            return self._imagingMagnifications()[ind]
         
     def setMagnification(self, value: float) -> None:
         """set Magnification/camera length."""
@@ -533,10 +654,7 @@ class TecnaiMicroscope(metaclass=Singleton):
             elif self.getFunctionMode() == 'LAD':
                 ind = self._mic_ranges['LAD'].index(value)
             else:
-                magni = self._mic_ranges['LM']
-                for k in ['Mi', 'SA', 'Mh']:
-                    magni.extend(self._mic_ranges[k])
-                ind = magni.index(value)
+                ind = self._imagingMagnifications().index(value)
         except ValueError:
             raise FEIValueError('wrong Magnification: %s' % (value))
 
@@ -547,15 +665,21 @@ class TecnaiMicroscope(metaclass=Singleton):
     
     def getMagnificationRanges(self) -> dict:
         """get the MagnificationRanges from the config file"""
+        return self._magnificationRanges(self._mic_ranges)
+
+    @staticmethod
+    def _magnificationRanges(ranges: dict) -> dict:
+        """Map the `ranges` of the config to the function modes, also used
+        by the server before the microscope is initialized."""
         mag_ranges = {}
 
-        mag_ranges['diff'] = self._mic_ranges['D']
-        mag_ranges['LAD'] = self._mic_ranges['LAD']
-        mag_ranges['lowmag'] = self._mic_ranges['LM']
-        mag_ranges['mag1'] = self._mic_ranges['Mi']
-        mag_ranges['samag'] = self._mic_ranges['SA']
-        mag_ranges['mag2'] = self._mic_ranges['Mh']
-        
+        mag_ranges['diff'] = ranges['D']
+        mag_ranges['LAD'] = ranges['LAD']
+        mag_ranges['lowmag'] = ranges['LM']
+        mag_ranges['mag1'] = ranges['Mi']
+        mag_ranges['samag'] = ranges['SA']
+        mag_ranges['mag2'] = ranges['Mh']
+
         return mag_ranges
 
     def getMagnificationIndex(self) -> int:
@@ -617,6 +741,16 @@ class TecnaiMicroscope(metaclass=Singleton):
 
         self._tem.Projection.ImageShift = is1
 
+    def setImageShift1Relative(self, dx: float = 0.0, dy: float = 0.0) -> (float, float):
+        """shift the image shift by dx, dy, return the new values."""
+        is1 = self._tem.Projection.ImageShift
+        x = is1.X + dx
+        y = is1.Y + dy
+        is1.X = x
+        is1.Y = y
+        self._tem.Projection.ImageShift = is1
+        return x, y
+
     def getImageShift2(self) -> (float, float):
         """not implemented."""
         return 0, 0
@@ -656,6 +790,16 @@ class TecnaiMicroscope(metaclass=Singleton):
 
         self._tem.Projection.DiffractionShift = ds1
 
+    def setDiffShiftRelative(self, dx: float = 0.0, dy: float = 0.0) -> (float, float):
+        """shift the diffraction shift by dx, dy in degree, return the new values."""
+        ds1 = self._tem.Projection.DiffractionShift
+        x = float(ds1.X + dx / 180 * pi)
+        y = float(ds1.Y + dy / 180 * pi)
+        ds1.X = x
+        ds1.Y = y
+        self._tem.Projection.DiffractionShift = ds1
+        return float(180 / pi * x), float(180 / pi * y)
+
     def getObjectiveLensStigmator(self) -> (float, float):
         """get the objective lens stigmator value."""
         return self._tem.Projection.ObjectiveStigmator.X, self._tem.Projection.ObjectiveStigmator.Y
@@ -677,13 +821,24 @@ class TecnaiMicroscope(metaclass=Singleton):
     @staticmethod
     def release_connection() -> None:
         """release the COM-connection."""
-        comtypes.CoUninitialize()
+        if comtypes is not None:
+            comtypes.CoUninitialize()
         print('Connection to microscope released')
 
     def getApertureSize(self, aperture: str) -> None:
         """not available on Tecnai."""
         print('getApertureSize, not available on Tecnai.')
 
+
+class FakeTecnaiMicroscope(TecnaiMicroscope):
+    """`TecnaiMicroscope` on the model of the COM interface in `fake_com`,
+    with the config `name`."""
+
+    def __init__(self, name: str = 'tecnai') -> None:
+        ranges = config(name).micr_ranges
+        instrument = fake_com.Instrument(tuple(len(ranges[k]) for k in ('LM', 'Mi', 'SA', 'Mh')))
+        super().__init__(name, instrument=instrument)
+
  
 if __name__ == '__main__':
     tem = TecnaiMicroscope()
@@ -1,6 +1,20 @@
 import threading
-import comtypes
 from typing import Union
+try:
+    import comtypes
+    import comtypes.client
+except ImportError:
+    comtypes = None  # only the model of `fake_com` can be used
+
+from TEMController import fake_com
+
+
+def get_constants(tem):
+    """Return the enum constants of the scripting interface `tem`."""
+    if isinstance(tem, fake_com.Instrument):
+        return tem.constants
+    return comtypes.client.Constants(tem)
+
 
 class TecnaiStageThread(threading.Thread):
     """
@@ -8,7 +22,7 @@ class TecnaiStageThread(threading.Thread):
     """
     
     def __init__(self, tem=None, pos:(float, float, float, float, float)=None, axis:int=None, speed:Union[int, float]=0):
-        super().__init__()
+        super().__init__(name='stage')
 
         #TEM-Scriptinginterface
         self._tem = tem
@@ -39,7 +53,7 @@ class TecnaiStageThread(threading.Thread):
         if self._pos is None:
             return
         with ContextManagedComtypes() as cmc:
-            tem_constant = comtypes.client.Constants(self._tem)
+            tem_constant = get_constants(self._tem)
             stagePos = self._tem.Stage.Position
             if self._axis & tem_constant.StageAxes['axisX']:
                 stagePos.X = self._pos[0]
@@ -61,11 +75,13 @@ class TecnaiStageThread(threading.Thread):
 class ContextManagedComtypes():
     '''The Context Manager Protocoll is used to initialize the COM connection again'''
     def __enter__(self):
-        comtypes.CoInitialize()
+        if comtypes is not None:
+            comtypes.CoInitialize()
         return self
 
     def __exit__(self, *args):
-        comtypes.CoUninitialize()
+        if comtypes is not None:
+            comtypes.CoUninitialize()
         return True
 
     def __str__(self):
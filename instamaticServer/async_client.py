@@ -0,0 +1,192 @@
+"""Asyncio client for the tem_server, requires Python 3.7 or newer.
+
+    async with AsyncTemClient(host, port) as tem:
+        pos, bs = await asyncio.gather(tem.getStagePosition(), tem.getBeamShift())
+        async for pos in tem.stream('getStagePosition', interval=0.1):
+            ...
+"""
+import asyncio
+import itertools
+
+from client import HOST, PORT, raise_for_status
+from serializer import FRAME_HEADER, FRAME_MAGIC, dumper, frame, loader
+from utils.exceptions import TEMCommunicationError
+
+
+class AsyncStream:
+    """Async iterator over the values pushed by a `__stream__` request."""
+
+    def __init__(self, client, seq: int):
+        self._client = client
+        self._unsubscribe = '__unstream__'
+        self._queue = asyncio.Queue()
+        self.seq = seq
+        self.done = False
+
+    def _put(self, response) -> None:
+        self._queue.put_nowait(response)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.done:
+            raise StopAsyncIteration
+        status, value = await self._queue.get()
+        if status == 102:
+            return value
+        self.done = True
+        raise_for_status((status, value))
+        raise StopAsyncIteration
+
+    async def stop(self) -> None:
+        """Ask the server to end the stream, the remaining values can
+        still be read until the iteration stops."""
+        if not self.done:
+            await self._client.call(self._unsubscribe, self.seq)
+
+
+class AsyncTemClient:
+    """Client for the tem_server that returns awaitables for its calls.
+
+    All calls share a single framed connection, each request carries a
+    sequence number `seq` so that many can be outstanding at the same
+    time, the responses are matched to them by a reader task. Microscope
+    methods are available as coroutine attributes. `microscope` selects
+    the instance on servers hosting several.
+    """
+
+    def __init__(self, host: str = HOST, port: int = PORT, microscope: str = None):
+        self.host = host
+        self.port = port
+        self.microscope = microscope
+        self._reader = None
+        self._writer = None
+        self._task = None
+        self._seq = itertools.count(1)
+        self._pending = {}
+        self._streams = {}
+
+    async def connect(self) -> None:
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._task = asyncio.ensure_future(self._read_loop())
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._writer = self._task = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def _read_loop(self) -> None:
+        error = TEMCommunicationError('Connection to tem_server closed')
+        try:
+            while True:
+                header = await self._reader.readexactly(FRAME_HEADER.size)
+                magic, size = FRAME_HEADER.unpack(header)
+                if magic != FRAME_MAGIC:
+                    raise TEMCommunicationError('Invalid message frame from server')
+                status, value, seq = loader(await self._reader.readexactly(size))
+                self._dispatch(seq, status, value)
+        except asyncio.IncompleteReadError:
+            pass
+        except Exception as e:
+            error = e
+        finally:
+            for future, on_progress in self._pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            for stream in self._streams.values():
+                stream._put((500, (error.__class__.__name__, error.args)))
+            self._pending.clear()
+            self._streams.clear()
+
+    def _dispatch(self, seq: int, status: int, value) -> None:
+        stream = self._streams.get(seq)
+        if stream is not None:
+            if status != 102:
+                del self._streams[seq]
+            stream._put((status, value))
+            return
+
+        try:
+            future, on_progress = self._pending[seq]
+        except KeyError:
+            return
+        if status == 102:
+            if on_progress:
+                on_progress(value)
+            return
+        del self._pending[seq]
+        if future.done():
+            return
+        try:
+            future.set_result(raise_for_status((status, value)))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _send(self, func_name: str, args, kwargs, stream: bool = False) -> int:
+        if self._writer is None:
+            raise TEMCommunicationError('Not connected, call `connect` first')
+        seq = next(self._seq)
+        request = {'func_name': func_name, 'args': tuple(args), 'kwargs': kwargs, 'seq': seq}
+        if self.microscope:
+            request['microscope'] = self.microscope
+        if stream:
+            request['stream'] = True
+        self._writer.write(frame(dumper(request)))
+        return seq
+
+    def call(self, func_name: str, *args, on_progress=None, **kwargs) -> asyncio.Future:
+        """Send `func_name` with `args` and `kwargs` and return a future for
+        its result. Progress messages are passed to `on_progress`."""
+        future = asyncio.get_running_loop().create_future()
+        seq = self._send(func_name, args, kwargs, stream=on_progress is not None)
+        self._pending[seq] = (future, on_progress)
+        return future
+
+    def stream(self, func_name: str, *args, interval: float = 1.0, count: int = None, **kwargs) -> AsyncStream:
+        """Return an async iterator over the results of `func_name`, read
+        by the server every `interval` s."""
+        seq = self._send('__stream__', (func_name,),
+                         {'interval': interval, 'args': args, 'kwargs': kwargs, 'count': count})
+        stream = AsyncStream(self, seq)
+        self._streams[seq] = stream
+        return stream
+
+    def wait_until(self, conditions: list, interval: float = 0.01, timeout: float = None) -> asyncio.Future:
+        """Return a future for the moment all `conditions` on the microscope
+        state hold, see `triggers.Trigger` for the result."""
+        return self.call('__wait_until__', conditions, interval=interval, timeout=timeout)
+
+    def changes(self) -> AsyncStream:
+        """Return an async iterator over the change events of the server,
+        dicts with the state `version` and the `changes` of the fields
+        modified by a command. Read the state after subscribing, the
+        events only carry the fields that changed since then."""
+        seq = self._send('__subscribe__', (), {})
+        stream = AsyncStream(self, seq)
+        stream._unsubscribe = '__unsubscribe__'
+        self._streams[seq] = stream
+        return stream
+
+    def __getattr__(self, func_name: str):
+        if func_name.startswith('_'):
+            raise AttributeError(func_name)
+
+        def stub(*args, **kwargs):
+            return self.call(func_name, *args, **kwargs)
+
+        stub.__name__ = func_name
+        return stub
@@ -0,0 +1,496 @@
+import itertools
+import json
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+
+import clock
+from dispatch import READONLY_PREFIXES
+from serializer import FRAME_HEADER, FRAME_MAGIC, dumper, frame, loader, truncated
+from utils.config import config
+from utils.exceptions import TEMCommunicationError, exception_list
+
+_conf = config()
+HOST = _conf.default_settings['tem_server_host']
+PORT = _conf.default_settings['tem_server_port']
+BUFSIZE = 65536
+TIMEOUT = 30.0
+
+# commands whose result does not change during a session, cached by `TemClient`
+STATIC_COMMANDS = ('__methods__', 'getMagnificationRanges', 'getHolderType', 'is_goniotool_available')
+
+# server commands that change its state, sent with a `request_id` like the mutating methods
+MUTATING_BUILTINS = ('__run_macro__', '__define_macro__', '__delete_macro__')
+
+
+def raise_for_status(response):
+    """Return the value of the server `response`, or raise the exception
+    reported by the server."""
+    status, value = response
+    if status == 200:
+        return value
+    if status == 500:
+        name, args = value
+        raise exception_list.get(name, TEMCommunicationError)(*args)
+    raise TEMCommunicationError('Unexpected response from server: %s' % (response,))
+
+
+class Connection:
+    """A framed connection to the tem_server at `host`:`port`."""
+
+    def __init__(self, host: str = HOST, port: int = PORT, timeout: float = TIMEOUT):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self._buf = b''
+
+    def connect(self) -> None:
+        self.close()
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self) -> None:
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self._buf = b''
+
+    @property
+    def connected(self) -> bool:
+        return self.sock is not None
+
+    def send(self, *requests) -> None:
+        """Send one or several requests in a single write."""
+        if self.sock is None:
+            self.connect()
+        self.sock.sendall(b''.join(frame(dumper(request)) for request in requests))
+
+    def _read(self, n: int) -> bytes:
+        while len(self._buf) < n:
+            chunk = self.sock.recv(BUFSIZE)
+            if not chunk:
+                raise ConnectionError('Connection closed by server')
+            self._buf += chunk
+        data, self._buf = self._buf[:n], self._buf[n:]
+        return data
+
+    def receive(self):
+        """Receive one response."""
+        magic, size = FRAME_HEADER.unpack(self._read(FRAME_HEADER.size))
+        if magic != FRAME_MAGIC:
+            raise TEMCommunicationError('Invalid message frame from server')
+        return loader(self._read(size))
+
+
+class ConnectionPool:
+    """Pool of up to `size` persistent connections to the tem_server, so
+    calls do not pay for a new connection every time."""
+
+    def __init__(self, host: str = HOST, port: int = PORT, size: int = 2, timeout: float = TIMEOUT):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._pool = queue.LifoQueue()
+        self._sem = threading.BoundedSemaphore(size)
+
+    def acquire(self) -> Connection:
+        self._sem.acquire()
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return Connection(self.host, self.port, timeout=self.timeout)
+
+    def release(self, conn: Connection) -> None:
+        self._pool.put(conn)
+        self._sem.release()
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class Pipeline:
+    """Collects calls and sends them to the server in one write, the
+    responses are read in order. Use through `TemClient.pipeline`:
+
+        with client.pipeline() as p:
+            p.getStagePosition()
+            p.getBeamShift()
+        pos, bs = p.results
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+        self.results = None
+
+    def call(self, func_name: str, *args, **kwargs) -> None:
+        self._calls.append((func_name, args, kwargs))
+
+    def __getattr__(self, func_name: str):
+        if func_name.startswith('_'):
+            raise AttributeError(func_name)
+        return lambda *args, **kwargs: self.call(func_name, *args, **kwargs)
+
+    def execute(self) -> list:
+        self.results = self._client.batch(self._calls)
+        self._calls = []
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.execute()
+
+
+class TemClient:
+    """Client for the tem_server.
+
+    Keeps a pool of persistent connections that are re-established
+    automatically, and sends the requests framed so that several calls
+    can be pipelined on one connection. Methods of the microscope are
+    available as attributes, generated from the `__methods__` command of
+    the server. Results of `STATIC_COMMANDS` are cached if `cache` is set.
+
+    `microscope` selects the instance on servers hosting several, and
+    `client` names the client for the scheduling settings of the server
+    (`tem_server_clients`), it defaults to the host. If
+    `trace` is set, every request carries a trace ID and the server
+    records its phases, see `save_traces`.
+
+    Commands that change the microscope state carry a unique
+    `request_id` if `idempotent` is set, so they are retried like the
+    read-only ones after a connection failure or timeout: the server
+    runs them only once and answers the retry with the same response.
+    """
+
+    def __init__(self,
+                 host: str = HOST,
+                 port: int = PORT,
+                 microscope: str = None,
+                 client: str = None,
+                 pool_size: int = 2,
+                 cache: bool = True,
+                 retries: int = 1,
+                 timeout: float = TIMEOUT,
+                 trace: bool = False,
+                 idempotent: bool = True):
+        self.microscope = microscope
+        self.client = client
+        self.pool = ConnectionPool(host, port, size=pool_size, timeout=timeout)
+        self.retries = retries
+        self._cache = {} if cache else None
+        self._methods = None
+        self._trace_ids = itertools.count(1) if trace else None
+        self._trace_prefix = '%s-%d' % (socket.gethostname(), os.getpid())
+        self.last_trace = None
+        self._request_ids = itertools.count(1) if idempotent else None
+        self._request_prefix = uuid.uuid4().hex
+        # result of `sync_clock`, server time = client time + offset
+        self.clock_sync = None
+
+    def close(self) -> None:
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _request(self, func_name: str, args, kwargs) -> dict:
+        request = {'func_name': func_name, 'args': tuple(args), 'kwargs': kwargs}
+        if self.microscope:
+            request['microscope'] = self.microscope
+        if self.client:
+            request['client'] = self.client
+        if self._trace_ids is not None:
+            self.last_trace = '%s:%d' % (self._trace_prefix, next(self._trace_ids))
+            request['trace'] = self.last_trace
+        if self._request_ids is not None and self._is_mutating(func_name):
+            request['request_id'] = '%s:%d' % (self._request_prefix, next(self._request_ids))
+        return request
+
+    def _is_readonly(self, func_name: str) -> bool:
+        methods = self._methods or {}
+        if func_name in methods:
+            return methods[func_name]['readonly']
+        if func_name in STATIC_COMMANDS:
+            return True
+        # not known (yet) from `__methods__`, the rule of the server
+        return not func_name.startswith('__') and func_name.startswith(READONLY_PREFIXES)
+
+    def _is_mutating(self, func_name: str) -> bool:
+        if func_name.startswith('__'):
+            return func_name in MUTATING_BUILTINS
+        return not self._is_readonly(func_name)
+
+    def _exchange(self, requests: list, on_progress=None) -> list:
+        """Send `requests` over one connection and return the responses.
+
+        Connection failures are retried on a new connection if nothing
+        was sent yet, or if all requests only read the microscope state
+        or carry a `request_id`.
+        """
+        attempt = 0
+        while True:
+            conn = self.pool.acquire()
+            sent = False
+            try:
+                if not conn.connected:
+                    conn.connect()
+                conn.send(*requests)
+                sent = True
+                responses = []
+                while len(responses) < len(requests):
+                    response = conn.receive()
+                    if response[0] == 102:
+                        if on_progress:
+                            on_progress(response[1])
+                        continue
+                    responses.append(response)
+                return responses
+            except (OSError, ConnectionError) as e:
+                conn.close()
+                retry = not sent or all(self._is_readonly(r['func_name']) or 'request_id' in r for r in requests)
+                attempt += 1
+                if not retry or attempt > self.retries:
+                    raise TEMCommunicationError('Lost connection to tem_server: %s' % (e,))
+            finally:
+                self.pool.release(conn)
+
+    def call(self, func_name: str, *args, **kwargs):
+        """Call `func_name` on the microscope with `args` and `kwargs`."""
+        cache = self._cache
+        if cache is not None and func_name in STATIC_COMMANDS:
+            key = (func_name, repr(args), repr(sorted(kwargs.items())))
+            if key not in cache:
+                cache[key] = self._call(func_name, args, kwargs)
+            return cache[key]
+        return self._call(func_name, args, kwargs)
+
+    def _call(self, func_name: str, args, kwargs, on_progress=None):
+        request = self._request(func_name, args, kwargs)
+        if on_progress:
+            request['stream'] = True
+        response, = self._exchange([request], on_progress=on_progress)
+        return raise_for_status(response)
+
+    def call_timestamped(self, func_name: str, *args, **kwargs):
+        """Call `func_name` and return its result and the (start, end) of its
+        execution on the microscope in the clock of the client (`clock.now`),
+        the clock offset is estimated with `sync_clock` on the first call."""
+        if self.clock_sync is None:
+            self.sync_clock()
+        request = self._request(func_name, args, kwargs)
+        request['timestamp'] = True
+        response, = self._exchange([request])
+        # servers that do not timestamp the response send (status, value)
+        value = raise_for_status(tuple(response[:2]))
+        stamp = response[3] if len(response) > 3 else None
+        if stamp is not None:
+            offset = self.clock_sync['offset']
+            stamp = (stamp[0] - offset, stamp[1] - offset)
+        return value, stamp
+
+    def sync_clock(self, n: int = 16) -> dict:
+        """Estimate the offset of the server clock from `n` exchanges, see
+        `clock.estimate_offset`. The result is kept in `clock_sync`."""
+        conn = self.pool.acquire()
+        try:
+            if not conn.connected:
+                conn.connect()
+            samples = []
+            for i in range(n):
+                t0 = clock.now()
+                conn.send(self._request('__time__', (), {}))
+                t1, t2 = raise_for_status(conn.receive())
+                samples.append((t0, t1, t2, clock.now()))
+        except (OSError, ConnectionError) as e:
+            conn.close()
+            raise TEMCommunicationError('Lost connection to tem_server: %s' % (e,))
+        finally:
+            self.pool.release(conn)
+        self.clock_sync = clock.estimate_offset(samples)
+        return self.clock_sync
+
+    def call_with_progress(self, func_name: str, on_progress, *args, **kwargs):
+        """Call `func_name` and pass the progress messages streamed by the
+        server (e.g. for `__run_macro__`) to `on_progress`."""
+        return self._call(func_name, args, kwargs, on_progress=on_progress)
+
+    def batch(self, calls: list) -> list:
+        """Pipeline the `calls`, a list of (func_name, args, kwargs), over
+        one connection and return their results in order. If any call
+        failed, its exception is raised after all responses are read."""
+        if not calls:
+            return []
+        requests = [self._request(func_name, args, kwargs) for func_name, args, kwargs in calls]
+        results = []
+        error = None
+        for response in self._exchange(requests):
+            try:
+                results.append(raise_for_status(response))
+            except Exception as e:
+                results.append(e)
+                error = error or e
+        if error is not None:
+            raise error
+        return results
+
+    def pipeline(self) -> Pipeline:
+        return Pipeline(self)
+
+    def ping(self) -> float:
+        """Return the round-trip time in s of a request answered by the
+        server without touching the microscope."""
+        t0 = time.perf_counter()
+        self._call('__ping__', (), {})
+        return time.perf_counter() - t0
+
+    def status(self) -> dict:
+        """Return the state, queue depth and executing command of the
+        microscope instance, also while it is busy."""
+        return self._call('__status__', (), {})
+
+    def stats(self) -> dict:
+        """Return the status and counters of all instances of the server."""
+        return self._call('__stats__', (), {})
+
+    def wait_until(self, conditions: list, interval: float = 0.01, timeout: float = None) -> dict:
+        """Block until all `conditions` on the microscope state hold, or for
+        at most `timeout` s, see `triggers.Trigger` for the result."""
+        return self._call('__wait_until__', (conditions,), {'interval': interval, 'timeout': timeout})
+
+    def cancel(self) -> bool:
+        """Cancel the sequence running on the microscope."""
+        return self._call('__cancel__', (), {})
+
+    def save_traces(self, path: str, trace_ids: list = None, last: int = None) -> int:
+        """Write the traces recorded by the server (all, `trace_ids` or the
+        `last` n) to `path` as Chrome trace-event JSON, return the number
+        of events."""
+        traces = self._call('__traces__', (), {'trace_ids': trace_ids, 'last': last})
+        with open(path, 'w') as f:
+            json.dump(traces, f)
+        return len(traces['traceEvents'])
+
+    def start_profiler(self, interval: float = 0.01, threads: list = None, duration: float = 600.0) -> bool:
+        """Start the sampling profiler of the server, see `stop_profiler`."""
+        return self._call('__profile_start__', (), {'interval': interval, 'threads': threads, 'duration': duration})
+
+    def stop_profiler(self, path: str = None, format: str = 'collapsed') -> dict:
+        """Stop the sampling profiler of the server and return its summary
+        with the samples in `format`, collapsed stacks (for flamegraph.pl or
+        speedscope) or `pstats` data. If `path` is given, the samples are
+        written there instead, to be opened with `pstats.Stats(path)`
+        for the `pstats` format."""
+        result = self._call('__profile_stop__', (), {'format': format})
+        if path is not None:
+            data = result.pop('data')
+            with open(path, 'w' if format == 'collapsed' else 'wb') as f:
+                f.write(data)
+        return result
+
+    @property
+    def methods(self) -> dict:
+        """The method table of the server, fetched once per session."""
+        if self._methods is None:
+            self._methods = self.call('__methods__')
+        return self._methods
+
+    def __dir__(self):
+        return list(super().__dir__()) + list(self.methods)
+
+    def __getattr__(self, func_name: str):
+        if func_name.startswith('_'):
+            raise AttributeError(func_name)
+        try:
+            info = self.methods[func_name]
+        except KeyError:
+            raise AttributeError("tem_server has no command '%s'" % (func_name))
+
+        def stub(*args, **kwargs):
+            return self.call(func_name, *args, **kwargs)
+
+        stub.__name__ = func_name
+        stub.__doc__ = '%s(%s)\n\n%s' % (func_name, ', '.join(info['params']), info['doc'])
+        setattr(self, func_name, stub)
+        return stub
+
+
+def naive_call(func_name: str, *args, host: str = HOST, port: int = PORT, **kwargs):
+    """Call `func_name` on a new connection with an unframed request, like
+    a client without connection reuse."""
+    with socket.create_connection((host, port), timeout=TIMEOUT) as sock:
+        sock.sendall(dumper({'func_name': func_name, 'args': args, 'kwargs': kwargs}))
+        data = b''
+        while True:
+            chunk = sock.recv(BUFSIZE)
+            if not chunk:
+                raise ConnectionError('Connection closed by server')
+            data += chunk
+            try:
+                response = loader(data)
+                break
+            except Exception as e:
+                if not truncated(e, data):
+                    raise
+    return raise_for_status(response)
+
+
+def benchmark(host: str = HOST, port: int = PORT, n: int = 1000, func_name: str = 'getBeamShift') -> dict:
+    """Time `n` calls of `func_name` with a new connection per call, with
+    the pooled client, and pipelined in batches of 100. Returns the mean
+    time per call in s."""
+    timings = {}
+
+    t0 = time.perf_counter()
+    for i in range(n):
+        naive_call(func_name, host=host, port=port)
+    timings['naive'] = (time.perf_counter() - t0) / n
+
+    with TemClient(host, port) as client:
+        client.call(func_name)
+        t0 = time.perf_counter()
+        for i in range(n):
+            client.call(func_name)
+        timings['pooled'] = (time.perf_counter() - t0) / n
+
+        t0 = time.perf_counter()
+        for i in range(0, n, 100):
+            client.batch([(func_name, (), {})] * min(100, n - i))
+        timings['pipelined'] = (time.perf_counter() - t0) / n
+
+    return timings
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the tem_server client against one connection per call.')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', default=PORT, type=int)
+    parser.add_argument('-n', default=1000, type=int, help='Number of calls per mode.')
+    parser.add_argument('-f', '--func', default='getBeamShift', help='Microscope method to call.')
+    options = parser.parse_args()
+
+    timings = benchmark(options.host, options.port, n=options.n, func_name=options.func)
+    for mode, t in sorted(timings.items(), key=lambda item: -item[1]):
+        print('%-10s %8.1f us/call  (%.1fx)' % (mode, t * 1e6, timings['naive'] / t))
+
+
+if __name__ == '__main__':
+    main()
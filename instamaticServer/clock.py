@@ -0,0 +1,43 @@
+import time
+
+# time.time() is only updated every ~15 ms on Windows XP, the server clock
+# is time.perf_counter() anchored to the wall clock at startup
+_T0 = time.perf_counter()
+_T0_WALL = time.time()
+
+
+def now() -> float:
+    """Return the high-resolution wall clock time of the server in s."""
+    return _T0_WALL + (time.perf_counter() - _T0)
+
+
+def from_perf_counter(t: float) -> float:
+    """Convert the time.perf_counter() value `t` to the server clock."""
+    return _T0_WALL + (t - _T0)
+
+
+def estimate_offset(samples: list, best: float = 0.25) -> dict:
+    """Estimate the offset of the server clock from the client clock.
+
+    `samples` are NTP-style exchanges (t0, t1, t2, t3): client send,
+    server receive, server send and client receive time. Each gives an
+    offset ((t1 - t0) + (t2 - t3)) / 2 and a round-trip delay
+    (t3 - t0) - (t2 - t1). Exchanges with a long delay were held up
+    somewhere and are the least accurate, so only the fraction `best`
+    with the shortest delays is used: the offset is their median, the
+    uncertainty half the shortest delay. server time = client time + offset.
+    """
+    if not samples:
+        raise ValueError('No clock samples.')
+    measured = sorted(((t3 - t0) - (t2 - t1), ((t1 - t0) + (t2 - t3)) / 2)
+                      for t0, t1, t2, t3 in samples)
+    kept = measured[:max(1, int(len(measured) * best))]
+    offsets = sorted(offset for delay, offset in kept)
+    n = len(offsets)
+    median = offsets[n // 2] if n % 2 else (offsets[n // 2 - 1] + offsets[n // 2]) / 2
+    return {
+        'offset': median,
+        'delay': kept[0][0],
+        'uncertainty': kept[0][0] / 2,
+        'samples': len(samples),
+    }
@@ -0,0 +1,187 @@
+"""Connection of a client of the tem_server or the gateway."""
+import queue
+import select
+import socket
+import threading
+import time
+
+import clock
+from serializer import FRAME_HEADER, FRAME_MAGIC, dumper, frame, loader, truncated
+from utils.exceptions import TEMValueError
+
+BUFSIZE = 1024
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+
+class Connection:
+    """Reads requests from and writes responses to the socket `conn`.
+
+    Requests are either plain serialized objects, as sent by instamatic,
+    or framed (see `serializer.frame`). The framing of the first request
+    is used for the rest of the connection.
+
+    Threads that must not wait for a slow client, like the `TemServer`
+    threads, `post` their responses, which are sent in order by a sender
+    thread of the connection.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        # the sub-queue of the connection on the `FairQueue`s is keyed by its
+        # peer address, its `client` name defaults to the host
+        try:
+            host, port = conn.getpeername()[:2]
+        except (OSError, ValueError):
+            host, port = 'unknown', id(self)
+        self.key = '%s:%s' % (host, port)
+        self.client = host
+        # pipelined responses must not wait for the ack of the previous one
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.framed = None
+        self.streams = {}
+        self.subscriptions = []
+        # perf_counter times of the last request: first byte, all bytes read, decoded
+        self.timing = None
+        self._buf = bytearray()
+        self._send_lock = threading.Lock()
+        # guards the outbox only, `_send_lock` is held while a slow client reads
+        self._outbox_lock = threading.Lock()
+        self._outbox = None
+        self._closed = False
+
+    def _read(self, n: int) -> bool:
+        """Read until the buffer holds at least `n` bytes."""
+        while len(self._buf) < n:
+            chunk = self.conn.recv(max(BUFSIZE, n - len(self._buf)))
+            if not chunk:
+                return False
+            self._buf += chunk
+        return True
+
+    def _read_more(self) -> bool:
+        """Read at least one more byte, and all that has arrived since."""
+        if not self._read(len(self._buf) + 1):
+            return False
+        while len(self._buf) <= MAX_MESSAGE_SIZE and select.select([self.conn], [], [], 0)[0]:
+            chunk = self.conn.recv(max(BUFSIZE, len(self._buf)))
+            if not chunk:
+                break  # closed, found by the next read
+            self._buf += chunk
+        return True
+
+    @staticmethod
+    def _invalid(error) -> TEMValueError:
+        return TEMValueError('Invalid request: %s: %s' % (error.__class__.__name__, error))
+
+    def receive(self):
+        """Receive and decode one request, None if the connection was
+        closed. Plain requests larger than `BUFSIZE` are read in several
+        chunks until they can be decoded, they are decoded again only
+        after all data that arrived in the meantime was read. Raises
+        `TEMValueError` for a request that can not be decoded, which is
+        dropped."""
+        if not self._read(1):
+            return None
+        t0 = time.perf_counter()
+
+        if self.framed is None:
+            self.framed = self._buf.startswith(FRAME_MAGIC[:1])
+
+        if self.framed:
+            if not self._read(FRAME_HEADER.size):
+                return None
+            magic, size = FRAME_HEADER.unpack(self._buf[:FRAME_HEADER.size])
+            if magic != FRAME_MAGIC or size > MAX_MESSAGE_SIZE:
+                raise IOError('Invalid message frame.')
+            end = FRAME_HEADER.size + size
+            if not self._read(end):
+                return None
+            data, self._buf = self._buf[FRAME_HEADER.size:end], self._buf[end:]
+            t1 = time.perf_counter()
+            try:
+                data = loader(data)
+            except Exception as e:
+                raise self._invalid(e)
+            self.timing = (t0, t1, time.perf_counter())
+            return data
+
+        while True:
+            t1 = time.perf_counter()
+            try:
+                data = loader(self._buf)
+            except Exception as e:
+                if not truncated(e, self._buf):
+                    self._buf = bytearray()
+                    raise self._invalid(e)
+                # incomplete message, wait for the rest
+                if len(self._buf) > MAX_MESSAGE_SIZE:
+                    raise IOError('Message too large.')
+                if not self._read_more():
+                    return None
+            else:
+                self._buf = bytearray()
+                self.timing = (t0, t1, time.perf_counter())
+                return data
+
+    def send(self, response, seq=None, trace=None, timestamp: bool = False, executed=None) -> None:
+        """Send `response`, with the sequence number `seq` of the request
+        appended if it had one. Safe to call from several threads. The
+        encode and send phases are added to `trace`, if given.
+
+        If the request asked for a `timestamp`, the response is always
+        (status, value, seq, (start, end)), with the server times of the
+        execution `executed` (perf_counter) of the command, or None as
+        the last item if it was not executed by the microscope."""
+        t0 = time.perf_counter()
+        if timestamp:
+            stamp = (clock.from_perf_counter(executed[0]), clock.from_perf_counter(executed[1])) if executed else None
+            response = tuple(response[:2]) + (seq, stamp)
+        elif seq is not None:
+            response = tuple(response) + (seq,)
+        data = dumper(response)
+        if self.framed:
+            data = frame(data)
+        t1 = time.perf_counter()
+        with self._send_lock:
+            self.conn.sendall(data)
+        if trace:
+            # may run on a worker thread, see `respond`
+            trace.add('encode', t0, t1)
+            trace.add('send', t1, time.perf_counter())
+
+    def post(self, response, seq=None, trace=None, timestamp: bool = False, executed=None) -> None:
+        """Queue `response` for the sender thread, the arguments are those
+        of `send`. Responses posted after `close` are dropped."""
+        with self._outbox_lock:
+            if self._closed:
+                return
+            if self._outbox is None:
+                self._outbox = queue.Queue()
+                sender = threading.Thread(target=self._send_outbox, args=(self._outbox,),
+                                          name='sender %s' % (self.key))
+                sender.daemon = True
+                sender.start()
+            self._outbox.put((response, seq, trace, timestamp, executed))
+
+    def _send_outbox(self, outbox) -> None:
+        while True:
+            item = outbox.get()
+            if item is None:
+                return
+            try:
+                self.send(*item)
+            except OSError:
+                pass  # connection closed, drop the rest until `close`
+
+    def close(self) -> None:
+        """Stop the sender thread once it sent the responses posted so far."""
+        with self._outbox_lock:
+            self._closed = True
+            if self._outbox is not None:
+                self._outbox.put(None)
+
+    def stop_streams(self) -> None:
+        for stream in list(self.streams.values()):
+            stream.stop()
+        for feed, key in self.subscriptions:
+            feed.unsubscribe(key)
@@ -0,0 +1,198 @@
+import inspect
+
+from utils.exceptions import TEMValueError
+
+# public methods that must not be called over the network
+_EXCLUDE = ('release_connection',)
+
+# name prefixes of methods that only read the microscope state, unless
+# listed in `_READONLY`
+READONLY_PREFIXES = ('get', 'is')
+
+# read-only flag of the methods whose name does not tell
+_READONLY = {
+    # change nothing, but block for a long time, so they are not reads to
+    # stream, shed or retry
+    'planStageTour': False,
+    'waitForStage': False,
+}
+
+# getters of the state changed by a mutating method, where this can not be
+# derived from the name of the method (`setBeamShift` -> `getBeamShift`)
+_CHANGES = {
+    'setFunctionMode': ('getFunctionMode', 'getMagnification', 'getMagnificationIndex'),
+    'setMagnification': ('getMagnification', 'getMagnificationIndex'),
+    'setMagnificationIndex': ('getMagnification', 'getMagnificationIndex'),
+    'increaseMagnificationIndex': ('getMagnification', 'getMagnificationIndex'),
+    'decreaseMagnificationIndex': ('getMagnification', 'getMagnificationIndex'),
+    'setStagePosition': ('getStagePosition',),
+    'setStagePositionRelative': ('getStagePosition',),
+    'setStageA': ('getStagePosition',),
+    'setStageB': ('getStagePosition',),
+    'setStageX': ('getStagePosition',),
+    'setStageY': ('getStagePosition',),
+    'setStageZ': ('getStagePosition',),
+    'setStageXY': ('getStagePosition',),
+    'stopStage': ('getStagePosition',),
+    'setBeamBlank': ('isBeamBlanked',),
+    'setBeamUnblank': ('isBeamBlanked',),
+    'setBrightnessValue': ('getBrightness', 'getBrightnessValue'),
+    'setBrightness': ('getBrightness', 'getBrightnessValue'),
+    'setFocus': ('getFocus',),
+    'setDiffFocus': ('getDiffFocus',),
+    'setDiffFocusValue': ('getDiffFocus',),
+    'sweepFocus': ('getFocus', 'getDiffFocus'),
+    'rasterScan': ('getBeamShift', 'getImageShift1', 'getDiffShift'),
+    'calibrateRotationSpeed': ('getStagePosition',),
+    'visitStagePositions': ('getStagePosition',),
+    'planStageTour': (),
+    'waitForStage': (),
+    'setNeutral': ('getBeamShift', 'getBeamTilt', 'getImageShift1', 'getDiffShift'),
+}
+
+
+def _to_float(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+
+def _to_int(value):
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _to_bool(value):
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    return value
+
+
+# argument coercion for parameters annotated with these types, used to
+# repair values mangled by the protocol (e.g. json turning 1.0 into 1)
+_COERCERS = {
+    float: _to_float,
+    int: _to_int,
+    bool: _to_bool,
+}
+
+
+class Command:
+    """Entry of the dispatch table, wraps the bound method `func` of
+    microscope method `name` with its signature `sig`. `readonly` tells
+    if it only reads the microscope state, by default if the name starts
+    with one of `READONLY_PREFIXES`."""
+
+    def __init__(self, name: str, func, sig: inspect.Signature, readonly: bool = None):
+        self.name = name
+        self.func = func
+        self.readonly = name.startswith(READONLY_PREFIXES) if readonly is None else readonly
+
+        self.params = []
+        self.defaults = {}
+        self.varargs = False
+        nargs_min = 0
+        # parameters without a default, by position and keyword-only
+        self._required = []
+        self._required_kw = []
+        coerce = []
+        kwcoerce = {}
+
+        for param in sig.parameters.values():
+            if param.kind == param.VAR_POSITIONAL:
+                self.varargs = True
+                continue
+            if param.kind == param.VAR_KEYWORD:
+                continue
+            self.params.append(param.name)
+            if param.default is param.empty:
+                if param.kind == param.KEYWORD_ONLY:
+                    self._required_kw.append(param.name)
+                else:
+                    nargs_min += 1
+                    self._required.append(param.name)
+            else:
+                self.defaults[param.name] = param.default
+            coercer = _COERCERS.get(param.annotation)
+            if param.kind != param.KEYWORD_ONLY:
+                coerce.append(coercer)
+            if coercer:
+                kwcoerce[param.name] = coercer
+
+        self.nargs = (nargs_min, None if self.varargs else len(coerce))
+        # getters of the state the command may change, set by `build_table`
+        self.changes = ()
+        self.doc = (inspect.getdoc(func) or '').split('\n')[0]
+
+        # only keep the coercion step for methods that need it
+        self._coerce = tuple(coerce) if any(coerce) else None
+        self._kwcoerce = kwcoerce or None
+
+    def check(self, args, kwargs) -> None:
+        """Raise `TEMValueError` if the arguments do not match `nargs`
+        and the required parameters."""
+        nargs_max = self.nargs[1]
+        if nargs_max is not None and len(args) > nargs_max:
+            raise TEMValueError('%s takes at most %d positional arguments, got %d' % (
+                self.name, nargs_max, len(args)))
+        missing = [name for name in self._required[len(args):] + self._required_kw
+                   if not kwargs or name not in kwargs]
+        if missing:
+            raise TEMValueError('%s is missing the arguments: %s' % (self.name, ', '.join(missing)))
+
+    def __call__(self, args, kwargs):
+        self.check(args, kwargs)
+        if self._coerce:
+            args = [c(a) if c else a for c, a in zip(self._coerce, args)] + list(args[len(self._coerce):])
+        if self._kwcoerce and kwargs:
+            kwcoerce = self._kwcoerce
+            kwargs = {k: kwcoerce[k](v) if k in kwcoerce else v for k, v in kwargs.items()}
+        return self.func(*args, **kwargs)
+
+    def describe(self) -> dict:
+        """Return the signature of the command as a serializable dict."""
+        return {
+            'params': list(self.params),
+            'defaults': dict(self.defaults),
+            'nargs': list(self.nargs),
+            'varargs': self.varargs,
+            'readonly': self.readonly,
+            'changes': list(self.changes),
+            'doc': self.doc,
+        }
+
+
+def build_table(tem) -> dict:
+    """Build the dispatch table of the public methods of microscope `tem`.
+
+    The table maps the method name to its `Command`. It is built once at
+    startup, so calls do not need to look up the method by reflection.
+    """
+    table = {}
+    for name, member in inspect.getmembers(type(tem)):
+        if name.startswith('_') or name in _EXCLUDE:
+            continue
+        if not (inspect.isfunction(member) or inspect.ismethod(member)):
+            continue
+
+        func = getattr(tem, name)
+        try:
+            sig = inspect.signature(func)
+        except (TypeError, ValueError):
+            continue
+        table[name] = Command(name, func, sig, readonly=_READONLY.get(name))
+
+    for name, command in table.items():
+        if command.readonly:
+            continue
+        if name in _CHANGES:
+            getters = _CHANGES[name]
+        else:
+            field = name[3:] if name.startswith('set') else name
+            if field.endswith('Relative'):
+                field = field[:-len('Relative')]
+            getters = ('get' + field,)
+        command.changes = tuple(g for g in getters if g in table and not table[g].nargs[0])
+
+    return table
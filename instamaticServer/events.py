@@ -0,0 +1,126 @@
+import queue
+import threading
+import time
+
+# events buffered per subscriber before it is told to resync
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+# marks a field without a last value
+_MISSING = object()
+
+
+class Subscription(threading.Thread):
+    """Sends the events of a `ChangeFeed` to a client with `send(event)`.
+
+    Events are queued, so a slow client does not hold up the microscope
+    thread that publishes them. If the queue overflows, the events are
+    dropped and the client receives `{'resync': True, 'version': n}`, it
+    must then read the state again.
+    """
+
+    def __init__(self, send, maxsize: int = SUBSCRIBER_QUEUE_SIZE):
+        super().__init__()
+        self.daemon = True
+        self._send = send
+        self._q = queue.Queue(maxsize=maxsize)
+        self._overflow = False
+        self.stopped = threading.Event()
+
+    def put(self, event: dict) -> None:
+        if self._overflow:
+            return
+        try:
+            self._q.put_nowait(event)
+        except queue.Full:
+            self._overflow = True
+
+    def stop(self) -> None:
+        self.stopped.set()
+        try:
+            self._q.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                event = self._q.get()
+                if event is None:
+                    continue
+                if self._overflow:
+                    while not self._q.empty():
+                        event = self._q.get_nowait() or event
+                    self._overflow = False
+                    event = {'resync': True, 'version': event['version']}
+                self._send(event)
+        except OSError:
+            self.stopped.set()  # connection closed
+
+
+class ChangeFeed:
+    """State version and change events of one microscope instance.
+
+    `publish` is called after every mutating command. It increments the
+    state version and, if there are subscribers, sends them an event
+    with the fields that changed value since the last event:
+
+        {'version': 12, 'time': ..., 'command': 'setBeamShift',
+         'changes': {'BeamShift': (1.0, 2.0)}}
+    """
+
+    def __init__(self, instance: str = None):
+        self.instance = instance
+        self.version = 0
+        self._last = {}
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    @property
+    def has_subscribers(self) -> bool:
+        return bool(self._subscribers)
+
+    def subscribe(self, key, send) -> Subscription:
+        """Register `send` to receive the events under `key`."""
+        subscription = Subscription(send)
+        with self._lock:
+            self._subscribers[key] = subscription
+        subscription.start()
+        return subscription
+
+    def unsubscribe(self, key) -> bool:
+        with self._lock:
+            subscription = self._subscribers.pop(key, None)
+        if subscription is None:
+            return False
+        subscription.stop()
+        return True
+
+    def publish(self, command: str, read_changes) -> int:
+        """Bump the state version after `command`, `read_changes()` returns
+        the dict of the fields it may have changed and is only called if
+        there are subscribers. Returns the new version."""
+        with self._lock:
+            self.version += 1
+            version = self.version
+            subscribers = [s for s in self._subscribers.values() if not s.stopped.is_set()]
+
+        if not subscribers:
+            self._last.clear()
+            return version
+
+        changes = {}
+        for field, value in read_changes().items():
+            if self._last.get(field, _MISSING) != value:
+                changes[field] = value
+                self._last[field] = value
+
+        event = {
+            'version': version,
+            'time': time.time(),
+            'instance': self.instance,
+            'command': command,
+            'changes': changes,
+        }
+        for subscriber in subscribers:
+            subscriber.put(event)
+        return version
@@ -0,0 +1,429 @@
+"""Caching gateway for the tem_server.
+
+Runs on another host, accepts any number of client connections and
+forwards their requests over a single pipelined connection to the
+tem_server, so the microscope PC only serves one client:
+
+    python gateway.py --upstream 169.254.178.125:8088 --port 8088
+
+Clients connect to the gateway exactly as to the tem_server. Read-only
+commands without arguments are answered from a cache for up to
+`gateway_cache_ttl` s, and identical reads that arrive while one is on
+its way upstream wait for its result instead of being sent again. The
+cache is invalidated by the writes passing through the gateway, and by
+the change events (`__subscribe__`) of the commands of other clients of
+the tem_server. `__gateway__` returns the counters of the gateway.
+"""
+import queue
+import socket
+import threading
+import time
+
+from client import STATIC_COMMANDS, Connection as UpstreamConnection
+from connection import Connection
+from utils.config import config
+from utils.exceptions import TEMCommunicationError, TEMValueError
+
+_conf = config()
+HOST = _conf.default_settings.get('gateway_host', '0.0.0.0')
+PORT = _conf.default_settings.get('gateway_port', 8088)
+UPSTREAM_HOST = _conf.default_settings['tem_server_host']
+UPSTREAM_PORT = _conf.default_settings['tem_server_port']
+# s a cached read is served before it is read again
+CACHE_TTL = _conf.default_settings.get('gateway_cache_ttl', 0.1)
+
+# requests with these fields are always forwarded
+UNCACHED_FIELDS = ('stream', 'timestamp', 'trace')
+
+# answered asynchronously by the server, on framed connections with a `seq`
+ASYNC_COMMANDS = {
+    '__stream__': '__unstream__',
+    '__wait_until__': '__unstream__',
+    '__subscribe__': '__unsubscribe__',
+}
+
+# refer to an asynchronous request by its `seq`
+SEQ_COMMANDS = ('__unstream__', '__unsubscribe__')
+
+
+def error(e) -> tuple:
+    return (500, (e.__class__.__name__, e.args))
+
+
+class Upstream:
+    """Single framed connection to the tem_server shared by all clients.
+
+    Every request gets its own `seq`, and the responses are handed to the
+    handler of the request by a reader thread, so any number of requests
+    can be outstanding. The connection is re-established by the next
+    request after it was lost; outstanding requests then fail with
+    `TEMCommunicationError`.
+    """
+
+    def __init__(self, host: str = UPSTREAM_HOST, port: int = UPSTREAM_PORT, on_disconnect=None):
+        self.conn = UpstreamConnection(host, port, timeout=None)
+        self.on_disconnect = on_disconnect
+        self.requests = 0
+        self._seq = 0
+        self._handlers = {}
+        self._lock = threading.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self.conn.connected
+
+    def send(self, request: dict, handler) -> int:
+        """Send `request`, `handler(response)` is called on the reader
+        thread with every message for it. Returns the upstream `seq`."""
+        with self._lock:
+            if not self.conn.connected:
+                try:
+                    self.conn.connect()
+                except OSError as e:
+                    raise TEMCommunicationError('Cannot connect to tem_server at %s:%s: %s' % (
+                        self.conn.host, self.conn.port, e))
+                reader = threading.Thread(target=self._read_loop, args=(self.conn.sock,))
+                reader.daemon = True
+                reader.start()
+            self._seq += 1
+            seq = self._seq
+            self._handlers[seq] = handler
+            request = dict(request, seq=seq)
+            try:
+                self.conn.send(request)
+            except OSError as e:
+                self._handlers.pop(seq, None)
+                raise TEMCommunicationError('Lost connection to tem_server: %s' % (e))
+            self.requests += 1
+        return seq
+
+    def call(self, request: dict, on_progress=None):
+        """Send `request` and wait for its final response, `on_progress`
+        is called with the (102, ...) messages received before."""
+        done = queue.Queue()
+
+        def handler(response):
+            if response[0] == 102:
+                if on_progress:
+                    on_progress(response)
+            else:
+                done.put(response)
+
+        self.send(request, handler)
+        return done.get()
+
+    def _read_loop(self, sock) -> None:
+        try:
+            while True:
+                response = self.conn.receive()
+                seq = response[2]
+                with self._lock:
+                    if response[0] == 102:
+                        handler = self._handlers.get(seq)
+                    else:
+                        handler = self._handlers.pop(seq, None)
+                if handler is not None:
+                    handler(response)
+        except Exception as e:
+            print('Upstream connection lost: %s' % (e))
+
+        with self._lock:
+            if self.conn.sock is sock:
+                self.conn.close()
+            handlers, self._handlers = self._handlers, {}
+        for seq, handler in handlers.items():
+            handler(error(TEMCommunicationError('Lost connection to tem_server')) + (seq,))
+        if self.on_disconnect:
+            self.on_disconnect()
+
+
+class Gateway:
+    """Cache of the reads of the tem_server behind `upstream`.
+
+    Read-only commands without arguments, according to the `__methods__`
+    of the server, are cached for `ttl` s, the `STATIC_COMMANDS` for as
+    long as the connection lasts. A write invalidates the getters listed
+    in its `changes`, or the whole cache of the microscope instance if
+    they are not known.
+    """
+
+    def __init__(self, upstream: Upstream, ttl: float = CACHE_TTL):
+        self.upstream = upstream
+        self.ttl = ttl
+        self.clients = 0
+        self.counters = {'requests': 0, 'cache_hits': 0, 'coalesced': 0, 'invalidations': 0}
+        self._cache = {}
+        self._inflight = {}
+        self._methods = {}
+        self._generation = {}
+        self._subscribed = set()
+        self._lock = threading.Lock()
+        upstream.on_disconnect = self.reset
+
+    def status(self) -> dict:
+        status = dict(self.counters)
+        status.update({
+            'clients': self.clients,
+            'upstream_connected': self.upstream.connected,
+            'upstream_requests': self.upstream.requests,
+            'cached': len(self._cache),
+        })
+        return status
+
+    def count(self, counter: str, n: int = 1) -> None:
+        """Add `n` to `counter`, from any client thread."""
+        with self._lock:
+            if counter == 'clients':
+                self.clients += n
+            else:
+                self.counters[counter] += n
+
+    def reset(self) -> None:
+        """Forget everything learned over the upstream connection."""
+        with self._lock:
+            self._cache.clear()
+            self._methods.clear()
+            self._subscribed.clear()
+            for microscope in self._generation:
+                self._generation[microscope] += 1
+
+    def methods(self, microscope) -> dict:
+        """Return the `__methods__` table of `microscope`, empty while the
+        server is not ready."""
+        methods = self._methods.get(microscope)
+        if methods is None:
+            status, value = self.upstream.call({'func_name': '__methods__', 'microscope': microscope})[:2]
+            methods = value if status == 200 else {}
+            if methods:
+                self._methods[microscope] = methods
+        return methods
+
+    def ttl_for(self, request: dict):
+        """Return how long the result of `request` may be cached, None if not."""
+        if any(request.get(field) for field in UNCACHED_FIELDS):
+            return None
+        func_name = request.get('func_name')
+        if func_name in STATIC_COMMANDS:
+            return float('inf')
+        if func_name.startswith('__') or request.get('args') or request.get('kwargs'):
+            return None
+        info = self.methods(request.get('microscope')).get(func_name)
+        if info and info['readonly']:
+            return self.ttl
+        return None
+
+    def read(self, request: dict, ttl: float):
+        """Return the response to the read `request`, from the cache if it
+        is younger than `ttl` s, or else from the identical request in
+        flight, or else from the server."""
+        microscope = request.get('microscope')
+        key = (microscope, request['func_name'], repr(request.get('args', ())),
+               repr(sorted(request.get('kwargs', {}).items())))
+        self.subscribe(microscope)
+
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and time.perf_counter() - cached[0] <= ttl:
+                self.counters['cache_hits'] += 1
+                return cached[1]
+            waiters = self._inflight.get(key)
+            if waiters is not None:
+                self.counters['coalesced'] += 1
+                waiter = queue.Queue()
+                waiters.append(waiter)
+            else:
+                waiter = None
+                self._inflight[key] = []
+                generation = self._generation.setdefault(microscope, 0)
+
+        if waiter is not None:
+            return waiter.get()
+
+        t0 = time.perf_counter()
+        try:
+            response = self.upstream.call(request)
+        except Exception as e:
+            response = error(e)
+        with self._lock:
+            waiters = self._inflight.pop(key)
+            # not cached if a write may have happened meanwhile, nor static
+            # results the server cannot give yet
+            cacheable = response[0] == 200 and (response[1] or ttl != float('inf'))
+            if cacheable and self._generation[microscope] == generation:
+                self._cache[key] = (t0, response)
+        for waiter in waiters:
+            waiter.put(response)
+        return response
+
+    def invalidate(self, microscope, getters=None) -> None:
+        """Drop the cached results of `getters` of `microscope`, or all of
+        them, except the static ones."""
+        with self._lock:
+            self.counters['invalidations'] += 1
+            self._generation[microscope] = self._generation.get(microscope, 0) + 1
+            for key in list(self._cache):
+                if key[0] != microscope or key[1] in STATIC_COMMANDS:
+                    continue
+                if getters is None or key[1] in getters:
+                    del self._cache[key]
+
+    def written(self, microscope, func_name: str) -> None:
+        """Invalidate the cache after the mutating command `func_name`."""
+        info = self._methods.get(microscope, {}).get(func_name)
+        if info is None:
+            if func_name.startswith('__') and func_name not in ('__run_macro__',):
+                return  # server commands, e.g. `__ping__`
+            self.invalidate(microscope)
+        elif not info['readonly']:
+            self.invalidate(microscope, info['changes'])
+
+    def subscribe(self, microscope) -> None:
+        """Subscribe to the change events of `microscope`, once."""
+        with self._lock:
+            if microscope in self._subscribed:
+                return
+            self._subscribed.add(microscope)
+        try:
+            self.upstream.send({'func_name': '__subscribe__', 'microscope': microscope},
+                               lambda response: self._on_event(microscope, response))
+        except TEMCommunicationError:
+            with self._lock:
+                self._subscribed.discard(microscope)
+
+    def _on_event(self, microscope, response) -> None:
+        status, event = response[:2]
+        if status != 102:
+            # the subscription ended or failed
+            with self._lock:
+                self._subscribed.discard(microscope)
+            self.invalidate(microscope)
+            return
+        self.written(microscope, event.get('command') or '')
+
+
+def forward(connection, seq, response) -> None:
+    """Post the upstream `response` to the client `connection` with the
+    client's `seq`. Called on the upstream reader thread, which must not
+    wait for a slow client."""
+    status, value = response[:2]
+    extra = tuple(response[3:])
+    if extra:
+        # timestamped, (status, value, seq, (start, end))
+        connection.post((status, value, seq) + extra)
+    else:
+        connection.post((status, value), seq)
+
+
+def handle(conn, gateway: Gateway):
+    """Forward the requests of the client `conn` through `gateway`.
+
+    Requests are answered one at a time, except the asynchronous ones
+    of framed clients with a `seq` (`ASYNC_COMMANDS`), which are stopped
+    when the client disconnects."""
+    connection = Connection(conn)
+    upstream = gateway.upstream
+    # client seq -> (upstream seq, microscope, command to stop it)
+    active = {}
+    gateway.count('clients')
+    with conn:
+        try:
+            _handle(connection, gateway, active)
+        except OSError:
+            pass  # connection closed
+        finally:
+            connection.close()
+            gateway.count('clients', -1)
+            for useq, microscope, stop in list(active.values()):
+                try:
+                    upstream.send({'func_name': stop, 'args': (useq,), 'microscope': microscope},
+                                  lambda response: None)
+                except TEMCommunicationError:
+                    pass
+
+
+def _handle(connection, gateway: Gateway, active: dict):
+    upstream = gateway.upstream
+    while True:
+        try:
+            data = connection.receive()
+        except TEMValueError as e:
+            connection.post(error(e))
+            continue
+        if data is None or data in ('exit', 'kill'):
+            break
+
+        gateway.count('requests')
+        seq = data.get('seq')
+        func_name = data.get('func_name')
+        microscope = data.get('microscope')
+
+        if func_name == '__gateway__':
+            connection.post((200, gateway.status()), seq)
+            continue
+
+        # the server sees the gateway as a single client
+        request = {k: v for k, v in data.items() if k not in ('seq', 'client')}
+
+        if func_name in SEQ_COMMANDS:
+            args = tuple(data.get('args', (None,)))
+            entry = active.get(args[0] if args else None)
+            request['args'] = (entry[0] if entry else None,) + args[1:]
+
+        try:
+            ttl = gateway.ttl_for(request)
+            if ttl is not None:
+                forward(connection, seq, gateway.read(request, ttl))
+                continue
+
+            if func_name in ASYNC_COMMANDS and connection.framed and seq is not None:
+                def handler(response, seq=seq):
+                    if response[0] != 102:
+                        active.pop(seq, None)
+                    forward(connection, seq, response)
+                useq = upstream.send(request, handler)
+                active[seq] = (useq, microscope, ASYNC_COMMANDS[func_name])
+                continue
+
+            response = upstream.call(request, on_progress=lambda message: forward(connection, seq, message))
+        except TEMCommunicationError as e:
+            response = error(e)
+        # also after errors, a failed move may have moved
+        gateway.written(microscope, func_name)
+
+        forward(connection, seq, response)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default=HOST,
+                        help='Address to listen on (default: %(default)s).')
+    parser.add_argument('--port', type=int, default=PORT,
+                        help='Port to listen on (default: %(default)s).')
+    parser.add_argument('--upstream', default='%s:%s' % (UPSTREAM_HOST, UPSTREAM_PORT),
+                        help='HOST:PORT of the tem_server (default: %(default)s).')
+    parser.add_argument('--ttl', type=float, default=CACHE_TTL,
+                        help='s a read is served from the cache (default: %(default)s).')
+    options = parser.parse_args()
+
+    host, port = options.upstream.rsplit(':', 1)
+    gateway = Gateway(Upstream(host, int(port)), ttl=options.ttl)
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((options.host, options.port))
+    s.listen(0)
+    print('Gateway listening on %s:%s, forwarding to %s' % (options.host, options.port, options.upstream))
+
+    with s:
+        while True:
+            conn, addr = s.accept()
+            thread = threading.Thread(target=handle, args=(conn, gateway))
+            thread.daemon = True
+            thread.start()
+
+
+if __name__ == '__main__':
+    main()
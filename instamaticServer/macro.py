@@ -0,0 +1,203 @@
+import operator
+import time
+from pathlib import Path
+
+import yaml
+
+from utils.exceptions import TEMValueError
+
+_macro_file = 'macros.yaml'
+
+MAX_ITERATIONS = 10000
+
+_OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda a, b: a in b,
+    'not in': lambda a, b: a not in b,
+}
+
+_STEP_KEYS = ('call', 'wait', 'repeat', 'while', 'if', 'macro')
+
+
+def load_macros() -> dict:
+    """Load the named macros stored in `utils/macros.yaml`."""
+    file = Path(__file__).resolve().parent.joinpath('utils', _macro_file)
+    if not file.exists():
+        return {}
+    with open(str(file), 'r') as stream:
+        macros = yaml.safe_load(stream) or {}
+    for name, steps in macros.items():
+        validate(steps)
+    return macros
+
+
+def validate(steps: list) -> None:
+    """Check the structure of the macro `steps`, raise TEMValueError if
+    it is invalid."""
+    if not isinstance(steps, (list, tuple)):
+        raise TEMValueError('A macro must be a list of steps, got: %r' % (steps,))
+
+    for step in steps:
+        if not isinstance(step, dict):
+            raise TEMValueError('A macro step must be a dict, got: %r' % (step,))
+        kinds = [key for key in _STEP_KEYS if key in step]
+        if len(kinds) != 1:
+            raise TEMValueError('A macro step needs exactly one of %s, got: %r' % (_STEP_KEYS, step))
+        kind = kinds[0]
+        if kind == 'call' and step['call'] == '__run_macro__':
+            # would start a new runner, not limited by the nesting depth
+            raise TEMValueError('A macro can not call __run_macro__, use a `macro` step.')
+        if kind in ('while', 'if'):
+            _check_condition(step[kind])
+        if kind in ('repeat', 'while'):
+            validate(step.get('steps', ()))
+        if kind == 'if':
+            validate(step.get('then', ()))
+            validate(step.get('else', ()))
+
+
+def _check_condition(cond: dict) -> None:
+    if not isinstance(cond, dict) or 'var' not in cond:
+        raise TEMValueError('A macro condition must be a dict with `var`, got: %r' % (cond,))
+    if cond.get('op', '==') not in _OPERATORS:
+        raise TEMValueError('No such operator: %s' % (cond.get('op'),))
+
+
+class MacroCancelled(Exception):
+    pass
+
+
+class MacroRunner:
+    """Runs a macro, a list of steps, through `evaluate(func_name, args, kwargs)`.
+
+    The steps are dicts of one of these kinds:
+
+        {call: setBeamBlank, args: [true], kwargs: {}, store: name, index: 0}
+            call a microscope method, optionally store its result (or the
+            item `index` of it) as variable `name`
+        {wait: 0.5}
+            wait for the given time in s
+        {repeat: 3, var: i, steps: [...]}
+            run the steps n times, the counter is stored as `var`
+        {while: <condition>, steps: [...], max: 100}
+            run the steps as long as the condition holds
+        {if: <condition>, then: [...], else: [...]}
+            run `then` if the condition holds, else `else`
+        {macro: name}
+            run the stored macro `name`, macros nest up to 16 deep
+
+    A condition is a dict `{var: name, op: '<', value: 30, index: 3}`
+    comparing a variable (or its item `index`) to a value, the operators
+    are ==, !=, <, <=, >, >=, in, not in. Strings like `$name` in the
+    arguments and values are replaced by the variable `name`.
+
+    `progress` is called with a dict after every call, `cancel_event`
+    stops the macro before the next step once set.
+    """
+
+    def __init__(self, evaluate, macros: dict = None, progress=None, cancel_event=None):
+        self._evaluate = evaluate
+        self._macros = macros or {}
+        self._progress = progress
+        self._cancel_event = cancel_event
+        self.variables = {}
+        self.calls = 0
+
+    def run(self, steps: list, variables: dict = None) -> dict:
+        """Run `steps`, return the variables, number of calls, and whether
+        the macro was cancelled."""
+        validate(steps)
+        self.variables = dict(variables or {})
+        self.calls = 0
+        cancelled = False
+        try:
+            self._run(steps, depth=0)
+        except MacroCancelled:
+            cancelled = True
+
+        return {
+            'variables': self.variables,
+            'calls': self.calls,
+            'cancelled': cancelled,
+        }
+
+    def _resolve(self, value):
+        if isinstance(value, str) and value.startswith('$'):
+            try:
+                return self.variables[value[1:]]
+            except KeyError:
+                raise TEMValueError('Undefined macro variable: %s' % (value,))
+        if isinstance(value, (list, tuple)):
+            return [self._resolve(v) for v in value]
+        if isinstance(value, dict):
+            return {k: self._resolve(v) for k, v in value.items()}
+        return value
+
+    def _test(self, cond: dict) -> bool:
+        value = self._resolve('$' + cond['var'])
+        if 'index' in cond:
+            value = value[cond['index']]
+        op = _OPERATORS[cond.get('op', '==')]
+        return op(value, self._resolve(cond.get('value')))
+
+    def _check_cancel(self) -> None:
+        if self._cancel_event is not None and self._cancel_event.is_set():
+            raise MacroCancelled
+
+    def _run(self, steps: list, depth: int) -> None:
+        if depth > 16:
+            raise TEMValueError('Macros nested too deeply.')
+
+        for step in steps:
+            self._check_cancel()
+
+            if 'call' in step:
+                func_name = step['call']
+                args = self._resolve(step.get('args', ()))
+                kwargs = self._resolve(step.get('kwargs', {}))
+                ret = self._evaluate(func_name, args, kwargs)
+                self.calls += 1
+                if 'store' in step:
+                    self.variables[step['store']] = ret[step['index']] if 'index' in step else ret
+                if self._progress:
+                    self._progress({'call': func_name, 'calls': self.calls, 'result': ret})
+
+            elif 'wait' in step:
+                delay = float(self._resolve(step['wait']))
+                if self._cancel_event is not None:
+                    if self._cancel_event.wait(delay):
+                        raise MacroCancelled
+                else:
+                    time.sleep(delay)
+
+            elif 'repeat' in step:
+                var = step.get('var')
+                for i in range(int(self._resolve(step['repeat']))):
+                    if var:
+                        self.variables[var] = i
+                    self._run(step.get('steps', ()), depth + 1)
+
+            elif 'while' in step:
+                n = 0
+                max_iterations = step.get('max', MAX_ITERATIONS)
+                while self._test(step['while']):
+                    if n >= max_iterations:
+                        raise TEMValueError('Macro loop exceeded %s iterations.' % (max_iterations,))
+                    self._run(step.get('steps', ()), depth + 1)
+                    n += 1
+
+            elif 'if' in step:
+                branch = 'then' if self._test(step['if']) else 'else'
+                self._run(step.get(branch, ()), depth + 1)
+
+            elif 'macro' in step:
+                try:
+                    macro = self._macros[step['macro']]
+                except KeyError:
+                    raise TEMValueError('No such macro: %s' % (step['macro'],))
+                self._run(macro, depth + 1)
@@ -0,0 +1,60 @@
+import threading
+import time
+
+
+class Metrics:
+    """Command counters shared by all microscope instances of a server.
+
+    Every worker reports each executed command with `record`, the
+    counters are kept per instance and can be read with `snapshot`.
+    The connection handlers count the open connections.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._instances = {}
+        self.t_start = time.time()
+        self.connections = 0
+        self.connections_total = 0
+
+    @property
+    def uptime(self) -> float:
+        return time.time() - self.t_start
+
+    def connection_opened(self) -> None:
+        with self._lock:
+            self.connections += 1
+            self.connections_total += 1
+
+    def connection_closed(self) -> None:
+        with self._lock:
+            self.connections -= 1
+
+    def _get(self, instance: str) -> dict:
+        try:
+            return self._instances[instance]
+        except KeyError:
+            d = {
+                'commands': 0,
+                'errors': 0,
+                'busy_time': 0.0,
+                'max_time': 0.0,
+            }
+            self._instances[instance] = d
+            return d
+
+    def record(self, instance: str, duration: float, error: bool = False) -> None:
+        """Add one command on `instance` that took `duration` seconds."""
+        with self._lock:
+            d = self._get(instance)
+            d['commands'] += 1
+            d['busy_time'] += duration
+            if duration > d['max_time']:
+                d['max_time'] = duration
+            if error:
+                d['errors'] += 1
+
+    def snapshot(self) -> dict:
+        """Return a copy of the counters per instance."""
+        with self._lock:
+            return {name: dict(d) for name, d in self._instances.items()}
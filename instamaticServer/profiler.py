@@ -0,0 +1,164 @@
+import collections
+import marshal
+import os
+import sys
+import threading
+import time
+
+# s between two samples of the stacks of all threads
+SAMPLE_INTERVAL = 0.01
+# s after which a profile stops sampling if it is not stopped
+MAX_DURATION = 600.0
+
+
+def _frame_key(frame) -> tuple:
+    code = frame.f_code
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+def _stack(frame) -> tuple:
+    """Return the functions of the stack of `frame`, outermost first."""
+    stack = []
+    while frame is not None:
+        stack.append(_frame_key(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+
+class SamplingProfiler:
+    """Statistical profiler of the server threads, started and stopped on
+    demand.
+
+    While running, a thread takes the stacks of the other threads with
+    `sys._current_frames` every `interval` s and counts the identical
+    ones, labelled by `label(thread)`. Nothing is installed in the
+    threads, so there is no overhead when the profiler is not running
+    and little while it is. `threads` limits the sampling to the threads
+    whose label starts with one of the given prefixes.
+
+    The result is available in the collapsed-stack format of
+    flamegraph.pl and speedscope, or as marshalled `pstats` data, with
+    the number of samples standing in for the call counts.
+    """
+
+    def __init__(self, label=None):
+        self.label = label or (lambda thread: thread.name)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop_event = None
+        self._counts = collections.Counter()
+        self.samples = 0
+        self.interval = SAMPLE_INTERVAL
+        self.t_start = None
+        self.t_stop = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: float = SAMPLE_INTERVAL, threads: list = None,
+              duration: float = MAX_DURATION) -> bool:
+        """Start sampling, the samples of a previous run are discarded.
+        Returns False if it was already running."""
+        with self._lock:
+            if self.running:
+                return False
+            self._counts = collections.Counter()
+            self.samples = 0
+            self.interval = float(interval)
+            self.t_start = time.time()
+            self.t_stop = None
+            self._stop_event = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='profiler',
+                                            args=(self._stop_event, tuple(threads or ()), duration))
+            self._thread.daemon = True
+            self._thread.start()
+        return True
+
+    def stop(self) -> bool:
+        """Stop sampling, returns False if it was not running."""
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return False
+            self._stop_event.set()
+            self._thread = None
+        thread.join()
+        return True
+
+    def _run(self, stop_event, prefixes: tuple, duration: float) -> None:
+        me = threading.get_ident()
+        t_end = time.perf_counter() + duration
+        t_next = time.perf_counter()
+        counts = self._counts
+        while not stop_event.is_set():
+            labels = {}
+            for thread in threading.enumerate():
+                label = self.label(thread)
+                if not prefixes or label.startswith(prefixes):
+                    labels[thread.ident] = label
+            frames = sys._current_frames()
+            for ident, label in labels.items():
+                if ident != me and ident in frames:
+                    counts[(label,) + _stack(frames[ident])] += 1
+            del frames
+            self.samples += 1
+
+            t_next += self.interval
+            now = time.perf_counter()
+            if now > t_end:
+                break
+            stop_event.wait(max(0.0, t_next - now))
+        self.t_stop = time.time()
+
+    def summary(self) -> dict:
+        return {
+            'running': self.running,
+            'samples': self.samples,
+            'interval': self.interval,
+            'start': self.t_start,
+            'stop': self.t_stop,
+            'stacks': len(self._counts),
+        }
+
+    def collapsed(self) -> str:
+        """Return the samples as collapsed stacks, one `thread;outer;...;inner
+        count` line per distinct stack."""
+        lines = []
+        for stack, count in sorted(self._counts.copy().items(), key=lambda item: -item[1]):
+            names = [stack[0]] + ['%s (%s:%d)' % (name, os.path.basename(filename), line)
+                                  for filename, line, name in stack[1:]]
+            lines.append('%s %d' % (';'.join(name.replace(';', ':') for name in names), count))
+        return '\n'.join(lines) + '\n'
+
+    def pstats(self) -> bytes:
+        """Return the samples as marshalled `pstats` data, save it to a file
+        and open it with `pstats.Stats(path)` or snakeviz. Times are
+        samples * interval, the call counts are sample counts."""
+        dt = self.interval
+        # function: [samples, own samples, time, own time, callers]
+        stats = {}
+        for stack, count in self._counts.copy().items():
+            functions = stack[1:]
+            seen = set()
+            for i, func in enumerate(functions):
+                entry = stats.get(func)
+                if entry is None:
+                    entry = stats[func] = [0, 0, 0.0, 0.0, {}]
+                if func not in seen:
+                    # recursion counts once for the cumulative time
+                    seen.add(func)
+                    entry[0] += count
+                    entry[2] += count * dt
+                if i == len(functions) - 1:
+                    entry[1] += count
+                    entry[3] += count * dt
+                if i > 0:
+                    caller = functions[i - 1]
+                    c = entry[4].get(caller, (0, 0, 0.0, 0.0))
+                    own = count * dt if i == len(functions) - 1 else 0.0
+                    entry[4][caller] = (c[0] + count, c[1] + count, c[2] + own, c[3] + count * dt)
+        data = {func: (n, n, own_time, cum_time, callers)
+                for func, (n, own, cum_time, own_time, callers) in stats.items()}
+        return marshal.dumps(data)
@@ -0,0 +1,111 @@
+import collections
+import functools
+import threading
+
+from utils.config import config
+
+# responses kept per instance for requests with a `request_id`
+RESULT_CACHE_SIZE = config().default_settings.get('tem_server_result_cache', 1000)
+
+
+class _Entry:
+    __slots__ = ('func_name', 'replies', 'response', 'executed')
+
+    def __init__(self, func_name: str):
+        self.func_name = func_name
+        self.replies = []
+        self.response = None
+        self.executed = None
+
+
+class ResultCache:
+    """Bounded LRU of the responses to requests with a client-generated
+    `request_id`, so that a client that timed out can retry a command
+    without running it twice.
+
+    `submit` is called with the `tem_server.Reply` of every such request.
+    The first one with an ID is run; a retry while it is still queued or
+    running is attached to it and gets the same response, a later retry
+    gets the recorded response. Only completed entries are evicted, the
+    oldest first. Rejected requests (`TEMServerBusyError`) are not kept,
+    so they can be retried.
+    """
+
+    def __init__(self, maxlen: int = RESULT_CACHE_SIZE):
+        self.maxlen = maxlen
+        self.hits = 0
+        self.attached = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {'size': len(self._entries), 'hits': self.hits, 'attached': self.attached}
+
+    def submit(self, request_id, func_name: str, reply, job) -> bool:
+        """Attach `reply` to the request `request_id` for `func_name`.
+
+        Returns True if the request is new and `job`, a `Reply` whose
+        response is recorded and passed on to `reply`, must be put on the
+        queue, or False if `reply` is answered by an earlier run.
+        """
+        with self._lock:
+            entry = self._entries.get(request_id)
+            if entry is not None:
+                self._entries.move_to_end(request_id)
+                if entry.func_name != func_name:
+                    response = (500, ('TEMValueError', ('request_id %r was used for %s, not %s' % (
+                        request_id, entry.func_name, func_name),)))
+                elif entry.response is None:
+                    self.attached += 1
+                    entry.replies.append(reply)
+                    return False
+                else:
+                    self.hits += 1
+                    response = entry.response
+                    reply.executed = entry.executed
+            else:
+                entry = self._entries[request_id] = _Entry(func_name)
+                entry.replies.append(reply)
+                self._evict()
+                response = None
+
+        if response is not None:
+            reply.set(response)
+            return False
+
+        job.callback = functools.partial(self._complete, request_id, job)
+        job.on_progress = reply.progress
+        return True
+
+    def _evict(self) -> None:
+        excess = len(self._entries) - self.maxlen
+        if excess <= 0:
+            return
+        done = []
+        for request_id, entry in self._entries.items():
+            if entry.response is not None:
+                done.append(request_id)
+                if len(done) == excess:
+                    break
+        for request_id in done:
+            del self._entries[request_id]
+
+    def _complete(self, request_id, job, response) -> None:
+        status, value = response[:2]
+        busy = status == 500 and value[0] == 'TEMServerBusyError'
+        with self._lock:
+            entry = self._entries.get(request_id)
+            if entry is None:
+                return
+            replies, entry.replies = entry.replies, []
+            if busy:
+                del self._entries[request_id]
+            else:
+                entry.response = response
+                entry.executed = job.executed
+        for reply in replies:
+            reply.executed = job.executed
+            reply.set(response)
@@ -0,0 +1,171 @@
+import collections
+import threading
+import time
+
+from utils.exceptions import TEMServerBusyError
+
+# commands queued per connection before `put` blocks
+QUEUE_SIZE = 100
+
+# key of the commands put on the queue by the server itself (e.g. telemetry)
+SERVER_KEY = '(server)'
+
+
+class TokenBucket:
+    """Rate limit of `rate` commands per s with bursts of up to `burst`."""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, rate))
+        self.tokens = self.burst
+        self.t = time.perf_counter()
+
+    def reserve(self) -> float:
+        """Take a token and return the time in s until it is available."""
+        now = time.perf_counter()
+        self.tokens = min(self.burst, self.tokens + (now - self.t) * self.rate)
+        self.t = now
+        self.tokens -= 1.0
+        return max(0.0, -self.tokens / self.rate)
+
+    def refund(self) -> None:
+        self.tokens += 1.0
+
+
+class _ClientQueue:
+    """Commands of one connection, with the settings of its client."""
+
+    def __init__(self, key: str, client: str, weight: float = 1.0, bucket: TokenBucket = None):
+        self.key = key
+        self.client = client
+        self.weight = float(weight)
+        self.bucket = bucket
+        self.items = collections.deque()
+        self.last_tag = 0.0
+        self.closed = False
+        self.served = 0
+        self.shed = 0
+        self.max_depth = 0
+
+    def stats(self) -> dict:
+        return {
+            'client': self.client,
+            'weight': self.weight,
+            'depth': len(self.items),
+            'max_depth': self.max_depth,
+            'served': self.served,
+            'shed': self.shed,
+        }
+
+
+class FairQueue:
+    """Command queue of a microscope instance that is shared fairly
+    between the connections.
+
+    Every connection has its own sub-queue of up to `maxsize` commands,
+    and the sub-queues are served by weighted fair queuing. Each command
+    gets a virtual finish time of 1/weight after the previous command of
+    its connection, or after the current virtual time if the connection
+    was idle, and `get` returns the command with the earliest one. A
+    connection polling at a high rate therefore only delays the others
+    by one command at a time.
+
+    `clients` maps a client name (the `client` field of the requests,
+    or else the address of the peer) to a dict with its `weight`, and
+    optionally a `rate` limit in commands per s with a `burst` size,
+    shared by all connections of the client; the `default` entry
+    applies to unlisted clients. A command over the rate
+    limit is delayed, or, with `shed_reads`, rejected with
+    `TEMServerBusyError` if it only reads the microscope state. With
+    `shed_reads` read-only commands are also rejected instead of
+    blocking when the sub-queue is full.
+    """
+
+    def __init__(self, maxsize: int = QUEUE_SIZE, clients: dict = None, shed_reads: bool = False):
+        self.maxsize = maxsize
+        self.clients = dict(clients or {})
+        self.shed_reads = shed_reads
+        self._queues = {}
+        self._buckets = {}
+        self._vtime = 0.0
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def _client_queue(self, key: str, client: str) -> _ClientQueue:
+        cq = self._queues.get(key)
+        if cq is None:
+            settings = self.clients.get(client) or self.clients.get('default') or {}
+            bucket = self._buckets.get(client)
+            if bucket is None and settings.get('rate'):
+                bucket = self._buckets[client] = TokenBucket(settings['rate'], settings.get('burst'))
+            cq = _ClientQueue(key, client, weight=settings.get('weight', 1.0), bucket=bucket)
+            self._queues[key] = cq
+        return cq
+
+    def _reject(self, cq: _ClientQueue, reason: str):
+        cq.shed += 1
+        raise TEMServerBusyError('Server busy, %s for client %s' % (reason, cq.client))
+
+    def put(self, item, key: str = SERVER_KEY, client: str = None, readonly: bool = False) -> None:
+        """Queue `item` for the connection `key` of `client`, blocks while
+        its sub-queue is full or its rate limit is exceeded."""
+        with self._cond:
+            cq = self._client_queue(key, client or key)
+            delay = cq.bucket.reserve() if cq.bucket else 0.0
+            if delay and readonly and self.shed_reads:
+                cq.bucket.refund()
+                self._reject(cq, 'rate limit exceeded')
+
+        if delay:
+            time.sleep(delay)
+
+        with self._cond:
+            # `close` drops the sub-queue when it is empty, also while the lock was released
+            cq = self._queues.setdefault(key, cq)
+            while len(cq.items) >= self.maxsize:
+                if readonly and self.shed_reads:
+                    self._reject(cq, 'queue full')
+                self._cond.wait()
+                cq = self._queues.setdefault(key, cq)
+            tag = max(self._vtime, cq.last_tag) + 1.0 / cq.weight
+            cq.last_tag = tag
+            cq.items.append((tag, item))
+            cq.closed = False
+            if len(cq.items) > cq.max_depth:
+                cq.max_depth = len(cq.items)
+            self._size += 1
+            self._cond.notify_all()
+
+    def get(self):
+        """Remove and return the command with the earliest finish time."""
+        with self._cond:
+            while not self._size:
+                self._cond.wait()
+            cq = min((cq for cq in self._queues.values() if cq.items), key=lambda cq: cq.items[0][0])
+            tag, item = cq.items.popleft()
+            self._vtime = tag
+            self._size -= 1
+            cq.served += 1
+            if cq.closed and not cq.items:
+                del self._queues[cq.key]
+            self._cond.notify_all()
+            return item
+
+    def close(self, key: str) -> None:
+        """Forget the sub-queue of the closed connection `key` once it is empty."""
+        with self._cond:
+            cq = self._queues.get(key)
+            if cq is None:
+                return
+            if cq.items:
+                cq.closed = True
+            else:
+                del self._queues[key]
+
+    def qsize(self) -> int:
+        return self._size
+
+    def stats(self) -> dict:
+        """Return the queue depth and counters per connection."""
+        with self._cond:
+            return {key: cq.stats() for key, cq in self._queues.items()}
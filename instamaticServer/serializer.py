@@ -1,5 +1,7 @@
 import json
 import pickle
+import re
+import struct
 
 from utils.config import config
 
@@ -19,6 +21,28 @@ def json_loader(data):
 def json_dumper(data):
     return json.dumps(data).encode()
 
+# the part of a number that `json` did not parse yet ('1.' is parsed as 1)
+_NUMBER_END = re.compile(r'-?\d*(\.\d*)?([eE][-+]?\d*)?$')
+
+def json_truncated(error, data):
+    if isinstance(error, UnicodeDecodeError):
+        return error.reason == 'unexpected end of data'
+    message = str(error)
+    if message.startswith('Unterminated string'):
+        return True
+    match = re.search(r'\(char (\d+)\)$', message)
+    if match is None:
+        return False
+    pos = int(match.group(1))
+    doc = data.decode()
+    if message.startswith('Invalid \\uXXXX escape'):
+        return len(doc) - pos < 6
+    # the rest is the start of a literal or number
+    rest = doc[pos:].rstrip()
+    return message.startswith('Expecting') and (
+        any(literal.startswith(rest) for literal in ('null', 'true', 'false'))
+        or _NUMBER_END.match(rest) is not None)
+
 
 def pickle_loader(data):
     return pickle.loads(data)
@@ -26,6 +50,10 @@ def pickle_loader(data):
 def pickle_dumper(data):
     return pickle.dumps(data)
 
+def pickle_truncated(error, data):
+    return isinstance(error, EOFError) or (
+        isinstance(error, pickle.UnpicklingError) and 'truncated' in str(error))
+
 
 try:
     import msgpack
@@ -39,16 +67,36 @@ else:
     def msgpack_dumper(data):
         return msgpack.dumps(data)
 
+    def msgpack_truncated(error, data):
+        return error.__class__.__name__ == 'OutOfData' or 'incomplete input' in str(error)
+
 
+# `truncated(error, data)` tells if the `error` raised by `loader(data)`
+# means that `data` is only the start of a message
 if PROTOCOL == 'json':
     loader = json_loader
     dumper = json_dumper
+    truncated = json_truncated
 elif PROTOCOL == 'pickle':
     loader = pickle_loader
     dumper = pickle_dumper
+    truncated = pickle_truncated
 elif PROTOCOL == 'msgpack':
     loader = msgpack_loader
     dumper = msgpack_dumper
+    truncated = msgpack_truncated
 else:
     raise ValueError("No such protocol: %s" % (PROTOCOL))
 
+
+
+# Optional framing: a message prefixed with `FRAME_MAGIC` and its length.
+# Framed messages can be streamed and pipelined over one connection, a
+# server answers in the framing the client used for its first request.
+FRAME_MAGIC = b'TEMF'
+FRAME_HEADER = struct.Struct('>4sI')
+
+
+def frame(data: bytes) -> bytes:
+    """Prefix the serialized `data` with the frame header."""
+    return FRAME_HEADER.pack(FRAME_MAGIC, len(data)) + data
@@ -0,0 +1,337 @@
+"""Soak test of the tem_server.
+
+Runs the server in this process against the simulated microscope, with
+client threads sending a mix of reads and writes (`TRAFFIC`) for a
+configurable duration:
+
+    python soak.py --duration 3600 --clients 4
+
+`--microscope fake-tecnai` soaks the `TecnaiMicroscope` code on the model
+of the COM interface in `TEMController/fake_com.py` instead.
+
+Every `--interval` s the resident set size, a `tracemalloc` snapshot
+and the call latencies since the previous sample are recorded. The
+report compares the end of the run with the baseline taken after the
+warm-up: the RSS growth (total and fitted rate), the allocation sites
+that grew most, and the drift of the median and 99th percentile
+latency. The exit code is 1 if a growth or drift exceeds its threshold.
+"""
+import ctypes
+import gc
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+from TEMController.rotation import fit_line
+from client import TemClient
+from metrics import Metrics
+from tem_server import serve, start_servers
+
+# (weight, command, args(rnd, context)) of the calls of the traffic clients
+TRAFFIC = (
+    (30, 'getStagePosition', None),
+    (15, 'getBeamShift', None),
+    (10, 'getMagnification', None),
+    (8, 'getFunctionMode', None),
+    (5, 'getFocus', None),
+    (5, 'getHTValue', None),
+    (5, 'isStageMoving', None),
+    (5, 'setBeamShift', lambda rnd, ctx: (rnd.randint(-1000, 1000), rnd.randint(-1000, 1000))),
+    (5, 'setFocus', lambda rnd, ctx: (rnd.randint(-1000, 1000),)),
+    (3, 'setStagePositionRelative', lambda rnd, ctx: (rnd.randint(-500, 500), rnd.randint(-500, 500))),
+    (3, 'setMagnification', lambda rnd, ctx: (rnd.choice(ctx['magnifications']),)),
+    (2, '__status__', None),
+    (2, '__version__', None),
+)
+
+# defaults of the thresholds, growth from the baseline to the end of the run
+MAX_RSS_GROWTH = 20.0  # MB
+MAX_SITE_GROWTH = 1024.0  # KB per allocation site
+MAX_LATENCY_DRIFT = 2.0  # end / baseline of the median and 99th percentile
+
+# allocation sites listed in the report
+TOP_SITES = 10
+
+
+class _PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+    _fields_ = [('cb', ctypes.c_ulong),
+                ('PageFaultCount', ctypes.c_ulong),
+                ('PeakWorkingSetSize', ctypes.c_size_t),
+                ('WorkingSetSize', ctypes.c_size_t),
+                ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                ('PagefileUsage', ctypes.c_size_t),
+                ('PeakPagefileUsage', ctypes.c_size_t)]
+
+
+def rss() -> int:
+    """Return the resident set size (working set) of this process in
+    bytes, or None if it cannot be read on this platform."""
+    if sys.platform == 'win32':
+        counters = _PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize
+        return None
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Traffic(threading.Thread):
+    """Client thread sending the weighted random calls of `TRAFFIC` to the
+    server at `port`, the latencies are appended to `context['latencies']`."""
+
+    def __init__(self, port: int, context: dict, seed: int = None):
+        super().__init__(name='traffic')
+        self.daemon = True
+        self.client = TemClient('127.0.0.1', port, pool_size=1)
+        self.context = context
+        self.rnd = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+        self._stop_event = threading.Event()
+        self._weights = [w for w, name, args in TRAFFIC]
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def run(self):
+        rnd = self.rnd
+        total = sum(self._weights)
+        while not self._stop_event.is_set():
+            r = rnd.uniform(0, total)
+            for weight, func_name, args in TRAFFIC:
+                r -= weight
+                if r <= 0:
+                    break
+            args = args(rnd, self.context) if args else ()
+            t0 = time.perf_counter()
+            try:
+                self.client.call(func_name, *args)
+            except Exception:
+                self.errors += 1
+            # the list is swapped by the sampler, read it every time
+            self.context['latencies'].append(time.perf_counter() - t0)
+            self.calls += 1
+        self.client.close()
+
+
+class Sample:
+    """RSS, tracemalloc snapshot and latencies at one point of the run."""
+
+    def __init__(self, t: float, latencies: list):
+        self.t = t
+        # garbage waiting for the cycle collector is not a leak
+        gc.collect()
+        self.rss = rss()
+        self.snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, __file__),
+        ))
+        self.traced = tracemalloc.get_traced_memory()[0]
+        self.n = len(latencies)
+        self.p50 = percentile(latencies, 0.5)
+        self.p99 = percentile(latencies, 0.99)
+
+
+def soak(duration: float = 600.0,
+         warmup: float = 60.0,
+         interval: float = 10.0,
+         clients: int = 4,
+         microscope: str = 'simulate',
+         frames: int = 1,
+         server_log: str = os.devnull) -> dict:
+    """Run the soak test, returns the report (see `check` for the
+    failure conditions). `frames` is the depth of the tracebacks of the
+    allocation sites, the server prints the commands it ran to
+    `server_log`."""
+    stdout = sys.stdout
+    sys.stdout = open(server_log, 'w')
+    try:
+        return _soak(duration, warmup, interval, clients, microscope, frames,
+                     log=lambda line: print(line, file=stdout, flush=True))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def _soak(duration, warmup, interval, clients, microscope, frames, log) -> dict:
+    tracemalloc.start(frames)
+    servers, default = start_servers([(microscope, microscope)], Metrics())
+    server = servers[default]
+    server.ready.wait()
+    if server.init_error is not None:
+        raise server.init_error
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    s.listen(5)
+    port = s.getsockname()[1]
+    listener = threading.Thread(target=serve, args=(s, servers, default), name='listener')
+    listener.daemon = True
+    listener.start()
+
+    with TemClient('127.0.0.1', port) as tem:
+        ranges = tem.getMagnificationRanges()
+        magnifications = ranges.get(tem.getFunctionMode()) or [tem.getMagnification()]
+    context = {'magnifications': magnifications, 'latencies': []}
+    traffic = [Traffic(port, context, seed=i) for i in range(clients)]
+    for t in traffic:
+        t.start()
+
+    t_start = time.perf_counter()
+    samples = []
+    baseline = None
+    try:
+        while True:
+            time.sleep(interval)
+            latencies, context['latencies'] = context['latencies'], []
+            t = time.perf_counter() - t_start
+            sample = Sample(t, latencies)
+            if baseline is None and t >= warmup:
+                baseline = sample
+            if baseline is not None:
+                # only the snapshots of the baseline and the last sample are kept
+                if len(samples) > 1:
+                    samples[-1].snapshot = None
+                samples.append(sample)
+                log('%7.0f s  rss %8.1f MB  traced %8.1f MB  calls %6d  p50 %6.2f ms  p99 %6.2f ms' % (
+                    t, (sample.rss or 0) / 1e6, sample.traced / 1e6, sample.n,
+                    (sample.p50 or 0) * 1e3, (sample.p99 or 0) * 1e3))
+            if t >= duration:
+                break
+    finally:
+        for t in traffic:
+            t.stop()
+
+    return report(samples, calls=sum(t.calls for t in traffic), errors=sum(t.errors for t in traffic))
+
+
+def report(samples: list, calls: int = 0, errors: int = 0) -> dict:
+    """Compare the last of `samples` with the first (the baseline)."""
+    if len(samples) < 2:
+        raise ValueError('The soak test needs at least two samples after the warm-up, '
+                         'increase the duration or lower the interval.')
+    first, last = samples[0], samples[-1]
+    minutes = (last.t - first.t) / 60
+
+    rss_growth = None
+    rss_rate = None
+    points = [(s.t / 60, s.rss / 1e6) for s in samples if s.rss is not None]
+    if len(points) >= 2:
+        rss_growth = points[-1][1] - points[0][1]
+        rss_rate = fit_line([p[0] for p in points], [p[1] for p in points])[0]
+
+    sites = []
+    stats = last.snapshot.compare_to(first.snapshot, 'traceback')
+    stats.sort(key=lambda stat: -stat.size_diff)
+    for stat in stats[:TOP_SITES]:
+        if stat.size_diff <= 0:
+            break
+        sites.append({
+            'site': ' '.join('%s:%d' % (frame.filename, frame.lineno) for frame in stat.traceback),
+            'growth_kb': stat.size_diff / 1024,
+            'size_kb': stat.size / 1024,
+            'count_diff': stat.count_diff,
+        })
+
+    return {
+        'minutes': minutes,
+        'calls': calls,
+        'errors': errors,
+        'rss_growth_mb': rss_growth,
+        'rss_rate_mb_per_min': rss_rate,
+        'traced_growth_mb': (last.traced - first.traced) / 1e6,
+        'sites': sites,
+        'p50_ms': (first.p50 * 1e3, last.p50 * 1e3) if first.p50 and last.p50 else None,
+        'p99_ms': (first.p99 * 1e3, last.p99 * 1e3) if first.p99 and last.p99 else None,
+    }
+
+
+def check(result: dict,
+          max_rss_growth: float = MAX_RSS_GROWTH,
+          max_site_growth: float = MAX_SITE_GROWTH,
+          max_latency_drift: float = MAX_LATENCY_DRIFT) -> list:
+    """Return the list of thresholds the `result` of `soak` exceeds."""
+    failures = []
+    if result['rss_growth_mb'] is not None and result['rss_growth_mb'] > max_rss_growth:
+        failures.append('RSS grew by %.1f MB (max %.1f MB)' % (result['rss_growth_mb'], max_rss_growth))
+    for site in result['sites']:
+        if site['growth_kb'] > max_site_growth:
+            failures.append('%s grew by %.0f KB (max %.0f KB)' % (site['site'], site['growth_kb'], max_site_growth))
+    for key in ('p50_ms', 'p99_ms'):
+        if result[key] is not None:
+            first, last = result[key]
+            if last > first * max_latency_drift:
+                failures.append('%s latency drifted from %.2f to %.2f ms (max %.1fx)' % (
+                    key[:3], first, last, max_latency_drift))
+    return failures
+
+
+def print_report(result: dict) -> None:
+    print()
+    print('%d calls, %d errors in %.1f min after the warm-up' % (result['calls'], result['errors'], result['minutes']))
+    if result['rss_growth_mb'] is not None:
+        print('RSS growth: %.1f MB (%.2f MB/min fitted)' % (result['rss_growth_mb'], result['rss_rate_mb_per_min']))
+    print('Traced growth: %.2f MB' % (result['traced_growth_mb']))
+    for key in ('p50_ms', 'p99_ms'):
+        if result[key] is not None:
+            print('%s latency: %.2f -> %.2f ms' % (key[:3], result[key][0], result[key][1]))
+    print('Allocation sites with the largest growth:')
+    for site in result['sites']:
+        print('  %10.1f KB  %+8d blocks  %s' % (site['growth_kb'], site['count_diff'], site['site']))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-t', '--microscope', default='simulate',
+                        help='Microscope config to soak, fake-tecnai for the COM model (default: %(default)s).')
+    parser.add_argument('--duration', type=float, default=600.0, help='Length of the run in s.')
+    parser.add_argument('--warmup', type=float, default=60.0, help='s before the baseline is taken.')
+    parser.add_argument('--interval', type=float, default=10.0, help='s between two samples.')
+    parser.add_argument('--clients', type=int, default=4, help='Number of traffic clients.')
+    parser.add_argument('--frames', type=int, default=1, help='Traceback depth of the allocation sites.')
+    parser.add_argument('--server-log', default=os.devnull, help='File for the command log of the server.')
+    parser.add_argument('--max-rss-growth', type=float, default=MAX_RSS_GROWTH, help='MB')
+    parser.add_argument('--max-site-growth', type=float, default=MAX_SITE_GROWTH, help='KB per allocation site')
+    parser.add_argument('--max-latency-drift', type=float, default=MAX_LATENCY_DRIFT,
+                        help='Ratio of the end to the baseline latency.')
+    options = parser.parse_args()
+
+    result = soak(options.duration, options.warmup, options.interval, options.clients,
+                  microscope=options.microscope, frames=options.frames, server_log=options.server_log)
+    print_report(result)
+    failures = check(result, options.max_rss_growth, options.max_site_growth, options.max_latency_drift)
+    print()
+    for failure in failures:
+        print('FAIL: %s' % (failure))
+    if not failures:
+        print('PASS')
+    sys.stdout.flush()
+    # the server threads do not stop
+    os._exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
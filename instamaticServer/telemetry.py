@@ -0,0 +1,249 @@
+import datetime
+import mmap
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+
+# columns recorded for each property, `time` is always the first column
+SCHEMA = {
+    'getStagePosition': ('stage_x', 'stage_y', 'stage_z', 'stage_a', 'stage_b'),
+    'getBeamShift': ('beamshift_x', 'beamshift_y'),
+    'getBeamTilt': ('beamtilt_x', 'beamtilt_y'),
+    'getImageShift1': ('imageshift1_x', 'imageshift1_y'),
+    'getDiffShift': ('diffshift_x', 'diffshift_y'),
+    'getFocus': ('focus',),
+    'getDiffFocus': ('difffocus',),
+    'getHTValue': ('ht',),
+    'getScreenCurrent': ('screen_current',),
+    'getBrightness': ('brightness',),
+    'getMagnification': ('magnification',),
+}
+
+MAGIC = b'TEMTLM01'
+# magic, number of columns, capacity (rows), count (rows written)
+HEADER = struct.Struct('<8sIxxxxQQ')
+COUNT_OFFSET = 24
+NAME_SIZE = 32
+ALIGN = 4096
+SUFFIX = '.tlm'
+
+
+def columns_for(properties: list) -> list:
+    """Return the column names recorded for the getters `properties`."""
+    columns = ['time']
+    for prop in properties:
+        try:
+            columns.extend(SCHEMA[prop])
+        except KeyError:
+            raise ValueError('No telemetry schema for: %s' % (prop))
+    return columns
+
+
+def _data_offset(n_columns: int) -> int:
+    size = HEADER.size + n_columns * NAME_SIZE
+    return (size + ALIGN - 1) // ALIGN * ALIGN
+
+
+class TelemetryFile:
+    """Fixed-size column-major file of float64 values, memory-mapped.
+
+    The header holds the column names, the capacity and the number of
+    rows written, followed by one contiguous array of `capacity` values
+    per column, so a column can be read without touching the others.
+    """
+
+    def __init__(self, path: str, columns: list, capacity: int):
+        self.path = str(path)
+        self.columns = list(columns)
+        self.capacity = int(capacity)
+        self.count = 0
+        self._offset = _data_offset(len(self.columns))
+
+        size = self._offset + len(self.columns) * self.capacity * 8
+        with open(self.path, 'wb') as f:
+            f.truncate(size)
+        self._file = open(self.path, 'r+b')
+        self._mm = mmap.mmap(self._file.fileno(), size)
+
+        HEADER.pack_into(self._mm, 0, MAGIC, len(self.columns), self.capacity, 0)
+        for i, name in enumerate(self.columns):
+            struct.pack_into('%ds' % NAME_SIZE, self._mm, HEADER.size + i * NAME_SIZE, name.encode())
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+    def append(self, row: list) -> None:
+        """Write one row, a value per column. The row count in the header
+        is updated last, so readers never see a partial row."""
+        mm = self._mm
+        base = self._offset + self.count * 8
+        stride = self.capacity * 8
+        for i, value in enumerate(row):
+            struct.pack_into('<d', mm, base + i * stride, value)
+        self.count += 1
+        struct.pack_into('<Q', mm, COUNT_OFFSET, self.count)
+
+    def close(self) -> None:
+        self._mm.flush()
+        self._mm.close()
+        self._file.close()
+
+
+class TelemetryWriter:
+    """Writes rows to a series of `TelemetryFile`s in `directory`.
+
+    A new file is started after `rows_per_file` rows, and the oldest
+    files are removed to keep at most `max_files` of them, which bounds
+    the size on disk.
+    """
+
+    def __init__(self, directory: str, prefix: str, columns: list,
+                 rows_per_file: int = 86400, max_files: int = 30):
+        self.directory = Path(directory)
+        self.prefix = prefix
+        self.columns = columns
+        self.rows_per_file = rows_per_file
+        self.max_files = max_files
+        self._file = None
+
+        if not self.directory.exists():
+            self.directory.mkdir(parents=True)
+
+    def files(self) -> list:
+        return sorted(self.directory.glob('%s_*%s' % (self.prefix, SUFFIX)))
+
+    def _rotate(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+        old = self.files()
+        for path in old[:max(0, len(old) - self.max_files + 1)]:
+            os.remove(str(path))
+
+        stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+        path = self.directory.joinpath('%s_%s%s' % (self.prefix, stamp, SUFFIX))
+        self._file = TelemetryFile(path, self.columns, self.rows_per_file)
+
+    def append(self, row: list) -> None:
+        if self._file is None or self._file.full:
+            self._rotate()
+        self._file.append(row)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def flatten(properties: list, values: dict) -> list:
+    """Flatten the `values` read for `properties` into the columns of a
+    row, reads that failed are recorded as NaN."""
+    row = []
+    for prop in properties:
+        n = len(SCHEMA[prop])
+        value = values.get(prop)
+        if value is None:
+            row.extend([float('nan')] * n)
+        elif n == 1:
+            row.append(float(value))
+        else:
+            row.extend(float(v) for v in value)
+    return row
+
+
+class TelemetrySampler(threading.Thread):
+    """Records `properties` of the microscope of `server` (a `TemServer`)
+    every `interval` s with `writer`.
+
+    Reads are shared with the other clients: the sampler uses the value
+    of a getter read by any command within the last `interval` s, and
+    only asks the microscope for the properties nobody else read.
+    """
+
+    def __init__(self, server, writer: TelemetryWriter, properties: list, interval: float = 1.0):
+        super().__init__()
+        self.daemon = True
+        self.server = server
+        self.writer = writer
+        self.properties = list(properties)
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def run(self):
+        t_next = time.perf_counter()
+        try:
+            while not self._stop_event.is_set():
+                t = time.time()
+                status, values = self.server.call('__sample__', self.properties, self.interval)
+                if status == 200:
+                    self.writer.append([t] + flatten(self.properties, values))
+                t_next += self.interval
+                self._stop_event.wait(max(0.0, t_next - time.perf_counter()))
+        finally:
+            self.writer.close()
+
+
+class TelemetryReader:
+    """Reads a telemetry file as NumPy arrays without copying.
+
+        tlm = TelemetryReader('telemetry/tecnaiG2_20240101_120000_000000.tlm')
+        tlm['stage_a']                # view on the recorded values
+        tlm.range(t0, t1)['focus']    # rows with t0 <= time < t1
+    """
+
+    def __init__(self, path: str):
+        import numpy as np
+
+        with open(str(path), 'rb') as f:
+            magic, n_columns, capacity, count = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError('Not a telemetry file: %s' % (path))
+            names = f.read(n_columns * NAME_SIZE)
+
+        self.path = str(path)
+        self.columns = [names[i * NAME_SIZE:(i + 1) * NAME_SIZE].rstrip(b'\x00').decode()
+                        for i in range(n_columns)]
+        self.capacity = capacity
+        self._data = np.memmap(self.path, dtype='<f8', mode='r',
+                               offset=_data_offset(n_columns), shape=(n_columns, capacity))
+        self._index = {name: i for i, name in enumerate(self.columns)}
+
+    @property
+    def count(self) -> int:
+        """Number of rows written, re-read so a file still being written grows."""
+        with open(self.path, 'rb') as f:
+            return HEADER.unpack(f.read(HEADER.size))[3]
+
+    def __getitem__(self, name: str):
+        return self._data[self._index[name], :self.count]
+
+    def range(self, t0: float = None, t1: float = None) -> dict:
+        """Return the views of all columns for the rows with t0 <= time < t1."""
+        import numpy as np
+
+        count = self.count
+        times = self._data[0, :count]
+        start = 0 if t0 is None else int(np.searchsorted(times, t0, side='left'))
+        stop = count if t1 is None else int(np.searchsorted(times, t1, side='left'))
+        return {name: self._data[i, start:stop] for name, i in self._index.items()}
+
+
+def read_directory(directory: str, prefix: str = '', t0: float = None, t1: float = None) -> dict:
+    """Load the rows with t0 <= time < t1 from all telemetry files in
+    `directory` starting with `prefix`, concatenated (this copies)."""
+    import numpy as np
+
+    parts = []
+    for path in sorted(Path(directory).glob('%s*%s' % (prefix, SUFFIX))):
+        part = TelemetryReader(path).range(t0, t1)
+        if len(part['time']):
+            parts.append(part)
+    if not parts:
+        return {}
+    return {name: np.concatenate([p[name] for p in parts]) for name in parts[0]}
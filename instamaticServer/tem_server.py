@@ -1,24 +1,85 @@
 import datetime
+import functools
 import queue
 import socket
 import threading
 import signal
+import time
 import traceback
 import logging
 
-from TEMController.microscope import get_microscope
-from serializer import dumper, loader
+import clock
+from connection import Connection
+from TEMController.microscope import get_interface, get_microscope, get_static_data
+from dispatch import build_table
+from events import ChangeFeed
+from macro import MacroRunner, load_macros, validate
+from metrics import Metrics
+from profiler import SamplingProfiler
+from results import ResultCache
+from scheduler import QUEUE_SIZE, FairQueue
+from telemetry import TelemetrySampler, TelemetryWriter, columns_for
+from tracing import TraceStore
+from triggers import Trigger
 from utils.config import config
+from utils.exceptions import TEMServerBusyError, TEMValueError
 
-condition = threading.Condition()
 stop_program_event = threading.Event()
 
-box = []
-
 _conf = config()
 HOST = _conf.default_settings['tem_server_host']
 PORT = _conf.default_settings['tem_server_port']
-BUFSIZE = 1024
+# s a command waits for the microscope to finish initializing before it fails
+INIT_WAIT = _conf.default_settings.get('tem_server_init_wait', 10.0)
+
+# commands issued by the server itself, not printed unless they fail
+QUIET_COMMANDS = ('__sample__',)
+
+
+class Reply:
+    """Hands the response of a single command from the `TemServer` thread
+    back to the connection that submitted it. If `stream` is set, the
+    progress messages of the command are handed over as well. `trace`
+    is the `tracing.Trace` of a traced request. `executed` is set to the
+    time.perf_counter() at the start and end of the execution.
+
+    If `callback` is given, the response is passed to it on the
+    `TemServer` thread instead, and the progress messages to
+    `on_progress`, so nobody has to wait for them."""
+
+    def __init__(self, stream: bool = False, trace=None, callback=None, on_progress=None):
+        self._q = queue.Queue()
+        self.stream = stream
+        self.response = None
+        self.trace = trace
+        self.t_queued = time.perf_counter() if trace else None
+        self.executed = None
+        self.callback = callback
+        self.on_progress = on_progress
+
+    def progress(self, message) -> None:
+        if self.stream:
+            if self.on_progress:
+                self.on_progress(message)
+            else:
+                self._q.put((False, message))
+
+    def set(self, response) -> None:
+        self.response = response
+        if self.callback:
+            self.callback(response)
+        else:
+            self._q.put((True, response))
+
+    def wait(self, on_progress=None):
+        """Wait for the response, call `on_progress` with every progress
+        message received in the meantime."""
+        while True:
+            final, message = self._q.get()
+            if final:
+                return message
+            if on_progress:
+                on_progress(message)
 
 
 class TemServer(threading.Thread):
@@ -28,10 +89,18 @@ class TemServer(threading.Thread):
     microscope `name` that is used to initialize the connection to the
     microscope. Start the server using `TemServer.run` which will wait
     for items to appear on `q` and execute them on the specified
-    microscope instance.
+    microscope instance. Every instance hosted by the server process has
+    its own `TemServer` and queue, `instance` is the name used to route
+    requests to it and `metrics` collects the counters of all instances.
+    The spans of traced requests are recorded in `traces`. The responses
+    to requests with a `request_id` are kept in `results`.
+
+    The connection to the microscope is initialized when the thread
+    starts, `ready` is set once it succeeded or failed. Until then, the
+    results of the commands in `static` are served from the config.
     """
-    
-    def __init__(self, log=None, q=None, name=None):
+
+    def __init__(self, log=None, q=None, name=None, instance=None, metrics=None, macros=None, traces=None):
         super().__init__()
 
         self._log = log
@@ -39,132 +108,742 @@ class TemServer(threading.Thread):
 
         # self.name is a reserved parameter for threads
         self._name = name
+        self.instance = instance
+        self.metrics = metrics
+        self.macros = macros if macros is not None else {}
+        self.traces = traces if traces is not None else TraceStore()
+
+        self.ready = threading.Event()
+        self.init_error = None
+        self.static = get_static_data(name)
+        self._t_init = (time.perf_counter(), None)
+        # (func_name, time.perf_counter() at its start) of the executing command
+        self.current = None
 
         self.verbose = False
 
+        self.commands = {}
+        self.changes = ChangeFeed(instance)
+        # (time.perf_counter(), value) of the last read of each getter without arguments
+        self.last_read = {}
+        self.results = ResultCache()
+        self._builtins = {
+            '__methods__': self.get_methods,
+            '__version__': lambda: self.changes.version,
+            '__sample__': self.sample,
+            '__run_macro__': self.run_macro,
+            '__define_macro__': self.define_macro,
+            '__delete_macro__': self.delete_macro,
+            '__macros__': self.get_macros,
+            '__com_profile__': self.com_profile,
+            '__traces__': self.traces.export,
+        }
+        self._reply = None
+
+    @property
+    def q(self):
+        return self._q
+
+    @property
+    def state(self) -> str:
+        """One of 'initializing', 'ready' or 'failed'."""
+        if not self.ready.is_set():
+            return 'initializing'
+        return 'failed' if self.init_error else 'ready'
+
+    def status(self) -> dict:
+        """Return the state of the instance, its queue depth and the command
+        being executed, answered by the connection without going through
+        the queue."""
+        t0, t1 = self._t_init
+        now = time.perf_counter()
+        current = self.current
+        status = {
+            'instance': self.instance,
+            'microscope': self._name,
+            'state': self.state,
+            'error': None if self.init_error is None else repr(self.init_error),
+            'init_time': (t1 or now) - t0,
+            'queue_depth': self._q.qsize(),
+            'current': current[0] if current else None,
+            'running_for': now - current[1] if current else 0.0,
+        }
+        if self.metrics:
+            status['uptime'] = self.metrics.uptime
+            status['connections'] = self.metrics.connections
+        return status
+
+    def stats(self) -> dict:
+        """Return the status with the command counters and the queue of
+        every connection."""
+        stats = self.status()
+        if self.metrics:
+            stats.update(self.metrics.snapshot().get(self.instance, {}))
+        stats['clients'] = self._q.stats()
+        stats['results'] = self.results.stats()
+        return stats
+
     def run(self):
         """Start the server thread."""
-        self.tem = get_microscope(name=self._name)
-        self._name = self.tem.name
-        print("Initialized connection to microscope: %s" % (self._name))
+        try:
+            self.tem = get_microscope(name=self._name)
+            self._name = self.tem.name
+            self.commands = build_table(self.tem)
+        except Exception as e:
+            traceback.print_exc()
+            if self._log:
+                self._log.exception(e)
+            self.init_error = e
+        self._t_init = (self._t_init[0], time.perf_counter())
+        self.ready.set()
+
+        if self.init_error is not None:
+            print("Failed to initialize microscope: %s (%s)" % (self._name, self.instance))
+            self._fail_queued()
+            return
+
+        profiler = getattr(self.tem, 'com_profiler', None)
+        print("Initialized connection to microscope: %s (%s)" % (self._name, self.instance))
 
         while True:
+            cmd, reply = self._q.get()
+
             now = datetime.datetime.now().strftime('%H:%M:%S.%f')
+            t0 = time.perf_counter()
+            trace = reply.trace
+
+            func_name = cmd['func_name']
+            args = cmd.get('args', ())
+            kwargs = cmd.get('kwargs', {})
+
+            self._reply = reply
+            self.current = (func_name, t0)
+            if profiler is not None:
+                profiler.command = func_name
+            t_exec = time.perf_counter()
+            try:
+                ret = self.evaluate(func_name, args, kwargs)
+                status = 200
+            except Exception as e:
+                traceback.print_exc()
+                if self._log:
+                    self._log.exception(e)
+                ret = (e.__class__.__name__, e.args)
+                status = 500
+            t_done = time.perf_counter()
+            reply.executed = (t_exec, t_done)
+            self.current = None
+            if trace:
+                trace.add('execute', t_exec, t_done, thread='worker %s' % self.instance)
+
+            if self.metrics:
+                self.metrics.record(self.instance, time.perf_counter() - t0, error=status != 200)
+
+            command = self.commands.get(func_name)
+            if command is not None:
+                if not command.readonly:
+                    # also after a failure, e.g. a scan may have moved the deflector
+                    self.changed(command)
+                elif status == 200 and not args and not kwargs:
+                    self.last_read[func_name] = (time.perf_counter(), ret)
+
+            if trace:
+                trace.add('queue', reply.t_queued, t0, thread='worker %s' % self.instance)
+                trace.add('dispatch', t0, time.perf_counter(), thread='worker %s' % self.instance)
+            reply.set((status, ret))
+            if func_name not in QUIET_COMMANDS or status != 200:
+                print("%s  |  %s  %s  %s: %s" % (now, self.instance, status, func_name, ret))
+
+    def _fail_queued(self):
+        """Answer every command with the initialization error."""
+        e = self.init_error
+        while True:
+            cmd, reply = self._q.get()
+            reply.set((500, ('TEMCommunicationError', ('Microscope %s failed to initialize: %r' % (self._name, e),))))
 
-            cmd = self._q.get()
+    def evaluate(self, func_name: str, args: list, kwargs: dict):
+        """Evaluate the function `func_name` on `self.tem` and call it with
+        `args` and `kwargs`.
+
+        Only the methods in the dispatch table `self.commands` and the
+        server commands in `self._builtins` can be called.
+        """
+        try:
+            command = self.commands[func_name]
+        except KeyError:
+            try:
+                command = self._builtins[func_name]
+            except KeyError:
+                raise AttributeError("'%s' has no command '%s'" % (self._name, func_name))
+            return command(*args, **kwargs)
+        return command(args, kwargs)
+
+    def changed(self, command) -> None:
+        """Forget the last reads of the getters the mutating `command`
+        changes and publish its change event."""
+        for getter in command.changes:
+            self.last_read.pop(getter, None)
+        self.changes.publish(command.name, lambda: self.read_state(command.changes))
+
+    def _evaluate_step(self, func_name: str, args: list, kwargs: dict):
+        """`evaluate` for the calls of macros, which publish their changes
+        like the commands sent by the clients."""
+        command = self.commands.get(func_name)
+        try:
+            return self.evaluate(func_name, args, kwargs)
+        finally:
+            if command is not None and not command.readonly:
+                self.changed(command)
+
+    def cancel(self) -> bool:
+        """Cancel the sequence running on the microscope (e.g. `rasterScan`),
+        return False if the microscope is not initialized yet."""
+        tem = getattr(self, 'tem', None)
+        if tem is None:
+            return False
+        if tem.cancel_event is not None:
+            tem.cancel_event.set()
+        return True
+
+    def call(self, func_name: str, *args, **kwargs):
+        """Put `func_name` on the queue from another thread of the server
+        and return the (status, value) response."""
+        reply = Reply()
+        self._q.put(({'func_name': func_name, 'args': args, 'kwargs': kwargs}, reply))
+        return reply.wait()
+
+    def sample(self, getters: list, max_age: float = 0.0) -> dict:
+        """Return the values of `getters`, reusing the results of reads made
+        by any client within the last `max_age` s. Failed reads are None."""
+        now = time.perf_counter()
+        values = {}
+        for getter in getters:
+            t, value = self.last_read.get(getter, (None, None))
+            if t is None or now - t > max_age:
+                try:
+                    value = self.commands[getter]((), {})
+                except Exception:
+                    value = None
+                else:
+                    self.last_read[getter] = (time.perf_counter(), value)
+            values[getter] = value
+        return values
+
+    def read_state(self, getters) -> dict:
+        """Return the values of `getters`, keyed by the field name
+        (`getBeamShift` -> `BeamShift`), for the change events."""
+        state = {}
+        for getter in getters:
+            field = getter[3:] if getter.startswith('get') else getter
+            try:
+                state[field] = self.commands[getter]((), {})
+            except Exception:
+                pass  # e.g. getFocus in diffraction mode
+        return state
+
+    def is_readonly(self, func_name: str) -> bool:
+        """Return True if `func_name` only reads the microscope state."""
+        command = self.commands.get(func_name)
+        return command is not None and command.readonly
+
+    def get_methods(self) -> dict:
+        """Return the signatures of all commands in the dispatch table."""
+        return {name: command.describe() for name, command in self.commands.items()}
+
+    def com_profile(self, sort: str = 'total', reset: bool = False) -> list:
+        """Return the time spent in each COM access per command, sorted by
+        `sort` (see `com_profiler.ComProfiler.report`)."""
+        profiler = getattr(self.tem, 'com_profiler', None)
+        if profiler is None:
+            raise ValueError('COM profiling is not enabled for %s, set `com_profiling` in the settings.' % (self._name))
+        return profiler.report(sort=sort, reset=reset)
+
+    def run_macro(self, macro, variables: dict = None) -> dict:
+        """Run `macro`, the name of a stored macro or a list of steps (see
+        `macro.MacroRunner`), with the initial `variables`. Progress is
+        streamed after every call if the request asked for it."""
+        if isinstance(macro, str):
+            try:
+                macro = self.macros[macro]
+            except KeyError:
+                raise KeyError('No such macro: %s' % (macro))
+
+        reply = self._reply
+        runner = MacroRunner(
+            self._evaluate_step,
+            macros=self.macros,
+            progress=lambda msg: reply.progress((102, msg)),
+            cancel_event=self.tem._start_sequence(),
+        )
+        return runner.run(macro, variables=variables)
+
+    def define_macro(self, name: str, steps: list) -> None:
+        """Store the macro `steps` under `name` to run it again later."""
+        validate(steps)
+        self.macros[name] = steps
+
+    def delete_macro(self, name: str) -> None:
+        """Remove the stored macro `name`."""
+        self.macros.pop(name, None)
+
+    def get_macros(self) -> dict:
+        """Return the stored macros."""
+        return dict(self.macros)
+
+
+class Stream(threading.Thread):
+    """Pushes the result of a read-only command to a connection.
+
+    The command in `request` is put on the queue of `server` every
+    `interval` s, `count` times or until stopped, and each result is
+    sent as `(102, value, seq)`. The stream ends with `(200, n, seq)`,
+    `n` being the number of results sent, or with the error of the
+    command.
+    """
 
-            with condition:
-                func_name = cmd['func_name']
-                args = cmd.get('args', ())
-                kwargs = cmd.get('kwargs', {})
+    def __init__(self, connection, server, request: dict, seq, interval: float = 1.0, count: int = None):
+        super().__init__()
+        self.daemon = True
+        self.connection = connection
+        self.server = server
+        self.request = request
+        self.seq = seq
+        self.interval = interval
+        self.count = count
+        self._stop_event = threading.Event()
+
+    def stop(self) -> None:
+        self._stop_event.set()
 
+    def run(self):
+        n = 0
+        response = None
+        t_next = time.perf_counter()
+        try:
+            while not self._stop_event.is_set() and (self.count is None or n < self.count):
+                reply = Reply()
+                self.server.q.put((self.request, reply), key=self.connection.key, client=self.connection.client)
+                status, value = reply.wait()
+                if status != 200:
+                    response = (status, value)
+                    break
+                self.connection.send((102, value), self.seq)
+                n += 1
+                t_next += self.interval
+                if self._stop_event.wait(max(0.0, t_next - time.perf_counter())):
+                    break
+            self.connection.send(response or (200, n), self.seq)
+        except OSError:
+            pass  # connection closed
+        finally:
+            self.connection.streams.pop(self.seq, None)
+
+
+def start_stream(connection, server, data: dict) -> None:
+    """Start a `Stream` for the `__stream__` request `data`, with the
+    arguments (func_name, interval=1.0, args=(), kwargs=None, count=None)."""
+    seq = data.get('seq')
+
+    def stream(func_name: str, interval: float = 1.0, args=(), kwargs=None, count: int = None):
+        if not connection.framed:
+            raise ValueError('Streams need a framed connection.')
+        if seq is None or seq in connection.streams:
+            raise ValueError('A stream needs a unique `seq` on its connection.')
+        if not server.is_readonly(func_name):
+            raise ValueError('Only read-only commands can be streamed, got: %s' % (func_name))
+        request = {'func_name': func_name, 'args': args, 'kwargs': kwargs or {}}
+        connection.streams[seq] = Stream(connection, server, request, seq, interval=interval, count=count)
+        connection.streams[seq].start()
+
+    try:
+        stream(*data.get('args', ()), **data.get('kwargs', {}))
+    except Exception as e:
+        connection.send((500, (e.__class__.__name__, e.args)), seq, None, bool(data.get('timestamp')))
+
+
+def start_trigger(connection, server, data: dict) -> None:
+    """Run a `Trigger` for the `__wait_until__` request `data`, with the
+    arguments (conditions, interval=0.01, timeout=None).
+
+    On a framed connection with a `seq`, the trigger runs on its own
+    thread and the response is sent when it fires or times out, so the
+    connection can be used meanwhile; `__unstream__` (seq) stops it.
+    Otherwise the connection waits for the trigger."""
+    seq = data.get('seq')
+
+    def sample(getters):
+        reply = Reply()
+        request = {'func_name': '__sample__', 'args': (getters, 0.0), 'kwargs': {}}
+        server.q.put((request, reply), key=connection.key, client=connection.client)
+        status, value = reply.wait()
+        if status != 200:
+            raise RuntimeError('Sampling failed: %s: %s' % value)
+        return value
+
+    def done(result, error=None):
+        connection.streams.pop(seq, None)
+        if error is not None:
+            response = (500, (error.__class__.__name__, error.args))
+        else:
+            response = (200, result)
+        try:
+            connection.send(response, seq, None, bool(data.get('timestamp')))
+        except OSError:
+            pass  # connection closed
+
+    try:
+        trigger = Trigger(sample, *data.get('args', ()), done=done, **data.get('kwargs', {}))
+        for getter in trigger.getters:
+            if not server.is_readonly(getter):
+                raise ValueError('Only read-only commands can be used in conditions, got: %s' % (getter))
+    except Exception as e:
+        done(None, e)
+        return
+
+    if connection.framed and seq is not None and seq not in connection.streams:
+        connection.streams[seq] = trigger
+        trigger.start()
+    else:
+        trigger.run()
+
+
+def thread_label(thread) -> str:
+    """Name of `thread` in the profiles of `sampling_profiler`."""
+    if isinstance(thread, TemServer):
+        return 'worker %s' % (thread.instance)
+    return thread.name
+
+
+# started and stopped with `__profile_start__` and `__profile_stop__`
+sampling_profiler = SamplingProfiler(label=thread_label)
+
+
+def profile_stop(format: str = 'collapsed') -> dict:
+    """Stop the profiler, return its summary and the samples in `format`,
+    `collapsed` or `pstats`. Returns the last profile again if the
+    profiler is not running."""
+    if format not in ('collapsed', 'pstats'):
+        raise ValueError('No such profile format: %s, must be collapsed or pstats' % (format))
+    sampling_profiler.stop()
+    result = sampling_profiler.summary()
+    result['format'] = format
+    result['data'] = sampling_profiler.collapsed() if format == 'collapsed' else sampling_profiler.pstats()
+    return result
+
+
+def send_progress(connection, seq, message) -> None:
+    connection.post(message, seq)
+
+
+def respond(connection, reply, seq, timestamp: bool, response) -> None:
+    """Post the `response` of the command of `reply` to `connection`, with
+    the server times of its execution if `timestamp` is set. Called on
+    the `TemServer` thread, which must not wait for the client."""
+    connection.post(response, seq, reply.trace, timestamp, reply.executed)
+
+
+def handle(conn, servers: dict, default: str, metrics=None):
+    """Handle incoming connection, put command on the Queue of the
+    `TemServer` in `servers` named by the optional `microscope` field of
+    the request (`default` if missing), and wait for its response.
+
+    If the request has a sequence number `seq`, it is appended to the
+    response, so framed clients can match responses and stream messages
+    to their requests. On a framed connection such a request is answered
+    by the sender thread of the connection when it completes, and the
+    connection reads the next request meanwhile, so requests for different
+    instances and out-of-band commands can be pipelined on one
+    connection. Open connections are counted in `metrics`."""
+    connection = Connection(conn)
+    if metrics:
+        metrics.connection_opened()
+    with conn:
+        try:
+            _handle(connection, servers, default)
+        finally:
+            if metrics:
+                metrics.connection_closed()
+            connection.close()
+            connection.stop_streams()
+            for server in servers.values():
+                server.q.close(connection.key)
+
+
+def _handle(connection, servers: dict, default: str):
+    while True:
+        if stop_program_event.is_set():
+            break
+
+        try:
+            data = connection.receive()
+        except TEMValueError as e:
+            connection.send((500, (e.__class__.__name__, e.args)))
+            continue
+        if data is None:
+            break
+
+        if data == 'exit':
+            break
+
+        if data == 'kill':
+            break
+
+        seq = data.get('seq')
+        timestamp = bool(data.get('timestamp'))
+        func_name = data.get('func_name')
+        trace = None
+
+        instance = data.get('microscope') or default
+        try:
+            server = servers[instance]
+        except KeyError:
+            response = (500, ('TEMValueError', ('No such microscope instance: %s' % (instance),)))
+        else:
+            if data.get('trace') is not None:
+                trace = server.traces.begin(data['trace'], func_name, instance)
+                t0, t1, t2 = connection.timing
+                trace.add('receive', t0, t1, thread='connection')
+                trace.add('decode', t1, t2, thread='connection')
+
+            if func_name == '__ping__':
+                # answered right away, also while the microscope initializes
+                connection.send((200, time.time()), seq, trace, timestamp)
+                continue
+
+            if func_name == '__status__':
+                connection.send((200, server.status()), seq, trace, timestamp)
+                continue
+
+            if func_name == '__time__':
+                # clock sync, the server times of receiving and answering the request
+                t_received = clock.from_perf_counter(connection.timing[0])
+                connection.send((200, (t_received, clock.now())), seq, trace, timestamp)
+                continue
+
+            if func_name == '__stats__':
+                # all instances, for monitoring
+                stats = {name: s.stats() for name, s in servers.items()}
+                connection.send((200, stats), seq, trace, timestamp)
+                continue
+
+            if func_name == '__clients__':
+                # depth and counters of the sub-queue of every connection
+                connection.send((200, server.q.stats()), seq, trace, timestamp)
+                continue
+
+            if func_name == '__profile_start__':
+                # process-wide, answered right away to profile a busy server
                 try:
-                    ret = self.evaluate(func_name, args, kwargs)
-                    status = 200
+                    response = (200, sampling_profiler.start(*data.get('args', ()), **data.get('kwargs', {})))
                 except Exception as e:
-                    traceback.print_exc()
-                    if self._log:
-                        self._log.exception(e)
-                    ret = (e.__class__.__name__, e.args)
-                    status = 500
-
-                box.append((status, ret))
-                condition.notify()
-                print("%s  |  %s  %s: %s" % (now, status, func_name, ret))
-                 
-    def evaluate(self, func_name: str, args: list, kwargs: dict):
-        """Evaluate the function `func_name` on `self.tem` and call it with
-        `args` and `kwargs`."""
-        print(func_name, args, kwargs)
-        f = getattr(self.tem, func_name)
-        ret = f(*args, **kwargs)
-        return ret
-
-def handle(conn, q):
-    """Handle incoming connection, put command on the Queue `q`, which is then
-    handled by TEMServer."""
-    with conn:
-        while True:
-            if stop_program_event.is_set():
-                break
-            
-            data = conn.recv(BUFSIZE)
-            if not data:
-                break
-
-            data = loader(data)
-            
-            if data == 'exit':
-                break
+                    response = (500, (e.__class__.__name__, e.args))
+                connection.send(response, seq, trace, timestamp)
+                continue
 
-            if data == 'kill':
-                break
+            if func_name == '__profile_stop__':
+                try:
+                    response = (200, profile_stop(*data.get('args', ()), **data.get('kwargs', {})))
+                except Exception as e:
+                    response = (500, (e.__class__.__name__, e.args))
+                connection.send(response, seq, trace, timestamp)
+                continue
+
+            if func_name == '__cancel__':
+                # answered right away, the queue is busy with the sequence to cancel
+                connection.send((200, server.cancel()), seq, trace, timestamp)
+                continue
+
+            if func_name == '__stream__':
+                # runs in its own thread, the stream messages carry `seq`
+                start_stream(connection, server, data)
+                continue
+
+            if func_name == '__wait_until__':
+                # answered when the conditions hold, asynchronously on framed connections
+                start_trigger(connection, server, data)
+                continue
+
+            if func_name == '__subscribe__':
+                # change events are pushed as (102, event, seq) until `__unsubscribe__`
+                if not connection.framed or seq is None:
+                    connection.send((500, ('ValueError', ('Subscriptions need a framed connection and a `seq`.',))), seq, None, timestamp)
+                    continue
+                key = (connection, seq)
+                server.changes.subscribe(key, lambda event, seq=seq: connection.send((102, event), seq))
+                connection.subscriptions.append((server.changes, key))
+                continue
+
+            if func_name == '__unsubscribe__':
+                key = (connection, data.get('args', (None,))[0])
+                found = server.changes.unsubscribe(key)
+                if found:
+                    connection.send((200, server.changes.version), key[1])
+                connection.send((200, found), seq, None, timestamp)
+                continue
+
+            if func_name == '__unstream__':
+                stream = connection.streams.get(data.get('args', (None,))[0])
+                if stream:
+                    stream.stop()
+                connection.send((200, stream is not None), seq, None, timestamp)
+                continue
+
+            if not server.ready.is_set():
+                if func_name in server.static:
+                    connection.send((200, server.static[func_name]), seq, trace, timestamp)
+                    continue
+                if not server.ready.wait(INIT_WAIT):
+                    message = 'Microscope %s is still initializing, try again later.' % (instance)
+                    connection.send((500, ('TEMCommunicationError', (message,))), seq, trace, timestamp)
+                    continue
+
+            # progress can only be streamed to framed connections
+            reply = Reply(stream=bool(data.get('stream')) and connection.framed, trace=trace)
+            if connection.framed and seq is not None:
+                reply.callback = functools.partial(respond, connection, reply, seq, timestamp)
+                reply.on_progress = functools.partial(send_progress, connection, seq)
+            job = reply
+            request_id = data.get('request_id')
+            if request_id is not None:
+                # a retry is answered by the first run of the request
+                job = Reply(stream=reply.stream, trace=trace)
+                if not server.results.submit(request_id, func_name, reply, job):
+                    job = None
+            if job is not None:
+                try:
+                    server.q.put((data, job), key=connection.key,
+                                 client=data.get('client') or connection.client,
+                                 readonly=server.is_readonly(func_name))
+                except TEMServerBusyError as e:
+                    job.set((500, (e.__class__.__name__, e.args)))
+            if reply.callback is None:
+                response = reply.wait(on_progress=lambda message: connection.send(message, seq))
+                connection.send(response, seq, reply.trace, timestamp, reply.executed)
+            continue
 
-            with condition:
-                q.put(data)
-                condition.wait()
-                response = box.pop()
-                conn.send(dumper(response))
+        connection.send(response, seq, trace, timestamp)
 
 
 def handle_kb_interrupt(sig, frame):
     stop_program_event.set()
 
 
-def main():
+def get_instances(microscope: str = None, instances: list = None) -> list:
+    """Return the list of (instance name, microscope) pairs to host.
 
-    import argparse
-    description = """
-Connects to the TEM and starts a server for microscope communication. Opens a socket on port {HOST}:{PORT}.
+    `instances` is a list of `name=microscope` strings, for example from
+    the command line. If it is empty, the `tem_server_instances` list
+    from the settings is used, or else the single `microscope`.
+    """
+    if instances:
+        pairs = []
+        for item in instances:
+            name, sep, micr = item.partition('=')
+            pairs.append((name, micr if sep else name))
+        return pairs
 
-This program initializes a connection to the TEM as defined in the config. The purpose of this program is to isolate the microscope connection in a separate process for improved stability of the interface in case instamatic crashes or is started and stopped frequently. For running the GUI, the temserver is required. Another reason is that it allows for remote connections from different PCs. The connection goes over a TCP socket.
+    pairs = [(d['name'], d.get('microscope', d['name']))
+             for d in _conf.default_settings.get('tem_server_instances') or ()]
+    if pairs and not microscope:
+        return pairs
 
-The host and port are defined in `config/settings.yaml`.
+    # a single instance is named after its microscope
+    return [(microscope or _conf.default_settings['microscope'], microscope)]
 
-The data sent over the socket is a serialized dictionary with the following elements:
 
-- `func_name`: Name of the function to call (str)
-- `args`: (Optional) List of arguments for the function (list)
-- `kwargs`: (Optiona) Dictionary of keyword arguments for the function (dict)
+def main():
 
-The response is returned as a serialized object.
-"""
-    
-    parser = argparse.ArgumentParser(
-        description=description,
-        formatter_class=argparse.RawDescriptionHelpFormatter)
+    import argparse
+    description = ('Connects to the TEM and starts a server for microscope communication on %s:%s. '
+                   'See README.md for the protocol.' % (HOST, PORT))
+
+    parser = argparse.ArgumentParser(description=description)
 
     parser.add_argument('-t', '--microscope', action='store', dest='microscope',
                         help="""Override microscope to use.""")
+    parser.add_argument('-i', '--instance', action='append', dest='instances',
+                        metavar='NAME=MICROSCOPE',
+                        help="""Host the microscope config MICROSCOPE as instance NAME (repeatable).""")
 
-    parser.set_defaults(microscope=None)
+    parser.set_defaults(microscope=None, instances=None)
     options = parser.parse_args()
     microscope = options.microscope
 
     logging.basicConfig(filename='tem_server.log', level=logging.INFO)
 
-    q = queue.Queue(maxsize=100)
+    metrics = Metrics()
+    servers, default = start_servers(get_instances(microscope, options.instances), metrics)
 
-    tem_reader = TemServer(name=microscope, log=None, q=q)
-    tem_reader.start()
-    
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.bind((HOST, PORT))
     s.listen(0)
 
     logging.info("Server listening on %s:%s" % (HOST, PORT))
     print ("Server listening on %s:%s" % (HOST, PORT))
+    print ("Microscope instances: %s (default: %s)" % (', '.join(sorted(servers)), default))
 
     signal.signal(signal.SIGINT, handle_kb_interrupt)
-    
+
+    serve(s, servers, default, metrics)
+
+
+def start_servers(instances: list, metrics=None, daemon: bool = False):
+    """Start a `TemServer` for every (instance name, microscope) pair in
+    `instances`, and its telemetry if enabled. Returns the dict of
+    servers by instance name and the name of the default instance. With
+    `daemon`, the server threads do not keep the process alive."""
+    traces = TraceStore()
+    macros = load_macros()
+    servers = {}
+    default = None
+    n_tecnai = 0
+
+    for instance, name in instances:
+        if get_interface(name) == 'tecnai':
+            n_tecnai += 1
+        if n_tecnai > 1:
+            raise ValueError('Only one `tecnai` microscope instance can be hosted per process.')
+
+        q = FairQueue(maxsize=QUEUE_SIZE,
+                      clients=_conf.default_settings.get('tem_server_clients'),
+                      shed_reads=_conf.default_settings.get('tem_server_shed_reads', False))
+        tem_reader = TemServer(name=name, instance=instance, log=None, q=q, metrics=metrics, macros=macros,
+                                traces=traces)
+        tem_reader.daemon = daemon
+        tem_reader.start()
+
+        servers[instance] = tem_reader
+
+        settings = _conf.default_settings
+        if settings.get('telemetry'):
+            properties = settings.get('telemetry_properties')
+            writer = TelemetryWriter(
+                settings.get('telemetry_directory', 'telemetry'),
+                prefix=instance,
+                columns=columns_for(properties),
+                rows_per_file=settings.get('telemetry_rows_per_file', 86400),
+                max_files=settings.get('telemetry_max_files', 30),
+            )
+            TelemetrySampler(tem_reader, writer, properties,
+                             interval=settings.get('telemetry_interval', 1.0)).start()
+        if default is None:
+            default = instance
+
+    return servers, default
+
+
+def serve(s, servers: dict, default: str, metrics=None):
+    """Accept connections on the listening socket `s` and handle each on
+    its own thread."""
     with s:
         while True:
             conn, addr = s.accept()
             #logging.info('Connected by %s' % (addr))
 #            print('Connected by', addr)
-            command_thread = threading.Thread(target=handle, args=(conn, q))
+            command_thread = threading.Thread(target=handle, args=(conn, servers, default, metrics),
+                                              name='connection %s:%s' % addr[:2])
+            command_thread.daemon = True
             command_thread.start()
-            command_thread.join()
 
 
 
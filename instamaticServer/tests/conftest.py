@@ -0,0 +1,38 @@
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import Metrics  # noqa: E402
+from tem_server import serve, start_servers  # noqa: E402
+
+
+class Server:
+    """A tem_server on an ephemeral localhost port, hosting the simulator."""
+
+    def __init__(self):
+        self.servers, self.default = start_servers([('simulate', 'simulate')], Metrics(), daemon=True)
+        self.tem_server = self.servers[self.default]
+        self.tem_server.ready.wait()
+        if self.tem_server.init_error is not None:
+            raise self.tem_server.init_error
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        s.listen(5)
+        self.host, self.port = s.getsockname()[:2]
+        listener = threading.Thread(target=serve, args=(s, self.servers, self.default), name='listener')
+        listener.daemon = True
+        listener.start()
+
+    def connect(self) -> socket.socket:
+        return socket.create_connection((self.host, self.port), timeout=10.0)
+
+
+@pytest.fixture(scope='session')
+def server():
+    return Server()
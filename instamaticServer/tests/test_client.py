@@ -0,0 +1,113 @@
+import socket
+import threading
+import time
+
+import pytest
+
+import client
+from client import TemClient
+from serializer import dumper, frame, loader
+from utils.exceptions import TEMValueError
+
+
+def plain_call(server, request: dict):
+    with server.connect() as sock:
+        sock.sendall(dumper(request))
+        return loader(sock.recv(65536))
+
+
+def test_call_timestamped(server):
+    with TemClient(server.host, server.port) as tem:
+        value, (start, end) = tem.call_timestamped('getBeamShift')
+        assert len(value) == 2
+        assert start <= end
+
+
+def test_timestamped_error_response(server):
+    response = plain_call(server, {'func_name': 'getBeamShift', 'args': (), 'kwargs': {},
+                                   'microscope': 'nope', 'timestamp': True, 'seq': 7})
+    assert response[0] == 500
+    assert response[2:] == (7, None)
+
+    with TemClient(server.host, server.port, microscope='nope') as tem:
+        with pytest.raises(TEMValueError):
+            tem.call_timestamped('getBeamShift')
+
+
+def test_timestamped_out_of_band_response(server):
+    response = plain_call(server, {'func_name': '__ping__', 'timestamp': True})
+    assert response[0] == 200
+    assert len(response) == 4
+
+
+def test_stalled_client_does_not_block_others(server):
+    # a framed client that pipelines requests for 2 s but never reads the
+    # responses, much more than the socket buffers hold
+    stalled = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    stalled.connect((server.host, server.port))
+    requests = b''.join(frame(dumper({'func_name': '__methods__', 'seq': i})) for i in range(50))
+    stop = threading.Event()
+
+    def flood():
+        t_end = time.perf_counter() + 2.0
+        while not stop.is_set() and time.perf_counter() < t_end:
+            stalled.sendall(requests)
+            time.sleep(0.02)
+
+    flooder = threading.Thread(target=flood)
+    flooder.start()
+    try:
+        time.sleep(0.5)
+        with TemClient(server.host, server.port, timeout=5.0, retries=0) as tem:
+            for i in range(10):
+                tem.getBeamShift()
+    finally:
+        stop.set()
+        flooder.join()
+        stalled.close()
+
+
+def test_request_ids_before_methods_are_loaded(server):
+    with TemClient(server.host, server.port) as tem:
+        assert 'request_id' not in tem._request('getBeamShift', (), {})
+        assert 'request_id' not in tem._request('isBeamBlanked', (), {})
+        assert 'request_id' in tem._request('setBeamShift', (1, 2), {})
+        assert tem._methods is None
+
+
+def test_retried_request_runs_once(server):
+    with TemClient(server.host, server.port) as tem:
+        tem.setBeamShift(0, 0)
+        request = tem._request('setBeamShiftRelative', (5, 0), {})
+        responses = tem._exchange([request])
+        # a retry after a timeout, on another connection
+        responses += tem._exchange([request])
+        assert responses[0][:2] == responses[1][:2] == (200, (5, 0))
+        assert tuple(tem.getBeamShift()) == (5, 0)
+
+
+def test_naive_call(server):
+    assert len(client.naive_call('getBeamShift', host=server.host, port=server.port)) == 2
+
+
+def test_naive_call_closed(server):
+    # a server that closes the connection without answering
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    s.listen(1)
+
+    def serve():
+        conn, addr = s.accept()
+        conn.recv(65536)
+        conn.sendall(dumper((200, 'x' * 100))[:10])
+        conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    try:
+        with pytest.raises(ConnectionError):
+            client.naive_call('getBeamShift', host='127.0.0.1', port=s.getsockname()[1])
+    finally:
+        thread.join()
+        s.close()
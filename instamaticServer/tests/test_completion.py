@@ -0,0 +1,20 @@
+import time
+
+import pytest
+
+from TEMController.completion import Completion
+from utils.exceptions import TEMCommunicationError
+
+
+def test_timeout():
+    completion = Completion({'interval': [0.001, 0.001], 'move': {'timeout': 0.05}})
+    with pytest.raises(TEMCommunicationError):
+        completion.wait('move', lambda: False)
+
+
+def test_scaled_timeout():
+    completion = Completion({'interval': [0.001, 0.001], 'move': {'timeout': 0.05}})
+    t_done = time.perf_counter() + 0.1
+    # a move at a quarter of the speed completes after twice the timeout
+    duration = completion.wait('move', lambda: time.perf_counter() > t_done, scale=4.0)
+    assert duration > 0.05
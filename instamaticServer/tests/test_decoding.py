@@ -0,0 +1,52 @@
+import client
+from serializer import FRAME_HEADER, FRAME_MAGIC, dumper, loader, truncated
+
+
+def receive(sock):
+    data = b''
+    while True:
+        data += sock.recv(65536)
+        try:
+            return loader(data)
+        except Exception as e:
+            if not truncated(e, data):
+                raise
+
+
+def test_truncated():
+    data = dumper({'func_name': 'setBeamShift', 'args': (1.5, -2), 'kwargs': {'text': 'h\xe9llo'}})
+    for i in range(len(data)):
+        try:
+            loader(data[:i])
+        except Exception as e:
+            assert truncated(e, data[:i])
+
+
+def test_malformed_plain_request(server):
+    with server.connect() as sock:
+        sock.sendall(b'GET / HTTP/1.1\r\n\r\n')
+        status, (name, args) = receive(sock)
+        assert (status, name) == (500, 'TEMValueError')
+
+        # the connection is still usable
+        sock.sendall(dumper({'func_name': '__ping__'}))
+        assert receive(sock)[0] == 200
+
+
+def test_large_plain_request(server):
+    with server.connect() as sock:
+        sock.sendall(dumper({'func_name': '__ping__', 'padding': 'x' * 4000000}))
+        assert receive(sock)[0] == 200
+
+
+def test_malformed_framed_request(server):
+    conn = client.Connection(server.host, server.port, timeout=10.0)
+    conn.connect()
+    try:
+        conn.sock.sendall(FRAME_HEADER.pack(FRAME_MAGIC, 5) + b'junk!')
+        conn.send({'func_name': '__ping__', 'seq': 1})
+        status, (name, args) = conn.receive()
+        assert (status, name) == (500, 'TEMValueError')
+        assert conn.receive()[::2] == (200, 1)
+    finally:
+        conn.close()
@@ -0,0 +1,45 @@
+import pytest
+
+from client import TemClient
+from dispatch import build_table
+from utils.exceptions import TEMValueError
+
+
+class Microscope:
+    def getValue(self) -> int:
+        return 1
+
+    def setValue(self, x: float, y: float = 0.0, *, wait: bool) -> tuple:
+        return x, y, wait
+
+    def planStageTour(self, targets: list) -> list:
+        return targets
+
+
+def test_nargs():
+    command = build_table(Microscope())['setValue']
+    assert command.nargs == (1, 2)
+    assert command((1,), {'wait': True}) == (1.0, 0.0, True)
+    assert command((), {'x': 2, 'wait': False}) == (2.0, 0.0, False)
+    with pytest.raises(TEMValueError):
+        command((1, 2, 3), {'wait': True})
+    with pytest.raises(TEMValueError):
+        command((1,), {})
+    with pytest.raises(TEMValueError):
+        command((), {'y': 1, 'wait': True})
+
+
+def test_readonly():
+    table = build_table(Microscope())
+    assert table['getValue'].readonly
+    assert not table['setValue'].readonly
+    assert not table['planStageTour'].readonly
+    assert table['planStageTour'].changes == ()
+
+
+def test_wrong_nargs_over_network(server):
+    with TemClient(server.host, server.port) as tem:
+        with pytest.raises(TEMValueError):
+            tem.call('setBeamShift', 1)
+        with pytest.raises(TEMValueError):
+            tem.call('getBeamShift', 1)
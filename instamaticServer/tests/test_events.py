@@ -0,0 +1,43 @@
+import client
+
+
+def sample(server, getter: str, max_age: float = 3600.0):
+    status, values = server.tem_server.call('__sample__', [getter], max_age)
+    assert status == 200
+    return values[getter]
+
+
+def test_macro_invalidates_last_read(server):
+    server.tem_server.call('setBeamShift', 1, 2)
+    assert tuple(sample(server, 'getBeamShift', 0.0)) == (1, 2)
+
+    status, value = server.tem_server.call('__run_macro__', [{'call': 'setBeamShift', 'args': [123, 456]}])
+    assert status == 200
+    assert tuple(sample(server, 'getBeamShift')) == (123, 456)
+
+
+def test_scan_invalidates_last_read(server):
+    server.tem_server.call('setImageShift1', 0, 0)
+    assert tuple(sample(server, 'getImageShift1', 0.0)) == (0, 0)
+
+    status, value = server.tem_server.call('rasterScan', 'ImageShift1', points=[(10, 20), (30, 40)],
+                                           dwell=0.0, return_to_start=False)
+    assert status == 200
+    assert tuple(sample(server, 'getImageShift1')) == (30, 40)
+
+
+def test_macro_publishes_change_events(server):
+    conn = client.Connection(server.host, server.port, timeout=10.0)
+    conn.connect()
+    try:
+        conn.send({'func_name': '__subscribe__', 'seq': 1})
+        with client.TemClient(server.host, server.port) as tem:
+            tem.call('__run_macro__', [{'call': 'setBeamShift', 'args': [-7, 8]}])
+        while True:
+            status, event, seq = conn.receive()
+            assert (status, seq) == (102, 1)
+            if event.get('command') == 'setBeamShift':
+                break
+        assert tuple(event['changes']['BeamShift']) == (-7, 8)
+    finally:
+        conn.close()
@@ -0,0 +1,41 @@
+import socket
+import threading
+
+import pytest
+
+from client import Connection as ClientConnection
+from gateway import Gateway, Upstream, handle
+
+
+@pytest.fixture
+def gateway(server):
+    gateway = Gateway(Upstream(server.host, server.port))
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    s.listen(5)
+
+    def accept():
+        while True:
+            conn, addr = s.accept()
+            thread = threading.Thread(target=handle, args=(conn, gateway))
+            thread.daemon = True
+            thread.start()
+
+    listener = threading.Thread(target=accept)
+    listener.daemon = True
+    listener.start()
+    yield s.getsockname()[:2]
+    s.close()
+
+
+def test_replies_in_order(gateway):
+    conn = ClientConnection(*gateway, timeout=10.0)
+    conn.connect()
+    try:
+        for i in range(20):
+            conn.send({'func_name': 'getBeamShift', 'seq': 2 * i})
+            conn.send({'func_name': '__gateway__', 'seq': 2 * i + 1})
+        seqs = [conn.receive()[2] for i in range(40)]
+        assert seqs == list(range(40))
+    finally:
+        conn.close()
@@ -0,0 +1,21 @@
+import pytest
+
+from macro import MacroRunner, validate
+from utils.exceptions import TEMValueError
+
+
+def test_recursive_macro_is_limited():
+    runner = MacroRunner(lambda func_name, args, kwargs: None, macros={'loop': [{'macro': 'loop'}]})
+    with pytest.raises(TEMValueError):
+        runner.run([{'macro': 'loop'}])
+
+
+def test_run_macro_step_rejected(server):
+    with pytest.raises(TEMValueError):
+        validate([{'repeat': 2, 'steps': [{'call': '__run_macro__', 'args': ['loop']}]}])
+
+    status, value = server.tem_server.call('__define_macro__', 'loop', [{'call': '__run_macro__', 'args': ['loop']}])
+    assert status == 500
+    assert value[0] == 'TEMValueError'
+    status, value = server.tem_server.call('__run_macro__', [{'call': '__run_macro__', 'args': [[]]}])
+    assert status == 500
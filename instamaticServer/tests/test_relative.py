@@ -0,0 +1,25 @@
+import pytest
+
+from client import TemClient
+
+
+def test_stage_position_relative(server):
+    with TemClient(server.host, server.port) as tem:
+        tem.setStagePosition(1000, 2000, 300, 5.0, 0.0)
+        start = tem.getStagePosition()
+        tem.setStagePositionRelative(dx=500, da=-2.0)
+        x, y, z, a, b = tem.getStagePosition()
+        assert x == pytest.approx(start[0] + 500)
+        assert a == pytest.approx(start[3] - 2.0)
+        # axes without a delta are not moved
+        assert (y, z, b) == (start[1], start[2], start[4])
+
+
+def test_deflector_relative(server):
+    with TemClient(server.host, server.port) as tem:
+        tem.setBeamShift(100, -100)
+        assert tuple(tem.setBeamShiftRelative(dx=10)) == (110, -100)
+        tem.setImageShift1(0, 0)
+        tem.setImageShift1Relative(dy=-3)
+        tem.setImageShift1Relative(dy=-3)
+        assert tuple(tem.getImageShift1()) == (0, -6)
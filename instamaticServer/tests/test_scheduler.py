@@ -0,0 +1,22 @@
+import threading
+import time
+
+from scheduler import FairQueue
+
+
+def test_close_during_rate_limit():
+    q = FairQueue(clients={'default': {'rate': 10.0, 'burst': 1}})
+    q.put('first', key='a')
+    assert q.get() == 'first'
+    q.close('a')
+
+    # the second command waits 0.1 s for its token
+    putter = threading.Thread(target=q.put, args=('second',), kwargs={'key': 'a'})
+    putter.start()
+    time.sleep(0.03)
+    q.close('a')
+    putter.join()
+
+    assert q.qsize() == 1
+    assert q.get() == 'second'
+    assert q.stats()['a']['depth'] == 0
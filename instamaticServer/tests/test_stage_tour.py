@@ -0,0 +1,28 @@
+import random
+
+import pytest
+
+from TEMController.stage_tour import StageModel, plan_tour
+from utils.exceptions import TEMValueError
+
+
+def test_plan_tour_visits_every_target():
+    rnd = random.Random(1)
+    positions = [(rnd.uniform(-1e5, 1e5), rnd.uniform(-1e5, 1e5), 0.0, 0.0) for i in range(30)]
+    order = plan_tour(StageModel({}), (0.0, 0.0, 0.0, 0.0), positions)
+    assert sorted(order) == list(range(30))
+
+
+def test_plan_tour_is_bounded():
+    positions = [(float(i), 0.0, 0.0, 0.0) for i in range(2000)]
+    with pytest.raises(TEMValueError):
+        plan_tour(StageModel({}), (0.0, 0.0, 0.0, 0.0), positions, max_time=0.01)
+
+
+def test_plan_is_not_a_getter(server):
+    command = server.tem_server.commands['planStageTour']
+    assert not command.readonly
+    assert not server.tem_server.is_readonly('planStageTour')
+    status, tour = server.tem_server.call('planStageTour', [(1000, 0), (0, 0), (500, 0)])
+    assert status == 200
+    assert sorted(tour['order']) == [0, 1, 2]
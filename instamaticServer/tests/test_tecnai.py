@@ -0,0 +1,55 @@
+"""Tests of `TecnaiMicroscope` against the model of the COM scripting
+interface in `fake_com`."""
+import pytest
+
+from TEMController import fake_com
+from TEMController.tecnai_microscope import FakeTecnaiMicroscope
+
+
+@pytest.fixture
+def tem():
+    tem = FakeTecnaiMicroscope()
+    # a fresh instrument for every test, the microscope is a singleton
+    tem._tem = fake_com.Instrument(tem._tem.Projection._ranges)
+    return tem
+
+
+def test_diffraction_defocus_units(tem):
+    tem._tem.Projection.Defocus = 0.0
+    assert tem._getDefocus(diffraction=True) == tem._toDiffFocus(0.0) == 32768
+    tem._setDefocus(0, diffraction=True)
+    assert tem._tem.Projection.Defocus == pytest.approx(-1e-4)
+    tem._setDefocus(1e-6)
+    assert tem._getDefocus() == 1e-6
+
+
+def test_get_magnification_keeps_ranges(tem):
+    ranges = tem._mic_ranges
+    n_lowmag = len(ranges['LM'])
+    imaging = ranges['LM'] + ranges['Mi'] + ranges['SA'] + ranges['Mh']
+    for index in (1, 5, len(imaging)):
+        tem._tem.Projection.MagnificationIndex = index
+        for i in range(3):
+            assert tem.getMagnification() == imaging[index - 1]
+    tem.setMagnification(imaging[-2])
+    assert tem._tem.Projection.MagnificationIndex == len(imaging) - 1
+    assert len(ranges['LM']) == n_lowmag
+
+
+def test_diffraction_sweep_restores_defocus(tem):
+    tem.setFunctionMode('diff')
+    tem._tem.Projection.Defocus = 1.23456789e-6
+    assert tem.getDiffFocus() == 33173  # 33172.54, rounded
+    result = tem.sweepFocus(33000, 33400, 100, settle=0.0, diffraction=True)
+    assert result['values'] == [33000, 33100, 33200, 33300, 33400]
+    assert tem._tem.Projection.Defocus == 1.23456789e-6
+
+
+def test_stage_move(tem):
+    tem.setStagePositionRelative(dx=2000, da=1.0)
+    assert tem.getStagePosition() == pytest.approx((2000, 0, 0, 1.0, 0))
+    # at a tenth of the speed, the move takes ten times longer
+    tem.setRotationSpeed(0.1)
+    assert tem.waitForStage() < 0.01
+    tem.setStageA(0.7)
+    assert tem.getCompletionTimes()['waitForStage'] > 0.3 / (10 * 0.1)
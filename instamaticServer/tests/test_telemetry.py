@@ -0,0 +1,58 @@
+import numpy as np
+
+from telemetry import TelemetryReader, TelemetryWriter, columns_for, flatten, read_directory
+from utils.config import config
+
+
+def test_default_properties(server):
+    properties = config().default_settings['telemetry_properties']
+    assert all(prop in server.tem_server.commands for prop in properties)
+
+
+def write(directory, n: int, rows_per_file: int = 4, max_files: int = 3) -> TelemetryWriter:
+    properties = ['getBeamShift', 'getFocus']
+    writer = TelemetryWriter(str(directory), 'simulate', columns_for(properties),
+                             rows_per_file=rows_per_file, max_files=max_files)
+    for i in range(n):
+        values = {'getBeamShift': (i, -i), 'getFocus': None if i == 2 else 10 * i}
+        writer.append([float(i)] + flatten(properties, values))
+    return writer
+
+
+def test_rotation(tmp_path):
+    writer = write(tmp_path, 10)
+    try:
+        files = writer.files()
+        assert len(files) == 3
+        counts = [TelemetryReader(path).count for path in files]
+        assert counts == [4, 4, 2]
+    finally:
+        writer.close()
+
+
+def test_max_files(tmp_path):
+    writer = write(tmp_path, 30)
+    writer.close()
+    files = writer.files()
+    assert len(files) == 3
+    # the oldest rows are gone
+    assert TelemetryReader(files[0])['time'][0] == 20.0
+
+
+def test_read_range(tmp_path):
+    writer = write(tmp_path, 10)
+    try:
+        # a file still being written is read as well
+        tlm = TelemetryReader(writer.files()[0])
+        assert tlm.columns == ['time', 'beamshift_x', 'beamshift_y', 'focus']
+        part = tlm.range(1.0, 3.0)
+        assert list(part['beamshift_y']) == [-1.0, -2.0]
+        assert np.isnan(part['focus'][1])
+        # views on the file, not copies
+        assert not part['time'].flags.owndata
+
+        data = read_directory(str(tmp_path), 'simulate', 3.0, 9.0)
+        assert list(data['time']) == [3.0, 4.0, 5.0, 6.0, 7.0, 8.0]
+        assert list(data['focus']) == [30.0, 40.0, 50.0, 60.0, 70.0, 80.0]
+    finally:
+        writer.close()
@@ -0,0 +1,21 @@
+import time
+
+import clock
+from triggers import Trigger
+
+
+def test_trigger_time():
+    reads = []
+
+    def sample(getters):
+        time.sleep(0.002)
+        reads.append(clock.now())
+        return {'getFocus': 10 * len(reads)}
+
+    t_start = clock.now()
+    trigger = Trigger(sample, [{'getter': 'getFocus', 'op': 'rises', 'value': 25}], interval=0.001)
+    result = trigger.wait_for()
+    assert result['triggered'] and result['samples'] == 3
+    # the read took 2 ms, measured with the server clock
+    assert t_start < result['time'] - result['uncertainty'] < reads[-1] < result['time'] + result['uncertainty']
+    assert 0.001 <= result['uncertainty'] < 0.005
@@ -0,0 +1,91 @@
+import collections
+import os
+import threading
+
+from clock import from_perf_counter
+
+# spans kept in memory, the oldest are dropped first
+TRACE_BUFFER_SIZE = 20000
+
+# phases of a traced request, in order
+PHASES = ('receive', 'decode', 'queue', 'dispatch', 'execute', 'encode', 'send')
+
+
+class Trace:
+    """Records the spans of one request with trace ID `trace_id` in
+    `store`, `func_name` and `instance` are added to every span."""
+
+    __slots__ = ('store', 'trace_id', 'func_name', 'instance')
+
+    def __init__(self, store, trace_id, func_name: str = None, instance: str = None):
+        self.store = store
+        self.trace_id = trace_id
+        self.func_name = func_name
+        self.instance = instance
+
+    def add(self, name: str, t0: float, t1: float, thread: str = None) -> None:
+        """Add span `name` from `t0` to `t1` (time.perf_counter) on the
+        calling thread, labelled `thread` in the trace viewer."""
+        self.store.add((self.trace_id, name, t0, t1, threading.get_ident(), thread,
+                        self.func_name, self.instance))
+
+
+class TraceStore:
+    """Bounded in-memory store of the spans of traced requests.
+
+    A request is traced if it carries a `trace` ID. The connection
+    records the receive, decode, encode and send phases, the worker of
+    the microscope instance the queue wait, the dispatch and the
+    execution on the microscope. `export` returns them in the Chrome
+    trace-event format, to be opened in chrome://tracing or Perfetto.
+    """
+
+    def __init__(self, maxlen: int = TRACE_BUFFER_SIZE):
+        self._spans = collections.deque(maxlen=maxlen)
+
+    def begin(self, trace_id, func_name: str = None, instance: str = None) -> Trace:
+        return Trace(self, trace_id, func_name, instance)
+
+    def add(self, span: tuple) -> None:
+        self._spans.append(span)
+
+    def clear(self) -> None:
+        self._spans.clear()
+
+    def trace_ids(self) -> list:
+        """Return the trace IDs in the store, oldest first."""
+        return list(collections.OrderedDict.fromkeys(span[0] for span in list(self._spans)))
+
+    def export(self, trace_ids: list = None, last: int = None) -> dict:
+        """Return the spans of `trace_ids`, or of the `last` n traces, or
+        all, as a Chrome trace-event JSON object."""
+        spans = list(self._spans)
+        if trace_ids is None and last is not None:
+            trace_ids = self.trace_ids()[-last:] if last > 0 else []
+        if trace_ids is not None:
+            wanted = set(trace_ids)
+            spans = [span for span in spans if span[0] in wanted]
+
+        pid = os.getpid()
+        events = []
+        threads = {}
+        for trace_id, name, t0, t1, tid, thread, func_name, instance in spans:
+            if thread:
+                threads[tid] = thread
+            events.append({
+                'name': name,
+                'cat': 'request',
+                'ph': 'X',
+                'ts': from_perf_counter(t0) * 1e6,
+                'dur': (t1 - t0) * 1e6,
+                'pid': pid,
+                'tid': tid,
+                'args': {'trace': trace_id, 'command': func_name, 'microscope': instance},
+            })
+        for tid, thread in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                           'args': {'name': thread}})
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+                       'args': {'name': 'tem_server'}})
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
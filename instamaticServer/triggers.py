@@ -0,0 +1,163 @@
+import operator
+import threading
+import time
+
+import clock
+
+# default and smallest interval in s between two samples of a trigger
+SAMPLE_INTERVAL = 0.01
+MIN_SAMPLE_INTERVAL = 0.001
+
+
+def _within(value, condition, previous):
+    return abs(value - condition.value) <= condition.tolerance
+
+
+def _rises(value, condition, previous):
+    return previous is not None and previous < condition.value <= value
+
+
+def _falls(value, condition, previous):
+    return previous is not None and previous > condition.value >= value
+
+
+def _crosses(value, condition, previous):
+    return _rises(value, condition, previous) or _falls(value, condition, previous)
+
+
+def _compare(op):
+    return lambda value, condition, previous: op(value, condition.value)
+
+
+# predicates, called with the value, the `Condition` and the previous value
+PREDICATES = {
+    '==': _compare(operator.eq),
+    '!=': _compare(operator.ne),
+    '<': _compare(operator.lt),
+    '<=': _compare(operator.le),
+    '>': _compare(operator.gt),
+    '>=': _compare(operator.ge),
+    'within': _within,
+    'rises': _rises,
+    'falls': _falls,
+    'crosses': _crosses,
+}
+
+
+class Condition:
+    """Predicate on the value of a getter without arguments.
+
+    Created from a dict with the `getter`, the `op` (see `PREDICATES`)
+    and the `value` to compare with. `index` selects an element of a
+    getter returning a tuple, and `tolerance` is used by `within`:
+
+        {'getter': 'getStagePosition', 'index': 3, 'op': 'crosses', 'value': 30}
+        {'getter': 'isStageMoving', 'op': '==', 'value': False}
+        {'getter': 'getFocus', 'op': 'within', 'value': 0, 'tolerance': 50}
+
+    `rises`, `falls` and `crosses` become true when the value passes
+    `value` between two samples.
+    """
+
+    def __init__(self, dct: dict):
+        try:
+            self.getter = dct['getter']
+            self.op = dct.get('op', '==')
+            self.value = dct['value']
+        except (KeyError, TypeError):
+            raise ValueError('A condition needs a `getter` and a `value`, got: %r' % (dct,))
+        if self.op not in PREDICATES:
+            raise ValueError('No such condition operator: %s' % (self.op))
+        self.index = dct.get('index')
+        self.tolerance = dct.get('tolerance', 0.0)
+        self._predicate = PREDICATES[self.op]
+        self._previous = None
+
+    def select(self, values: dict):
+        value = values.get(self.getter)
+        if value is not None and self.index is not None:
+            value = value[self.index]
+        return value
+
+    def test(self, values: dict) -> bool:
+        value = self.select(values)
+        if value is None:
+            return False  # the read failed
+        previous, self._previous = self._previous, value
+        return bool(self._predicate(value, self, previous))
+
+
+class Trigger(threading.Thread):
+    """Samples the microscope until all `conditions` hold.
+
+    `sample(getters)` returns the dict of the current values of the
+    getters. They are sampled every `interval` s until the conditions
+    are true, or for at most `timeout` s. The result is a dict with
+    `triggered`, the `time` of the sample that triggered (server time,
+    see `clock.now`, at the middle of the read, which is accurate to
+    +/- `uncertainty` s),
+    the `values` of that sample and the number of `samples` taken.
+
+    `wait_for` runs the trigger on the calling thread, `start` on its
+    own, passing the result to `done(result)`, or the exception raised
+    by `sample` to `done(None, error)`.
+    """
+
+    def __init__(self, sample, conditions: list, interval: float = SAMPLE_INTERVAL,
+                 timeout: float = None, done=None):
+        super().__init__()
+        self.daemon = True
+        if not conditions:
+            raise ValueError('A trigger needs at least one condition.')
+        self.conditions = [c if isinstance(c, Condition) else Condition(c) for c in conditions]
+        self.getters = sorted(set(c.getter for c in self.conditions))
+        self.sample = sample
+        self.interval = max(MIN_SAMPLE_INTERVAL, float(interval))
+        self.timeout = timeout
+        self.done = done
+        self._stop_event = threading.Event()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def wait_for(self) -> dict:
+        t_start = time.perf_counter()
+        t_next = t_start
+        n = 0
+        while True:
+            t0 = clock.now()
+            values = self.sample(self.getters)
+            t1 = clock.now()
+            n += 1
+            # every condition is tested, to keep their previous values up to date
+            results = [c.test(values) for c in self.conditions]
+            if all(results):
+                return {
+                    'triggered': True,
+                    'time': (t0 + t1) / 2,
+                    'uncertainty': (t1 - t0) / 2,
+                    'values': values,
+                    'samples': n,
+                    'elapsed': time.perf_counter() - t_start,
+                }
+
+            t_next += self.interval
+            now = time.perf_counter()
+            timed_out = self.timeout is not None and now - t_start > self.timeout
+            if timed_out or self._stop_event.wait(max(0.0, t_next - now)):
+                return {
+                    'triggered': False,
+                    'time': None,
+                    'uncertainty': None,
+                    'values': values,
+                    'samples': n,
+                    'elapsed': now - t_start,
+                }
+
+    def run(self):
+        try:
+            result = self.wait_for()
+        except Exception as e:
+            self.done(None, e)
+        else:
+            self.done(result)
@@ -14,6 +14,7 @@ class config:
             self.default_settings['microscope'] = name
 
         self.micr_interface, self.micr_wavelength, self.micr_ranges = self.microscope()
+        self.micr_simulation = self.micr_settings.get('simulation') or {}
 
     def settings(self) -> dict:
         """load the settings.yaml file."""
@@ -31,11 +32,12 @@ class config:
         default = None
         
         direc = Path(__file__).resolve().parent
-        microscope_file = '\\' + str(self.default_settings['microscope']) + '.yaml'
-        file = str(direc) + microscope_file
-        with open(file, 'r') as stream:
+        file = direc.joinpath(str(self.default_settings['microscope']) + '.yaml')
+        with open(str(file), 'r') as stream:
             default = yaml.safe_load(stream)
 
+        self.micr_settings = default
+
         interface = default['interface']
         wavelength = default['wavelength']
         micr_ranges = default['ranges']
@@ -2,6 +2,10 @@ class TEMCommunicationError(ConnectionError):
     pass
 
 
+class TEMServerBusyError(TEMCommunicationError):
+    pass
+
+
 class TEMValueError(ValueError):
     pass
 
@@ -21,6 +25,7 @@ class TEMControllerError(Exception):
 exception_list = {
     'TEMValueError': TEMValueError,
     'TEMCommunicationError': TEMCommunicationError,
+    'TEMServerBusyError': TEMServerBusyError,
     'JEOLValueError': JEOLValueError,
     'FEIValueError': FEIValueError,
     'TEMControllerError   ': TEMControllerError,